@@ -3,7 +3,268 @@ import numpy as np
 import torch
 import json
 import glob
-from torch_geometric.data import Dataset, Data
+import queue
+import threading
+from torch_geometric.data import Dataset, Data, Batch
+from torch.utils.data import Subset
+
+
+def graph_filepaths(data_dir, included_complexes=None):
+    """
+    Returns the filepaths of all graph.pth files in data_dir. If a list of complexes is given, only the graphs 
+    of these complexes (and all their associated ligands) are included.
+    """
+    if included_complexes is None:
+        return [file.path for file in os.scandir(data_dir) if file.name.endswith('graph.pth')]
+
+    dataset_filepaths = []
+    for id in included_complexes:
+        search_pattern = os.path.join(data_dir, f"{id}*_graph.pth")
+        matching_files = glob.glob(search_pattern)
+        dataset_filepaths.extend(matching_files)
+    return dataset_filepaths
+
+
+
+def process_graph(grph,
+                protein_embeddings,
+                ligand_embeddings,
+                data_dict=None,
+                delete_protein=False,
+                delete_ligand=False,
+                edge_features=True,
+                atom_features=True,
+                masternode=False,
+                masternode_connectivity='all',
+                masternode_edges='undirected'):
+
+    """
+    Turns a single graph object as saved by the graph construction (graph.pth) into the Data() object that is fed to 
+    the model. Takes the same kwargs as PDBbind_Dataset (data_dict being the already loaded label dictionary) and is shared 
+    by PDBbind_Dataset and PDBbind_GraphStream, so that both apply identical transformations to the graphs.
+    """
+
+    id = grph.id
+    pos = grph.pos
+
+    if data_dict is not None:
+        min=0
+        max=16
+        try: # If the labels are saved with L00001 in the dictionary
+            pK = data_dict[id]['log_kd_ki']
+        except KeyError: # If the labels are saved without L00001 in the dictionary
+            id_short = id[:-17]
+            pK = data_dict[id_short]['log_kd_ki']
+
+        pK_scaled = (pK - min) / (max - min)
+    else: pK_scaled = 0
+
+    # --- AMINO ACID EMBEDDINGS ---
+    x = grph.x
+
+    # Append the amino acid embeddings to the feature matrices
+    for emb in protein_embeddings:
+        emb_tensor = grph[emb]
+        if emb_tensor is not None:
+            x = torch.concatenate((x, emb_tensor), axis=1)
+
+
+    # --- LIGAND EMBEDDINGS ---
+    ligand_embedding = None
+
+    # Concatenate all ligand embeddings into a single vector
+    for emb in ligand_embeddings:
+        emb_vector = grph[emb]
+        if emb_vector is None: print(f"Embedding {emb} not found for {id}")
+        else:
+            if ligand_embedding is None: ligand_embedding = emb_vector
+            else:
+                ligand_embedding = torch.concatenate((ligand_embedding, emb_vector), axis=1)
+                ligand_embedding = ligand_embedding.float()
+
+
+    # --- EDGE INDECES, EDGE ATTRIBUTES--- 
+    # for convolution on 1) all edges, 2) only ligand edges and 3) only protein edges
+    edge_index = grph.edge_index
+    edge_index_lig = grph.edge_index_lig
+    edge_index_prot = grph.edge_index_prot
+
+    edge_attr = grph.edge_attr
+    edge_attr_lig = grph.edge_attr_lig
+    edge_attr_prot = grph.edge_attr_prot
+
+
+
+    # If a masternode should be included in the graph, add the corresponding edge_index
+    if masternode:
+
+        # Depending on the desired masternode connectivity (to all nodes, to ligand nodes or to protein nodes),
+        # choose the correct edge index master from the graph object
+        if masternode_connectivity == 'all': edge_index_master = grph.edge_index_master
+        elif masternode_connectivity == 'ligand': edge_index_master = grph.edge_index_master_lig
+        elif masternode_connectivity == 'protein': edge_index_master = grph.edge_index_master_prot
+        else: raise ValueError(f"Invalid value for masternode_connectivity: {masternode_connectivity}")
+
+        # By default, the edge_index_master contains directed edges for information flow from the 
+        # ligand and protein nodes to the masternode ("in")
+        if masternode_edges == 'in':
+            pass
+
+        # For information flow from the masternode to the ligand and protein nodes ("out"), swap the rows
+        elif masternode_edges == 'out':
+            edge_index_master = edge_index_master[[1, 0], :]
+
+        # For information flow in both directions ("undirected"), swap the rows and append
+        elif masternode_edges == 'undirected':
+            edge_index_master = torch.concatenate((edge_index_master[:,:-1], edge_index_master[[1, 0], :]), dim=1)
+
+        else: raise ValueError(f"Invalid value for masternode_edges: {masternode_edges}")
+
+        # Append the updated edge_index_master to the edge_index containing the other edges in the graph
+        edge_index = torch.concatenate((edge_index, edge_index_master), dim=1)
+        edge_index_lig = torch.concatenate((edge_index_lig, edge_index_master), dim=1)
+        edge_index_prot = torch.concatenate((edge_index_prot, edge_index_master), dim=1)
+
+
+        # For each edge that has been added to connect the masternode, extend also the edge attribute 
+        # matrix with a feature vector
+
+        mn_edge_attr = torch.tensor([0., 1., 0.,        # it's a mn connection
+                0., 0., 0.,0.,                          # length is zero
+                0., 0., 0.,0.,0.,                       # bondtype = None
+                0.,                                     # is not conjugated
+                0.,                                     # is not in ring
+                0., 0., 0., 0., 0., 0.],                # No stereo
+                dtype=torch.float)
+
+        mn_edge_matrix = mn_edge_attr.repeat(edge_index_master.shape[1], 1)
+
+        edge_attr = torch.concatenate([edge_attr, mn_edge_matrix], axis=0)
+        edge_attr_lig = torch.concatenate([edge_attr_lig, mn_edge_matrix], axis=0)
+        edge_attr_prot = torch.concatenate([edge_attr_prot, mn_edge_matrix], axis=0)
+
+
+    # If NO masternode should be included in the graph, remove the corresponding rows from pos and x
+    else:
+        x = x[:-1, :]
+        pos = pos[:-1, :]
+
+
+
+    # --- ABLATION STUDIES ---
+    # For ablation studies: Generate feature matrices without node/edge features
+    if not atom_features:
+        x = torch.concatenate((x[:, 0:9], x[:, 40:]), dim=1)
+    if not edge_features:
+        edge_attr = edge_attr[:, :7]
+        edge_attr_lig = edge_attr_lig[:, :7]
+        edge_attr_prot = edge_attr_prot[:, :7]
+
+
+    n_prot_nodes = grph.edge_index_master_prot.shape[1] - 1
+    n_lig_nodes = grph.edge_index_master_lig.shape[1] - 1
+    n_nodes = grph.edge_index_master.shape[1] - 1
+
+
+    # For ablation studies: Generate graphs with all protein nodes removed          
+    if delete_protein and delete_ligand: raise ValueError('Cannot delete both protein and ligand nodes')
+
+    elif delete_protein and masternode:
+        # Remove all nodes that don't belong to the ligand from feature matrix, keep masternode
+        x = torch.concatenate( [x[:n_lig_nodes,:] , x[-1,:].view(1,-1)] )
+
+        # Remove all coordinates of nodes that don't belong to the ligand and keep masternode
+        pos = torch.concatenate( [pos[:n_lig_nodes,:] , pos[-1,:].view(1,-1)] )
+
+        # Keep only edges that are between ligand atoms or between ligand atoms and masternode
+        mask = ((edge_index < n_lig_nodes) | (edge_index == n_nodes)).all(dim=0)
+        edge_index = edge_index[:, mask]
+        edge_index[edge_index == n_nodes] = n_lig_nodes
+        edge_attr = edge_attr[mask, :]
+
+        train_graph = Data(x = x.float(),
+                        edge_index=edge_index.long(),
+                        edge_attr=edge_attr.float(),
+                        y=torch.tensor(pK_scaled, dtype=torch.float),
+                        n_nodes=torch.tensor([n_nodes, n_lig_nodes, n_prot_nodes], dtype=torch.long),
+                        lig_emb=ligand_embedding
+                        #,pos=pos
+                        ,id=id
+                        )
+
+    elif delete_protein and not masternode:
+        # Remove all nodes that don't belong to the ligand from feature matrix
+        x = x[:n_lig_nodes,:]
+
+        # Remove all coordinates of nodes that don't belong to the ligand
+        pos = pos[:n_lig_nodes,:]
+
+        # Keep only edges that are between ligand atoms
+        mask = (edge_index < n_lig_nodes).all(dim=0)
+        edge_index = edge_index[:, mask]
+        edge_attr = edge_attr[mask, :]
+
+        train_graph = Data(x = x.float(),
+                        edge_index=edge_index.long(),
+                        edge_attr=edge_attr.float(),
+                        y=torch.tensor(pK_scaled, dtype=torch.float),
+                        n_nodes=torch.tensor([n_nodes, n_lig_nodes, n_prot_nodes], dtype=torch.long),
+                        lig_emb=ligand_embedding
+                        #,pos=pos
+                        ,id=id
+                        )
+
+
+    elif delete_ligand and not masternode: raise ValueError('Cannot delete ligand nodes without masternode')
+
+    elif delete_ligand and masternode:
+        # Remove all nodes that don't belong to the ligand from feature matrix, keep masternode
+        x = x[n_lig_nodes:, :]
+
+        # Remove all coordinates of nodes that don't belong to the ligand and keep masternode (for visualization only)
+        grph.pos = grph.pos[n_lig_nodes:, :]
+
+        # Keep only edges that are between protein nodes and the masternode
+        mask = torch.all(edge_index >= n_lig_nodes, dim=0)
+        edge_index = edge_index[:, mask] - n_lig_nodes
+        edge_attr = edge_attr[mask, :]
+
+        train_graph = Data(x = x.float(),
+                        edge_index=edge_index.long(),
+                        edge_attr=edge_attr.float(),
+                        y=torch.tensor(pK_scaled, dtype=torch.float),
+                        n_nodes=torch.tensor([n_nodes, n_lig_nodes, n_prot_nodes], dtype=torch.long),
+                        lig_emb=ligand_embedding
+                        #,pos=pos
+                        ,id=id
+                        )
+
+
+
+
+    # --- NO ABLATION - Complete Interaction Graphs ---
+    else: 
+        train_graph = Data(x = x.float(), 
+                        edge_index=edge_index.long(),
+                        edge_attr=edge_attr.float(),
+                        # To do: If we want to do convolution on only ligand or protein edges, 
+                        # we need to pass the corresponding edge_index conaining these edges, but in such 
+                        # architectures we can't do the ablation anymore because there we don't have
+                        # any edge_index_lig or edge_index_prot.
+                        #edge_index_lig=edge_index_lig,
+                        #edge_index_prot=edge_index_prot,
+                        #edge_attr_lig=edge_attr_lig,
+                        #edge_attr_prot=edge_attr_prot,
+                        y=torch.tensor(pK_scaled, dtype=torch.float),
+                        n_nodes=torch.tensor([n_nodes, n_lig_nodes, n_prot_nodes], dtype=torch.long),
+                        lig_emb=ligand_embedding
+                        #,pos=pos
+                        ,id=id
+                        )
+
+
+    return train_graph
+
 
 
 class PDBbind_Dataset(Dataset):
@@ -84,16 +345,10 @@ class PDBbind_Dataset(Dataset):
             # including only the complexes that are included in the split dict and 
             # all their associated ligands
             included_complexes = self.split_dict[self.dataset]
-            
-            dataset_filepaths = []
-            for id in included_complexes:
-                search_pattern = os.path.join(self.data_dir, f"{id}*_graph.pth")
-                matching_files = glob.glob(search_pattern)
-                dataset_filepaths.extend(matching_files)
-            self.filepaths = dataset_filepaths
+            self.filepaths = graph_filepaths(self.data_dir, included_complexes)
 
         else: 
-            self.filepaths = [file.path for file in os.scandir(self.data_dir) if file.name.endswith('graph.pth')]
+            self.filepaths = graph_filepaths(self.data_dir)
 
         print("-- Number of graphs loaded: ", len(self.filepaths))
 
@@ -104,232 +359,244 @@ class PDBbind_Dataset(Dataset):
         ind = 0
         for file in self.filepaths:
             grph = torch.load(file)
-            id = grph.id
-            pos = grph.pos
-
-            if self.labels:
-                min=0
-                max=16
-                try: # If the labels are saved with L00001 in the dictionary
-                    pK = self.data_dict[id]['log_kd_ki']
-                except KeyError: # If the labels are saved without L00001 in the dictionary
-                    id_short = id[:-17]
-                    pK = self.data_dict[id_short]['log_kd_ki']
-
-                pK_scaled = (pK - min) / (max - min)
-            else: pK_scaled = 0
-
-            # --- AMINO ACID EMBEDDINGS ---
-            x = grph.x
-            
-            # Append the amino acid embeddings to the feature matrices
-            for emb in self.protein_embeddings:
-                emb_tensor = grph[emb]
-                if emb_tensor is not None:
-                    x = torch.concatenate((x, emb_tensor), axis=1)
-
-
-            # --- LIGAND EMBEDDINGS ---
-            ligand_embedding = None
-
-            # Concatenate all ligand embeddings into a single vector
-            for emb in self.ligand_embeddings:
-                emb_vector = grph[emb]
-                if emb_vector is None: print(f"Embedding {emb} not found for {id}")
-                else:
-                    if ligand_embedding is None: ligand_embedding = emb_vector
-                    else:
-                        ligand_embedding = torch.concatenate((ligand_embedding, emb_vector), axis=1)
-                        ligand_embedding = ligand_embedding.float()
-
-
-            # --- EDGE INDECES, EDGE ATTRIBUTES--- 
-            # for convolution on 1) all edges, 2) only ligand edges and 3) only protein edges
-            edge_index = grph.edge_index
-            edge_index_lig = grph.edge_index_lig
-            edge_index_prot = grph.edge_index_prot
-
-            edge_attr = grph.edge_attr
-            edge_attr_lig = grph.edge_attr_lig
-            edge_attr_prot = grph.edge_attr_prot
-
-
-
-            # If a masternode should be included in the graph, add the corresponding edge_index
-            if masternode:
-
-                # Depending on the desired masternode connectivity (to all nodes, to ligand nodes or to protein nodes),
-                # choose the correct edge index master from the graph object
-                if masternode_connectivity == 'all': edge_index_master = grph.edge_index_master
-                elif masternode_connectivity == 'ligand': edge_index_master = grph.edge_index_master_lig
-                elif masternode_connectivity == 'protein': edge_index_master = grph.edge_index_master_prot
-                else: raise ValueError(f"Invalid value for masternode_connectivity: {masternode_connectivity}")
-
-                # By default, the edge_index_master contains directed edges for information flow from the 
-                # ligand and protein nodes to the masternode ("in")
-                if masternode_edges == 'in':
-                    pass
-
-                # For information flow from the masternode to the ligand and protein nodes ("out"), swap the rows
-                elif masternode_edges == 'out':
-                    edge_index_master = edge_index_master[[1, 0], :]
-
-                # For information flow in both directions ("undirected"), swap the rows and append
-                elif masternode_edges == 'undirected':
-                    edge_index_master = torch.concatenate((edge_index_master[:,:-1], edge_index_master[[1, 0], :]), dim=1)
-                
-                else: raise ValueError(f"Invalid value for masternode_edges: {masternode_edges}")
-
-                # Append the updated edge_index_master to the edge_index containing the other edges in the graph
-                edge_index = torch.concatenate((edge_index, edge_index_master), dim=1)
-                edge_index_lig = torch.concatenate((edge_index_lig, edge_index_master), dim=1)
-                edge_index_prot = torch.concatenate((edge_index_prot, edge_index_master), dim=1)
-
-
-                # For each edge that has been added to connect the masternode, extend also the edge attribute 
-                # matrix with a feature vector
-
-                mn_edge_attr = torch.tensor([0., 1., 0.,        # it's a mn connection
-                        0., 0., 0.,0.,                          # length is zero
-                        0., 0., 0.,0.,0.,                       # bondtype = None
-                        0.,                                     # is not conjugated
-                        0.,                                     # is not in ring
-                        0., 0., 0., 0., 0., 0.],                # No stereo
-                        dtype=torch.float)
-
-                mn_edge_matrix = mn_edge_attr.repeat(edge_index_master.shape[1], 1)
-
-                edge_attr = torch.concatenate([edge_attr, mn_edge_matrix], axis=0)
-                edge_attr_lig = torch.concatenate([edge_attr_lig, mn_edge_matrix], axis=0)
-                edge_attr_prot = torch.concatenate([edge_attr_prot, mn_edge_matrix], axis=0)
-
-
-            # If NO masternode should be included in the graph, remove the corresponding rows from pos and x
-            else:
-                x = x[:-1, :]
-                pos = pos[:-1, :]
-
-
-
-            # --- ABLATION STUDIES ---
-            # For ablation studies: Generate feature matrices without node/edge features
-            if not atom_features:
-                x = torch.concatenate((x[:, 0:9], x[:, 40:]), dim=1)
-            if not edge_features:
-                edge_attr = edge_attr[:, :7]
-                edge_attr_lig = edge_attr_lig[:, :7]
-                edge_attr_prot = edge_attr_prot[:, :7]
-
-
-            n_prot_nodes = grph.edge_index_master_prot.shape[1] - 1
-            n_lig_nodes = grph.edge_index_master_lig.shape[1] - 1
-            n_nodes = grph.edge_index_master.shape[1] - 1
-
-
-            # For ablation studies: Generate graphs with all protein nodes removed          
-            if delete_protein and delete_ligand: raise ValueError('Cannot delete both protein and ligand nodes')
-            
-            elif delete_protein and masternode:
-                # Remove all nodes that don't belong to the ligand from feature matrix, keep masternode
-                x = torch.concatenate( [x[:n_lig_nodes,:] , x[-1,:].view(1,-1)] )
-
-                # Remove all coordinates of nodes that don't belong to the ligand and keep masternode
-                pos = torch.concatenate( [pos[:n_lig_nodes,:] , pos[-1,:].view(1,-1)] )
-
-                # Keep only edges that are between ligand atoms or between ligand atoms and masternode
-                mask = ((edge_index < n_lig_nodes) | (edge_index == n_nodes)).all(dim=0)
-                edge_index = edge_index[:, mask]
-                edge_index[edge_index == n_nodes] = n_lig_nodes
-                edge_attr = edge_attr[mask, :]
-
-                train_graph = Data(x = x.float(),
-                                edge_index=edge_index.long(),
-                                edge_attr=edge_attr.float(),
-                                y=torch.tensor(pK_scaled, dtype=torch.float),
-                                n_nodes=torch.tensor([n_nodes, n_lig_nodes, n_prot_nodes], dtype=torch.long),
-                                lig_emb=ligand_embedding
-                                #,pos=pos
-                                ,id=id
-                                )
-                
-            elif delete_protein and not masternode:
-                # Remove all nodes that don't belong to the ligand from feature matrix
-                x = x[:n_lig_nodes,:]
-
-                # Remove all coordinates of nodes that don't belong to the ligand
-                pos = pos[:n_lig_nodes,:]
-
-                # Keep only edges that are between ligand atoms
-                mask = (edge_index < n_lig_nodes).all(dim=0)
-                edge_index = edge_index[:, mask]
-                edge_attr = edge_attr[mask, :]
-
-                train_graph = Data(x = x.float(),
-                                edge_index=edge_index.long(),
-                                edge_attr=edge_attr.float(),
-                                y=torch.tensor(pK_scaled, dtype=torch.float),
-                                n_nodes=torch.tensor([n_nodes, n_lig_nodes, n_prot_nodes], dtype=torch.long),
-                                lig_emb=ligand_embedding
-                                #,pos=pos
-                                ,id=id
-                                )
-                
-
-            elif delete_ligand and not masternode: raise ValueError('Cannot delete ligand nodes without masternode')
-
-            elif delete_ligand and masternode:
-                # Remove all nodes that don't belong to the ligand from feature matrix, keep masternode
-                x = x[n_lig_nodes:, :]
-
-                # Remove all coordinates of nodes that don't belong to the ligand and keep masternode (for visualization only)
-                grph.pos = grph.pos[n_lig_nodes:, :]
-
-                # Keep only edges that are between protein nodes and the masternode
-                mask = torch.all(edge_index >= n_lig_nodes, dim=0)
-                edge_index = edge_index[:, mask] - n_lig_nodes
-                edge_attr = edge_attr[mask, :]
-
-                train_graph = Data(x = x.float(),
-                                edge_index=edge_index.long(),
-                                edge_attr=edge_attr.float(),
-                                y=torch.tensor(pK_scaled, dtype=torch.float),
-                                n_nodes=torch.tensor([n_nodes, n_lig_nodes, n_prot_nodes], dtype=torch.long),
-                                lig_emb=ligand_embedding
-                                #,pos=pos
-                                ,id=id
-                                )
-
-
-
-
-            # --- NO ABLATION - Complete Interaction Graphs ---
-            else: 
-                train_graph = Data(x = x.float(), 
-                                edge_index=edge_index.long(),
-                                edge_attr=edge_attr.float(),
-                                # To do: If we want to do convolution on only ligand or protein edges, 
-                                # we need to pass the corresponding edge_index conaining these edges, but in such 
-                                # architectures we can't do the ablation anymore because there we don't have
-                                # any edge_index_lig or edge_index_prot.
-                                #edge_index_lig=edge_index_lig,
-                                #edge_index_prot=edge_index_prot,
-                                #edge_attr_lig=edge_attr_lig,
-                                #edge_attr_prot=edge_attr_prot,
-                                y=torch.tensor(pK_scaled, dtype=torch.float),
-                                n_nodes=torch.tensor([n_nodes, n_lig_nodes, n_prot_nodes], dtype=torch.long),
-                                lig_emb=ligand_embedding
-                                #,pos=pos
-                                ,id=id
-                                )
-
-
-            self.input_data[ind] = train_graph
+            self.input_data[ind] = process_graph(grph,
+                                                self.protein_embeddings,
+                                                self.ligand_embeddings,
+                                                data_dict=self.data_dict if self.labels else None,
+                                                delete_protein=delete_protein,
+                                                delete_ligand=delete_ligand,
+                                                edge_features=edge_features,
+                                                atom_features=atom_features,
+                                                masternode=masternode,
+                                                masternode_connectivity=masternode_connectivity,
+                                                masternode_edges=masternode_edges)
             ind += 1
 
+        # Header with the labels and ids of all graphs, so that they can be read without iterating over the graphs 
+        # (e.g. for the data split in train.py)
+        self.label_vector = torch.tensor([graph.y.item() for graph in self.input_data.values()], dtype=torch.float)
+        self.ids = [graph.id for graph in self.input_data.values()]
+
 
     def len(self):
         return len(self.input_data)
     
     def get(self, idx):
         graph = self.input_data[idx]
-        return graph
\ No newline at end of file
+        return graph
+
+
+
+class PDBbind_GraphStream:
+
+    """
+    A class used to stream protein-ligand interaction graphs from a folder of graph.pth files without building a dataset .pt file. 
+    Takes the same kwargs as PDBbind_Dataset and applies the same transformations to the graphs (see process_graph).
+
+    - The graphs are loaded and processed on the fly by num_workers producer threads
+    - The producers hand the processed graphs over to the consumer through a bounded queue, so that at most queue_size graphs are held in memory
+    - Iterating over the stream yields Batch objects of batch_size graphs (the last batch may be smaller)
+    - The order of the graphs in the stream is not deterministic if num_workers > 1
+    """
+
+    def __init__(self,
+                root,                               # Path to the folder containing the graphs
+                protein_embeddings,                 # List of all protein embeddings that should be included
+                ligand_embeddings,                  # List of all ligand embeddings that should be included
+                data_dict=None,                     # Path to dictionary containing the affinity labels of the complexes
+                data_split=None,                    # Filepath to dictionary (json file) containing the data split for the graphs in the folder
+                dataset=None,                       # If a split dict is given, which subset should be streamed
+                delete_protein = False,
+                delete_ligand = False,
+                edge_features=True,
+                atom_features=True,
+                masternode=False,
+                masternode_connectivity = 'all',
+                masternode_edges='undirected',
+                batch_size=128,                     # Number of graphs per yielded Batch
+                queue_size=1024,                    # Maximal number of processed graphs waiting in the queue
+                num_workers=2                       # Number of producer threads loading and processing graphs
+                ):
+
+        self.data_dir = root
+        self.protein_embeddings = protein_embeddings
+        self.ligand_embeddings = ligand_embeddings
+        self.delete_protein = delete_protein
+        self.delete_ligand = delete_ligand
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.num_workers = num_workers
+
+        if data_dict is not None:
+            with open(data_dict, 'r', encoding='utf-8') as json_file:
+                self.data_dict = json.load(json_file)
+            self.labels = True
+        else:
+            self.data_dict = None
+            self.labels = False
+
+        if data_split:
+            with open(data_split, 'r', encoding='utf-8') as json_file:
+                split_dict = json.load(json_file)
+            self.filepaths = graph_filepaths(self.data_dir, split_dict[dataset])
+        else:
+            self.filepaths = graph_filepaths(self.data_dir)
+
+        print("-- Number of graphs to stream: ", len(self.filepaths))
+
+        self.process_kwargs = dict(data_dict=self.data_dict,
+                                   delete_protein=delete_protein,
+                                   delete_ligand=delete_ligand,
+                                   edge_features=edge_features,
+                                   atom_features=atom_features,
+                                   masternode=masternode,
+                                   masternode_connectivity=masternode_connectivity,
+                                   masternode_edges=masternode_edges)
+
+
+    def __len__(self):
+        return len(self.filepaths)
+
+
+    def load(self, filepath):
+        return process_graph(torch.load(filepath), self.protein_embeddings, self.ligand_embeddings, **self.process_kwargs)
+
+
+    def _produce(self, filepaths, graph_queue):
+        try:
+            for file in filepaths:
+                graph_queue.put(self.load(file))
+        except Exception as e:
+            graph_queue.put(e)
+        finally:
+            graph_queue.put(None)
+
+
+    def __iter__(self):
+        graph_queue = queue.Queue(maxsize=self.queue_size)
+        producers = [threading.Thread(target=self._produce, args=(self.filepaths[w::self.num_workers], graph_queue), daemon=True)
+                     for w in range(self.num_workers)]
+        for producer in producers: producer.start()
+
+        batch = []
+        finished = 0
+        while finished < len(producers):
+            item = graph_queue.get()
+            if item is None:
+                finished += 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+
+            batch.append(item)
+            if len(batch) == self.batch_size:
+                yield Batch.from_data_list(batch)
+                batch = []
+
+        if batch: yield Batch.from_data_list(batch)
+
+
+
+class DeviceGraphs:
+
+    """
+    All graphs of a dataset concatenated once into flat tensors on the device, so that batches can be assembled on the 
+    device by index gathering (see DeviceGraphLoader) instead of collating and copying them in every step.
+
+    - Stores x, edge_attr, y, lig_emb and the edge_index relative to the first node of each graph
+    - The node and edge counts are kept on the host as well, so that the size of a batch is known without synchronization
+    - The ids of the graphs are not stored
+    """
+
+    def __init__(self, dataset, device):
+        batch = Batch.from_data_list([dataset[idx] for idx in range(len(dataset))])
+
+        self.device = device
+        self.node_counts_cpu = torch.diff(batch.ptr)
+        self.edge_counts_cpu = torch.bincount(batch.batch[batch.edge_index[0]], minlength=batch.num_graphs)
+
+        self.node_counts = self.node_counts_cpu.to(device)
+        self.edge_counts = self.edge_counts_cpu.to(device)
+        self.node_ptr = batch.ptr[:-1].to(device)
+        self.edge_ptr = (torch.cumsum(self.edge_counts_cpu, 0) - self.edge_counts_cpu).to(device)
+
+        self.x = batch.x.to(device)
+        self.edge_index = (batch.edge_index - batch.ptr[batch.batch[batch.edge_index[0]]]).to(device)
+        self.edge_attr = batch.edge_attr.to(device)
+        self.y = batch.y.to(device)
+        self.lig_emb = batch.lig_emb.to(device) if 'lig_emb' in batch else None
+
+
+    def __len__(self):
+        return self.node_counts_cpu.size(0)
+
+
+    def batch(self, graphs, n_nodes, n_edges):
+        """
+        Assembles the Batch of the graphs with the given indices (tensor on the device), n_nodes and n_edges are the 
+        total numbers of nodes and edges of these graphs
+        """
+        n_graphs = graphs.size(0)
+        arange = torch.arange(max(n_graphs, n_nodes, n_edges), device=self.device)
+
+        # Node and edge pointers of the batch and the assignment of the nodes and edges to the graphs of the batch
+        node_counts, edge_counts = self.node_counts[graphs], self.edge_counts[graphs]
+        ptr = torch.zeros(n_graphs + 1, dtype=torch.long, device=self.device)
+        ptr[1:] = torch.cumsum(node_counts, 0)
+        edge_ptr = torch.cumsum(edge_counts, 0) - edge_counts
+        batch = torch.repeat_interleave(arange[:n_graphs], node_counts, output_size=n_nodes)
+        edge_batch = torch.repeat_interleave(arange[:n_graphs], edge_counts, output_size=n_edges)
+
+        # Gather the nodes and edges of the graphs from the flat tensors
+        nodes = self.node_ptr[graphs][batch] + arange[:n_nodes] - ptr[batch]
+        edges = self.edge_ptr[graphs][edge_batch] + arange[:n_edges] - edge_ptr[edge_batch]
+
+        return Batch(x=self.x[nodes],
+                     edge_index=self.edge_index[:, edges] + ptr[edge_batch],
+                     edge_attr=self.edge_attr[edges],
+                     y=self.y[graphs],
+                     lig_emb=self.lig_emb[graphs] if self.lig_emb is not None else None,
+                     batch=batch,
+                     ptr=ptr)
+
+
+
+class DeviceGraphLoader:
+
+    """
+    Iterates over batches of a subset of the graphs in DeviceGraphs without worker processes and without host to 
+    device copies in each step. Takes the place of a DataLoader in the training and evaluation loops.
+
+    - dataset is the full dataset of the DeviceGraphs or a (nested) Subset of it
+    - The order of the graphs is taken from the sampler (e.g. RandomSampler or DistributedSampler over the subset), in
+      the same way as a DataLoader, so that the batches are the same. Without a sampler, the graphs are in order
+    - The order of an epoch is copied to the device once, the batches are gathered from the flat tensors on the device
+    """
+
+    def __init__(self, graphs, dataset, batch_size, sampler=None):
+        self.graphs = graphs
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.sampler = sampler
+
+        # Indices of the graphs of the subset in the full dataset
+        self.indices = torch.arange(len(dataset))
+        while isinstance(dataset, Subset):
+            self.indices = torch.as_tensor(dataset.indices)[self.indices]
+            dataset = dataset.dataset
+
+
+    def __len__(self):
+        n = len(self.sampler) if self.sampler is not None else len(self.indices)
+        return (n + self.batch_size - 1) // self.batch_size
+
+
+    def __iter__(self):
+        order = self.indices[torch.as_tensor(list(self.sampler))] if self.sampler is not None else self.indices
+        n_nodes = self.graphs.node_counts_cpu[order].tolist()
+        n_edges = self.graphs.edge_counts_cpu[order].tolist()
+        order_device = order.to(self.graphs.device)
+
+        for start in range(0, order.size(0), self.batch_size):
+            end = start + self.batch_size
+            yield self.graphs.batch(order_device[start:end], sum(n_nodes[start:end]), sum(n_edges[start:end]))
@@ -19,6 +19,9 @@ from rdkit.Chem import rdFingerprintGenerator
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+from utils.similarity_matrix import TiledMatrixWriter, update_complex_list
+
 
 # Set up logging with rotation
 log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
@@ -51,77 +54,113 @@ def parse_sdf_files(folder_path, complexes):
     return parsed_molecules
 
 
-def compute_tversky_similarity(mol1, mol2, alpha=0.5, beta=0.5):
-    mfpgen = rdFingerprintGenerator.GetMorganGenerator(radius=2, fpSize=2048)
+# Number of set bits of each byte, for numpy versions without np.bitwise_count (numpy < 2.0)
+POPCOUNT_TABLE = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
 
-    # Generate fingerprints
-    fp1 = mfpgen.GetFingerprint(mol1)
-    fp2 = mfpgen.GetFingerprint(mol2)
+def popcount(words):
+    # Number of set bits of an array of uint64 words, summed over the last axis
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int32)
+    return POPCOUNT_TABLE[words.view(np.uint8)].sum(axis=-1, dtype=np.int32)
 
-    tversky_sim = DataStructs.TverskySimilarity(fp1, fp2, alpha, beta)
-    return tversky_sim
 
+def fingerprint_matrix(complexes, parsed_molecules, radius=2, fp_size=2048):
+    """
+    Computes the Morgan fingerprint of each ligand once and packs the fingerprints into a bit matrix 
+    (num_complexes x fp_size/64 uint64 words). Returns the bit matrix, the number of set bits of each fingerprint 
+    and a mask of the complexes with a valid ligand.
+    """
+    mfpgen = rdFingerprintGenerator.GetMorganGenerator(radius=radius, fpSize=fp_size)
 
+    fingerprints = np.zeros((len(complexes), fp_size // 8), dtype=np.uint8)
+    valid = np.zeros(len(complexes), dtype=bool)
+    for i, complex_id in enumerate(complexes):
+        mol = parsed_molecules[complex_id]
+        if not mol: continue
+        try:
+            fingerprints[i] = np.packbits(mfpgen.GetFingerprintAsNumPy(mol).astype(bool))
+            valid[i] = True
+        except Exception as e:
+            logger.error(f"Error computing fingerprint of {complex_id}: {str(e)}")
 
-def process_pair(id1, id2, mol1, mol2):
-    
-    try:
-        # Compute Tanimoto/Tversky similarity
-        if mol1 and mol2:
-            tanimoto = compute_tversky_similarity(mol1, mol2)
-            if tanimoto == 0: tanimoto = 0.001 # If twersky is zero, set it to a small value
-        else:
-            return 0
+    fingerprints = fingerprints.view(np.uint64)
+    return fingerprints, popcount(fingerprints), valid
 
-    except Exception as e:
-        logger.error(f"Error processing pair {id1}, {id2}: {str(e)}")
 
-    return tanimoto
+def tversky_block(fingerprints, n_bits, valid, rows, cols, alpha=0.5, beta=0.5, block_size=32):
+    """
+    Tversky similarity (as DataStructs.TverskySimilarity) between the fingerprints of a range of rows and a range of 
+    columns, from the popcounts of the bitwise AND of the packed fingerprints (computed for block_size rows at once). 
+    Pairs with an invalid ligand are set to 0, a similarity of zero between valid ligands is set to 0.001 and the 
+    diagonal is set to 0.
+    """
+    (r0, r1), (c0, c1) = rows, cols
+    common = np.empty((r1 - r0, c1 - c0), dtype=np.int32)
+    for start in range(r0, r1, block_size):
+        end = min(start + block_size, r1)
+        common[start-r0:end-r0] = popcount(fingerprints[start:end, None, :] & fingerprints[None, c0:c1, :])
+
+    n_rows, n_cols = n_bits[r0:r1, None], n_bits[None, c0:c1]
+    denominator = alpha * (n_rows - common) + beta * (n_cols - common) + common
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        similarities = np.where(denominator > 0, common / denominator, 0.0)
 
+    # If tversky is zero, set it to a small value
+    similarities[similarities == 0] = 0.001
+    similarities[~valid[r0:r1], :] = 0
+    similarities[:, ~valid[c0:c1]] = 0
+    similarities[np.arange(r0, r1)[:, None] == np.arange(c0, c1)[None, :]] = 0
+    return similarities.astype(np.float32)
 
 
-def main(folder_path):
+
+def main(folder_path, tile_size=512, n_jobs=-1, update=False):
 
     try:
         # List of the names of the complexes
         complexes = sorted([compl[0:4] for compl in os.listdir(folder_path) 
                             if compl[0].isdigit() and compl.endswith('protein.pdb')])
+
+        # Incremental update: The new complexes are appended to the existing list of complexes and only their 
+        # similarities to all complexes are computed, the existing entries of the matrix are kept
+        if update: complexes = update_complex_list('pairwise_similarity_complexes.json', complexes, ['pairwise_similarity_tanimoto.hdf5'])
+
         num_complexes = len(complexes)
         print("Number of complexes: {}".format(num_complexes), flush=True)
 
-        #To Do: Export the list of complexes to a JSON file
-
-        # Initialize the HDF5 file and dataset to save the similarities
-        with h5py.File('pairwise_similarity_tanimoto.hdf5', 'a') as f:
-            if 'similarities' not in f:
-                dset = f.create_dataset("similarities", (num_complexes, num_complexes), dtype='float32', compression="gzip")
-            else:
-                dset = f['similarities']
+        # Save list of complexes to json file
+        if not update:
+            with open('pairwise_similarity_complexes.json', 'w') as f:
+                json.dump(complexes, f)
+            print("List of complexes saved to pairwise_similarity_complexes.json", flush=True)
 
         # Parse the SDF files and store the molecules in a dictionary
         print("Parsing all SDF files...", flush=True)
         parsed_molecules = parse_sdf_files(folder_path, complexes)
         print("Parsed all ligands!", flush=True)
 
-        # Loop through each complex and compare it with all other complexes in parallel
+        # Compute the fingerprints of all ligands once
         tic = time()
-        for i in range(num_complexes):
-
-            to_compare = [j for j in range(i+1, num_complexes)]
-            if len(to_compare) == 0: continue
+        fingerprints, n_bits, valid = fingerprint_matrix(complexes, parsed_molecules)
+        print(f"Time: {time() - tic:.2f} - Computed the fingerprints of {valid.sum()} ligands", flush=True)
 
-            # RUN ALL THE COMPARISONS IN PARALLEL, accumulate the results
-            results = Parallel(n_jobs=-1)(delayed(process_pair)(
-                    complexes[i], complexes[j], parsed_molecules[complexes[i]], parsed_molecules[complexes[j]]) for j in to_compare)
+        # Compute the similarities in square tiles of the upper triangle (the tiles of a tile row in parallel threads) 
+        # and write each tile and its transpose to the HDF5 file in chunk-aligned operations
+        with TiledMatrixWriter('pairwise_similarity_tanimoto.hdf5', num_complexes, tile_size) as writer, \
+             Parallel(n_jobs=n_jobs, prefer='threads') as parallel:
 
-            # APPEND THE TANIMOTO SCORES TO THE HDF5 FILE
-            with h5py.File('pairwise_similarity_tanimoto.hdf5', 'a') as f:
-                dset = f['similarities']
-                for j, metrics in zip(to_compare, results):
-                    dset[i, j] = metrics
-                    dset[j, i] = metrics
+            # In an update, only the tiles with columns of the new complexes are computed (from update_start on)
+            update_start = writer.update_start if update else 0
+            tiles = writer.tiles(col_start=update_start)
+            for row_range in sorted(set(rows for rows, _ in tiles)):
+                row_tiles = [(rows, cols) for rows, cols in tiles if rows == row_range]
+                results = parallel(delayed(tversky_block)(fingerprints, n_bits, valid, rows, cols) for rows, cols in row_tiles)
+                for (rows, cols), similarities in zip(row_tiles, results):
+                    new_columns = np.arange(*cols)[None, :] >= update_start if cols[0] < update_start else None
+                    writer.write(rows, cols, similarities, mask=new_columns)
 
-            print(f"Time: {time() - tic:.2f} - Compared {complexes[i]} ({i}) to indexes {to_compare[0]}-{to_compare[-1]}", flush=True)
+                print(f"Time: {time() - tic:.2f} - Compared {complexes[row_range[0]]} ({row_range[0]}) - {complexes[row_range[1]-1]} ({row_range[1]-1}) to indexes {row_range[0]}-{num_complexes-1}", flush=True)
 
 
     except Exception as e:
@@ -138,7 +177,10 @@ if __name__ == '__main__':
     import argparse
     parser = argparse.ArgumentParser(description="Compute and store pairwise metrics for 3D complexes.")
     parser.add_argument('folder_path', type=str, help='Path to the folder containing the 3D complexes')
+    parser.add_argument('--tile_size', type=int, default=512, help='Size of the square tiles of the similarity matrix that are computed at once (and of the HDF5 chunks)')
+    parser.add_argument('--n_jobs', type=int, default=-1, help='Number of threads computing blocks of rows in parallel (-1 for all CPUs)')
+    parser.add_argument('--update', type=lambda x: x.lower() in ['true', '1', 'yes'], default=False, help='Append the complexes that are not in pairwise_similarity_complexes.json to the existing matrix and compute only their similarities')
     args = parser.parse_args()
 
-    main(args.folder_path)
+    main(args.folder_path, tile_size=args.tile_size, n_jobs=args.n_jobs, update=args.update)
 
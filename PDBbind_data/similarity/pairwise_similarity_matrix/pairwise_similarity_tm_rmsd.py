@@ -1,5 +1,4 @@
 import argparse
-from scipy.spatial import KDTree
 import json
 import sys
 import os
@@ -8,17 +7,24 @@ import logging
 from logging.handlers import RotatingFileHandler
 import warnings
 import h5py
-from scipy.spatial import KDTree
 from time import time
-from joblib import Parallel, delayed
+from joblib import cpu_count
+from multiprocessing import Pool
+from collections import deque
 import numpy as np
 from rdkit import Chem
 from rdkit.Chem import DataStructs
 from rdkit.Chem import rdFingerprintGenerator
+from scipy.sparse import csr_matrix
+from Bio.PDB.PDBParser import PDBParser
 
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..'))
+from utils.similarity_matrix import TiledMatrixWriter, update_complex_list
+from utils.f_parse_pdb_general import parse_pdb
+
 
 # Set up logging with rotation
 log_formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
@@ -69,12 +75,12 @@ def parse_tm_align_output(output):
 
 
 
-def parse_rotation_matrix_and_translation_vector(filename):
+def parse_rotation_matrix_and_translation_vector(output):
     """
-    Parses the rotation matrix and translation vector from a given text file.
+    Parses the rotation matrix and translation vector from the rotation matrix output of TM-align (-m).
     
     Args:
-    filename (str): The path to the text file containing the matrix and vector.
+    output (str): The text written by TM-align containing the matrix and vector.
     
     Returns:
     tuple: A tuple containing:
@@ -84,81 +90,105 @@ def parse_rotation_matrix_and_translation_vector(filename):
     rotation_matrix = []
     translation_vector = []
     
-    # Open and read the file
-    with open(filename, 'r') as file:
-        start_parsing = False
-        for line in file:
-            # Check if we've reached the matrix section
-            if "------ The rotation matrix to rotate Chain_1 to Chain_2 ------" in line:
-                start_parsing = True
-                continue
+    start_parsing = False
+    for line in output.split('\n'):
+        # Check if we've reached the matrix section
+        if "------ The rotation matrix to rotate Chain_1 to Chain_2 ------" in line:
+            start_parsing = True
+            continue
+        
+        # Parse the matrix and vector
+        if start_parsing:
+            if line.strip() and 'm' not in line:  # Ensure it's not a header or empty line
+                parts = line.split()
+                translation_vector.append(float(parts[1]))
+                rotation_matrix.append([float(part) for part in parts[2:]])
             
-            # Parse the matrix and vector
-            if start_parsing:
-                if line.strip() and 'm' not in line:  # Ensure it's not a header or empty line
-                    parts = line.split()
-                    translation_vector.append(float(parts[1]))
-                    rotation_matrix.append([float(part) for part in parts[2:]])
-                
-                # Stop parsing after reading the third line of the matrix
-                if len(rotation_matrix) == 3:
-                    break
+            # Stop parsing after reading the third line of the matrix
+            if len(rotation_matrix) == 3:
+                break
     
+    if len(rotation_matrix) != 3: raise ValueError("No rotation matrix in the TM-align output")
     return np.array(rotation_matrix), np.array(translation_vector)
 
 
 
-def run_tmalign(tm_align_path, pdb1, pdb2, matrix_path=None):
+def run_tmalign(tm_align_path, pdb1, pdb2, rotation_matrix=False):
+    """
+    Runs TM-align and returns the TM-score and the sequence identity, with rotation_matrix=True also the rotation
+    matrix output. TM-align writes the matrix (-m) into a pipe that is passed to the process as /dev/fd/<n>, so no
+    temporary file is written. The matrix output is much smaller than the pipe buffer, the pipe is read after exit.
+    """
+    if not rotation_matrix:
+        result = subprocess.run([tm_align_path, pdb1, pdb2], text=True, capture_output=True)
+        if result.returncode != 0: return None, None
+        return parse_tm_align_output(result.stdout)
 
-    if matrix_path:
-        command = [tm_align_path, pdb1, pdb2, "-m", matrix_path]
+    read_fd, write_fd = os.pipe()
+    try:
+        process = subprocess.Popen([tm_align_path, pdb1, pdb2, "-m", f"/dev/fd/{write_fd}"], text=True,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=(write_fd,))
+    finally:
+        os.close(write_fd)
+    with os.fdopen(read_fd, 'r') as matrix_pipe:
+        stdout, _ = process.communicate()
+        matrix_output = matrix_pipe.read()
 
-    else: command = [tm_align_path, pdb1, pdb2]
+    if process.returncode != 0: return None, None, None
+    tm_score, seq_id = parse_tm_align_output(stdout)
+    return tm_score, seq_id, matrix_output
 
-    # Run the command
-    result = subprocess.run(command, text=True, capture_output=True)
 
-    if result.returncode == 0:
-        #print("Output:\n", result.stdout)
-        tm_score, seq_id = parse_tm_align_output(result.stdout)
-        
-        # Write result.stdout to txt
-        # with open(matrix_path.replace('matrix', 'output'), 'w') as f:
-        #     f.write(result.stdout)
-        return tm_score, seq_id
-    
-    else:
-        return None, None
 
 
+def point_cloud_similarity_scores(pcs1, pcs2, max_elements=2**16):
+    """
+    Root mean squared distance of the points of pc1 to their nearest neighbours in pc2, for many pairs of point clouds
+    (pc1, pc2) at once. The pairs are sorted by size and split into chunks, the point clouds of a chunk are padded to
+    the largest point cloud and the squared distances of all points are computed as one dense (pairs x n1 x n2) tensor
+    of at most max_elements entries, with the padding of pc2 set to infinity.
+    """
+    sizes1 = np.array([len(pc) for pc in pcs1])
+    sizes2 = np.array([len(pc) for pc in pcs2])
+    rmsds = np.empty(len(pcs1))
 
+    order = np.argsort(sizes1 * sizes2, kind='stable')
+    start = 0
+    while start < len(order):
 
-def point_cloud_similarity_score(pc1, pc2):
-    # Ensure both point clouds are numpy arrays
-    pc1 = np.array(pc1)
-    pc2 = np.array(pc2)
-    
-    # Build a KD-tree for the second point cloud
-    tree = KDTree(pc2)
-    
-    # Find the nearest neighbors for each point in pc1
-    distances, _ = tree.query(pc1)
+        # Extend the chunk as long as the padded distance tensor stays within max_elements
+        end, n1, n2 = start, 0, 0
+        while end < len(order):
+            chunk_n1, chunk_n2 = max(n1, sizes1[order[end]]), max(n2, sizes2[order[end]])
+            if end > start and (end + 1 - start) * chunk_n1 * chunk_n2 > max_elements: break
+            end, n1, n2 = end + 1, chunk_n1, chunk_n2
+        chunk = order[start:end]
 
-    # Compute the root mean squared deviation
-    rmsd = np.sqrt(np.mean(distances**2))
-    
-    return rmsd
+        points1 = np.zeros((len(chunk), n1, 3))
+        points2 = np.full((len(chunk), n2, 3), np.inf)
+        for k, pair in enumerate(chunk):
+            points1[k, :sizes1[pair]] = pcs1[pair]
+            points2[k, :sizes2[pair]] = pcs2[pair]
 
+        squared_distances = sum((points1[:, :, None, dim] - points2[:, None, :, dim])**2 for dim in range(3))
+        nearest = squared_distances.min(axis=2)
+        nearest[np.arange(n1)[None, :] >= sizes1[chunk][:, None]] = 0
+
+        rmsds[chunk] = np.sqrt(nearest.sum(axis=1) / sizes1[chunk])
+        start = end
+
+    return rmsds
 
 
 
 
-def process_pair(id1, id2, mol1, mol2, folder_path, tm_align_path):
-    
-    matrix_path = os.path.join(folder_path, f"{id1}_{id2}_matrix.txt")
 
+def align_pair(id1, id2, lig1_coords, folder_path, tm_align_path):
+    """
+    Aligns the proteins of a pair with TM-align and moves ligand 1 with the rotation of the alignment. Returns the
+    TM-score and the moved coordinates of ligand 1 (None if the pair failed, the error is logged)
+    """
     tm_score = np.nan
-    ligand_rmsd = np.nan
     try:
 
         # Align proteins with TM-align
@@ -166,36 +196,185 @@ def process_pair(id1, id2, mol1, mol2, folder_path, tm_align_path):
         pdb1 = os.path.join(folder_path, f"{id1}.pdb")
         pdb2 = os.path.join(folder_path, f"{id2}.pdb")
         
-        tm_score, seq_id = run_tmalign(tm_align_path, pdb1, pdb2, matrix_path)
-        
+        tm_score, seq_id, matrix_output = run_tmalign(tm_align_path, pdb1, pdb2, rotation_matrix=True)
+        if tm_score is None:
+            tm_score = np.nan
+            raise RuntimeError("TM-align failed")
 
         # Compute ligand positioning similarity
-        rot_matrix, t_vector = parse_rotation_matrix_and_translation_vector(matrix_path)
+        rot_matrix, t_vector = parse_rotation_matrix_and_translation_vector(matrix_output)
 
-        # Get the ligand atomcoords
-        lig1_coords = mol1.GetConformer().GetPositions()
-        lig2_coords = mol2.GetConformer().GetPositions()
+        if lig1_coords is None:
+            raise ValueError("Ligand could not be parsed")
 
         # Rotate and translate ligand1 to ligand2
-        lig1_coords_moved = np.dot(lig1_coords, rot_matrix.T) + t_vector
+        return tm_score, np.dot(lig1_coords, rot_matrix.T) + t_vector
 
-        # Compute the positioning similarity
-        ligand_rmsd = point_cloud_similarity_score(lig1_coords_moved, lig2_coords)
+    except Exception as e:
+        logger.error(f"Error processing pair {id1}, {id2}: {str(e)}")
+        return tm_score, None
 
-        if os.path.exists(matrix_path): os.remove(matrix_path)
 
+
+def process_pairs(pairs, ligand_coords, folder_path, tm_align_path):
+    """
+    Returns the [TM-score, ligand RMSD] of the pairs (id1, id2), the ligand positioning similarities of all aligned
+    pairs are computed at once
+    """
+    aligned = [align_pair(id1, id2, ligand_coords[id1], folder_path, tm_align_path) for id1, id2 in pairs]
+
+    ligand_rmsds = np.full(len(pairs), np.nan)
+    moved = []
+    for k, ((id1, id2), (_, lig1_coords_moved)) in enumerate(zip(pairs, aligned)):
+        if lig1_coords_moved is None: continue
+        if ligand_coords[id2] is None: logger.error(f"Error processing pair {id1}, {id2}: Ligand could not be parsed")
+        else: moved.append(k)
+
+    # Compute the positioning similarity
+    if len(moved) > 0:
+        ligand_rmsds[moved] = point_cloud_similarity_scores([aligned[k][1] for k in moved], [ligand_coords[pairs[k][1]] for k in moved])
+
+    return [[tm_score, ligand_rmsd] for (tm_score, _), ligand_rmsd in zip(aligned, ligand_rmsds)]
+
+
+def process_pair(id1, id2, lig1_coords, lig2_coords, folder_path, tm_align_path):
+    return process_pairs([(id1, id2)], {id1: lig1_coords, id2: lig2_coords}, folder_path, tm_align_path)[0]
+
+
+
+# Prefilter of the protein pairs: Pairs that are ruled out by a cheap comparison of the chain lengths, the k-mer
+# sequence identity or a coarse shape descriptor of the Cα atoms are not aligned with TM-align, they are recorded with
+# a TM-score of 0 (below any similarity threshold) and a ligand RMSD of NaN
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+KMER_SIZE = 3
+SHAPE_BINS = np.arange(0, 62, 2) # Bins (in Angstrom) of the distances of the Cα atoms to their centroid
+
+
+def protein_profile(folder_path, complex_id):
+    """
+    Returns the number of amino acids, the indices of the k-mers in the sequences (aa_seq) of the chains and the
+    histogram of the distances of the Cα atoms to their centroid of a protein, or None if it could not be parsed
+    """
+    try:
+        with open(os.path.join(folder_path, f"{complex_id}.pdb")) as pdbfile:
+            protein = parse_pdb(PDBParser(PERMISSIVE=1, QUIET=True), complex_id, pdbfile)
     except Exception as e:
-        logger.error(f"Error processing pair {id1}, {id2}: {str(e)}")
+        logger.error(f"Error parsing protein {complex_id}: {str(e)}")
+        return None
+
+    length = 0
+    kmers = set()
+    ca_coords = []
+    for chain in protein.values():
+        codes = [AMINO_ACIDS.find(aa) for aa in chain['aa_seq']]
+        length += len(codes)
+        for k in range(len(codes) - KMER_SIZE + 1):
+            window = codes[k:k + KMER_SIZE]
+            if min(window) >= 0: kmers.add(sum(code * len(AMINO_ACIDS)**pos for pos, code in enumerate(window)))
 
-    return [tm_score, ligand_rmsd]
+        for residue in chain['aa_residues'].values():
+            if 'CA' in residue['atoms']: ca_coords.append(residue['coords'][residue['atoms'].index('CA')])
 
+    if length == 0 or len(ca_coords) == 0: return None
 
+    ca_coords = np.array(ca_coords)
+    distances = np.linalg.norm(ca_coords - ca_coords.mean(axis=0), axis=1)
+    shape = np.histogram(np.clip(distances, 0, SHAPE_BINS[-1] - 1e-3), bins=SHAPE_BINS)[0] / len(distances)
 
+    return {'length': length, 'kmers': sorted(kmers), 'shape': shape}
 
 
 
+class PairPrefilter:
+
+    """
+    Screens the protein pairs of a tile before the alignment. A pair is aligned only if it passes all enabled criteria
+    (threshold > 0), pairs with a protein that could not be profiled are always aligned:
 
-def main(folder_path, tm_align_path, start_complex=0, end_complex=19443):
+    - min_length_ratio: ratio of the number of amino acids of the shorter and the longer protein
+    - min_kmer_identity: fraction of the k-mers of the protein with fewer k-mers that are also found in the other one
+    - min_shape_similarity: overlap (sum of the minima) of the histograms of the Cα distances to the centroid
+
+    Note that the TM-score is normalized by the shorter protein, so a small protein that matches a domain of a large
+    one has a high TM-score despite a low length ratio, the thresholds should be chosen conservatively.
+    """
+
+    def __init__(self, profiles, min_length_ratio=0, min_kmer_identity=0, min_shape_similarity=0):
+        self.min_length_ratio = min_length_ratio
+        self.min_kmer_identity = min_kmer_identity
+        self.min_shape_similarity = min_shape_similarity
+
+        self.valid = np.array([profile is not None for profile in profiles])
+        profiles = [profile if profile is not None else {'length': 1, 'kmers': [], 'shape': np.zeros(len(SHAPE_BINS) - 1)}
+                    for profile in profiles]
+
+        self.lengths = np.array([profile['length'] for profile in profiles], dtype=np.float64)
+        self.shapes = np.stack([profile['shape'] for profile in profiles])
+
+        # Binary k-mer occurrence matrix (proteins x k-mers), the shared k-mers of the pairs of a tile are a sparse product
+        indptr = np.cumsum([0] + [len(profile['kmers']) for profile in profiles])
+        indices = np.concatenate([profile['kmers'] for profile in profiles]).astype(np.int64)
+        self.kmers = csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr),
+                                shape=(len(profiles), len(AMINO_ACIDS)**KMER_SIZE))
+        self.kmer_counts = np.diff(indptr)
+
+
+    def candidates(self, rows, cols):
+        """
+        Returns a boolean array of the pairs of the tile (row range x column range) that should be aligned
+        """
+        r, c = slice(*rows), slice(*cols)
+        passed = np.ones((rows[1] - rows[0], cols[1] - cols[0]), dtype=bool)
+
+        if self.min_length_ratio > 0:
+            lengths1, lengths2 = self.lengths[r, None], self.lengths[None, c]
+            passed &= np.minimum(lengths1, lengths2) / np.maximum(lengths1, lengths2) >= self.min_length_ratio
+
+        if self.min_kmer_identity > 0:
+            shared = (self.kmers[r] @ self.kmers[c].T).toarray()
+            identity = shared / np.maximum(np.minimum(self.kmer_counts[r, None], self.kmer_counts[None, c]), 1)
+            passed &= identity >= self.min_kmer_identity
+
+        if self.min_shape_similarity > 0:
+            overlap = np.minimum(self.shapes[r, None, :], self.shapes[None, c, :]).sum(axis=-1)
+            passed &= overlap >= self.min_shape_similarity
+
+        return passed | ~(self.valid[r, None] & self.valid[None, c])
+
+
+
+# The worker processes of the pool are started once and keep the ligand coordinates of all complexes in memory, each
+# task is a batch of pairs
+worker_state = {}
+
+def init_worker(folder_path, tm_align_path, ligand_coords):
+    worker_state.update(folder_path=folder_path, tm_align_path=tm_align_path, ligand_coords=ligand_coords)
+
+
+def profile_worker(complex_id):
+    return protein_profile(worker_state['folder_path'], complex_id)
+
+
+def process_batch(pairs):
+    return process_pairs(pairs, worker_state['ligand_coords'], worker_state['folder_path'], worker_state['tm_align_path'])
+
+
+
+def ligand_coordinates(parsed_molecules):
+    coords = {}
+    for complex_id, mol in parsed_molecules.items():
+        try: coords[complex_id] = mol.GetConformer().GetPositions()
+        except Exception: coords[complex_id] = None
+    return coords
+
+
+
+
+
+
+
+def main(folder_path, tm_align_path, start_complex=0, end_complex=None, tile_size=128, n_jobs=-1, batch_size=256,
+         min_length_ratio=0, min_kmer_identity=0, min_shape_similarity=0, update=False):
 
     try:
         run = 8
@@ -204,66 +383,90 @@ def main(folder_path, tm_align_path, start_complex=0, end_complex=19443):
         complexes = sorted([compl[0:4] for compl in os.listdir(folder_path) 
                             if compl[0].isdigit() and compl.endswith('.pdb')])
 
+        # Incremental update: The new complexes are appended to the existing list of complexes and only their 
+        # similarities to all complexes are computed, the existing entries of the matrices are kept
+        if update:
+            complexes = update_complex_list('pairwise_similarity_complexes.json', complexes,
+                                            [f'pairwise_similarity_tm_scores_{run}.hdf5', f'pairwise_similarity_rmsd_ligand_{run}.hdf5'])
+
         num_complexes = len(complexes)
         print("Number of complexes: {}".format(num_complexes), flush=True)
 
         # Save list of complexes to json file
-        with open('pairwise_similarity_complexes.json', 'w') as f:
-            json.dump(complexes, f)
-        print("List of complexes saved to pairwise_similarity_complexes.json", flush=True)
-
+        if not update:
+            with open('pairwise_similarity_complexes.json', 'w') as f:
+                json.dump(complexes, f)
+            print("List of complexes saved to pairwise_similarity_complexes.json", flush=True)
 
-        # Initialize the HDF5 file and dataset to save the similarities
-        with h5py.File(f'pairwise_similarity_tm_scores_{run}.hdf5', 'a') as f:
-            if 'similarities' not in f:
-                dset = f.create_dataset("similarities", (num_complexes, num_complexes), dtype='float32', compression="gzip")
-            else:
-                dset = f['similarities']
 
+        # HDF5 files of the TM scores and the ligand RMSDs, written in square tiles of tile_size (see TiledMatrixWriter)
+        tm_writer = TiledMatrixWriter(f'pairwise_similarity_tm_scores_{run}.hdf5', num_complexes, tile_size)
+        rmsd_writer = TiledMatrixWriter(f'pairwise_similarity_rmsd_ligand_{run}.hdf5', num_complexes, tile_size)
 
-        with h5py.File(f'pairwise_similarity_rmsd_ligand_{run}.hdf5', 'a') as f:
-            if 'similarities' not in f:
-                dset = f.create_dataset("similarities", (num_complexes, num_complexes), dtype='float32', compression="gzip")
-            else:
-                dset = f['similarities']
+        # In an update, only the pairs with a new complex (from update_start on) are compared
+        with tm_writer, rmsd_writer: update_start = min(tm_writer.update_start, rmsd_writer.update_start) if update else 0
 
 
-        # Parse the SDF files and store the molecules in a dictionary
+        # Parse the SDF files and keep the ligand coordinates
         print("Parsing all SDF files...", flush=True)
-        parsed_molecules = parse_sdf_files(folder_path, complexes)
+        ligand_coords = ligand_coordinates(parse_sdf_files(folder_path, complexes))
         print("Parsed all ligands!", flush=True)
 
 
-        # Loop through each complex and compare it with all other complexes in parallel
+        # Loop through the tiles of the upper triangle in the tile rows that start in [start_complex, end_complex).
+        # The comparisons of a tile are submitted in batches to the worker pool, the next tile is submitted before the
+        # results of the previous tile are collected and written, so the workers stay busy across the tiles
+        n_workers = cpu_count() if n_jobs < 0 else n_jobs
+        pending = deque()
         tic = time()
-        for i in range(num_complexes):
 
-            if not start_complex <= i < end_complex: continue
+        def write_tile(rows, cols, to_compare, skipped, batch_results):
 
-            to_compare = [j for j in range(i+1, num_complexes)]
-            if len(to_compare) == 0: continue
+            # Wait for the results of the batches of the tile and write them to the matrices
+            tm_scores = np.zeros((rows[1] - rows[0], cols[1] - cols[0]), dtype=np.float32)
+            ligand_rmsds = np.zeros((rows[1] - rows[0], cols[1] - cols[0]), dtype=np.float32)
+            results = [metrics for batch in batch_results.get() for metrics in batch]
+            for (i, j), metrics in zip(to_compare, results):
+                tm_scores[i - rows[0], j - cols[0]] = metrics[0]
+                ligand_rmsds[i - rows[0], j - cols[0]] = metrics[1]
+            ligand_rmsds[skipped] = np.nan
 
-            # RUN ALL THE COMPARISONS IN PARALLEL, accumulate the results
-            results = Parallel(n_jobs=-1)(delayed(process_pair)(
-                    complexes[i], complexes[j], parsed_molecules[complexes[i]], parsed_molecules[complexes[j]],
-                    folder_path, tm_align_path) for j in to_compare)
+            # WRITE THE TILE AND ITS TRANSPOSE TO THE HDF5 FILES (in an update only the columns of the new complexes)
+            new_columns = np.arange(*cols)[None, :] >= update_start if cols[0] < update_start else None
+            with tm_writer: tm_writer.write(rows, cols, tm_scores, mask=new_columns)
+            with rmsd_writer: rmsd_writer.write(rows, cols, ligand_rmsds, mask=new_columns)
 
+            prefiltered = f" ({len(to_compare)} of {len(to_compare) + skipped.sum()} pairs aligned)" if prefilter else ""
+            print(f"Time: {time() - tic:.2f} - Compared {complexes[rows[0]]}-{complexes[rows[1]-1]} ({rows[0]}-{rows[1]-1}) to indexes {cols[0]}-{cols[1]-1}{prefiltered}", flush=True)
 
-            # APPEND THE TM SCORES TO THE HDF5 FILE
-            with h5py.File(f'pairwise_similarity_tm_scores_{run}.hdf5', 'a') as f:
-                dset = f['similarities']
-                for j, metrics in zip(to_compare, results):
-                    dset[i, j] = metrics[0]
-                    dset[j, i] = metrics[0]
 
-            # APPEND THE LIGAND RMSD TO THE HDF5 FILE
-            with h5py.File(f'pairwise_similarity_rmsd_ligand_{run}.hdf5', 'a') as f:
-                    dset = f['similarities']
-                    for j, metrics in zip(to_compare, results):
-                        dset[i, j] = metrics[1]
-                        dset[j, i] = metrics[1]
-            
-            print(f"Time: {time() - tic:.2f} - Compared {complexes[i]} ({i}) to indexes {to_compare[0]}-{to_compare[-1]}", flush=True)
+        with Pool(n_workers, initializer=init_worker, initargs=(folder_path, tm_align_path, ligand_coords)) as pool:
+
+            # Profiles of the proteins for the prefilter of the pairs
+            prefilter = None
+            if min_length_ratio > 0 or min_kmer_identity > 0 or min_shape_similarity > 0:
+                print("Computing the protein profiles for the prefilter...", flush=True)
+                profiles = pool.map(profile_worker, complexes, chunksize=16)
+                prefilter = PairPrefilter(profiles, min_length_ratio, min_kmer_identity, min_shape_similarity)
+                print(f"Computed the profiles of {prefilter.valid.sum()} proteins!", flush=True)
+
+            for rows, cols in tm_writer.tiles(start_complex, end_complex, col_start=update_start):
+
+                upper = (np.arange(*rows)[:, None] < np.arange(*cols)[None, :]) & (np.arange(*cols)[None, :] >= update_start)
+                if not upper.any(): continue
+
+                candidates = upper & prefilter.candidates(rows, cols) if prefilter else upper
+                to_compare = [(i + rows[0], j + cols[0]) for i, j in zip(*np.nonzero(candidates))]
+
+                # The pairs are aligned in the order of the complex names (the ligand RMSD depends on the direction
+                # of the alignment), so that the appended complexes of an update get the values of a full computation
+                batches = [[tuple(sorted((complexes[i], complexes[j]))) for i, j in to_compare[start:start + batch_size]]
+                           for start in range(0, len(to_compare), batch_size)]
+                pending.append((rows, cols, to_compare, upper & ~candidates, pool.map_async(process_batch, batches, chunksize=1)))
+
+                if len(pending) > 1: write_tile(*pending.popleft())
+
+            while pending: write_tile(*pending.popleft())
 
 
     except Exception as e:
@@ -281,9 +484,17 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Compute and store pairwise metrics for 3D complexes.")
     parser.add_argument('folder_path', type=str, help='Path to the folder containing the 3D complexes')
     parser.add_argument('tm_align_path', type=str, help='Path to the TM-align executable')
-    parser.add_argument('start_complex', type=int, default=0, help='Index of the first complex to process')
-    parser.add_argument('end_complex', type=int, default=19443, help='Index of the last complex to process')
+    parser.add_argument('start_complex', type=int, nargs='?', default=0, help='Index of the first complex to process')
+    parser.add_argument('end_complex', type=int, nargs='?', default=None, help='Index of the last complex to process (default: all complexes)')
+    parser.add_argument('--tile_size', type=int, default=128, help='Size of the square tiles of the matrices that are computed at once (and of the HDF5 chunks), start_complex and end_complex should be multiples of it')
+    parser.add_argument('--n_jobs', type=int, default=-1, help='Number of worker processes running TM-align (-1: all available CPUs)')
+    parser.add_argument('--batch_size', type=int, default=256, help='Number of pairs that are sent to a worker process at once')
+    parser.add_argument('--min_length_ratio', type=float, default=0, help='Prefilter: Align only pairs with a ratio of the protein lengths (shorter/longer) of at least this value (0: disabled)')
+    parser.add_argument('--min_kmer_identity', type=float, default=0, help=f'Prefilter: Align only pairs that share at least this fraction of the {KMER_SIZE}-mers of the sequences (0: disabled)')
+    parser.add_argument('--min_shape_similarity', type=float, default=0, help='Prefilter: Align only pairs with an overlap of the Cα distance histograms of at least this value (0: disabled)')
+    parser.add_argument('--update', type=lambda x: x.lower() in ['true', '1', 'yes'], default=False, help='Append the complexes that are not in pairwise_similarity_complexes.json to the existing matrices and compare only the new complexes to all complexes')
     args = parser.parse_args()
 
-    main(args.folder_path, args.tm_align_path, args.start_complex, args.end_complex)
+    main(args.folder_path, args.tm_align_path, args.start_complex, args.end_complex, args.tile_size, args.n_jobs, args.batch_size,
+         args.min_length_ratio, args.min_kmer_identity, args.min_shape_similarity, args.update)
 
@@ -1,6 +1,12 @@
-import h5py
+import os
+import sys
 import json
+import heapq
 import numpy as np
+from scipy.sparse import csr_matrix
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.similarity_matrix import SimilarityMatrix
 
 
 # INPUTS
@@ -55,57 +61,70 @@ refined = np.array([1 if "refined" in pdbbind_data[complex]['dataset'] else 0 fo
 # Vector storing the resolutions of the complexes
 resolutions = np.array([float(pdbbind_data[complex]['resolution']) if pdbbind_data[complex]['resolution'] != 'NMR' else 3.0 for complex in complexes])
 
-# Pairwise label difference matrix
+# Labels of the complexes (the label differences are computed for the pairs in the blocks of the similarity graph)
 labels = np.array([pdbbind_data[complex]['log_kd_ki'] for complex in complexes])
-pairwise_label_diff = labels[:, np.newaxis] - labels[np.newaxis, :]
-pairwise_label_diff = np.abs(pairwise_label_diff)
 
-# Indeces of data points in the current training dataset
-train_dataset_indices = [complexes.index(complex) for complex in train_dataset]
-non_train_dataset_indices = [complexes.index(complex) for complex in complexes if complex not in train_dataset]
+# Complexes in the current training dataset that are not test complexes
+train_set = set(train_dataset)
+train_mask = np.array([complex in train_set for complex in complexes]) & ~train_or_test
 # -----------------------------------------------------------------------------------------------
 
 
 
-# CREATE ADJACENCY MATRIX BASED ON THRESHOLDS FOR TANIMOTO, TM-SCORE AND LABEL DIFFERENCES
+# CREATE SPARSE SIMILARITY GRAPH BASED ON THRESHOLDS FOR TANIMOTO, TM-SCORE AND LABEL DIFFERENCES
 # -----------------------------------------------------------------------------------------------
 
-# TM-SCORE SIMILARITY MATRIX
-with h5py.File(PSM_tm_scores_file, 'r') as f:
-    similarity_matrix_tm = f['similarities'][:]
-
-adjacency_matrix = similarity_matrix_tm > TM_threshold # Pairs with TM-score > 0.8
-
-
-# TANIMOTO SIMILARITY MATRIX combined with RMSD SIMILARITY MATRIX
-with h5py.File(PSM_tanimoto_file, 'r') as f:
-    similarity_matrix_tanimoto = f['similarities'][:]
-
-with h5py.File(PSM_rmsd_file, 'r') as f:
-    similarity_matrix_rmsd = f['similarities'][:]
-
-similarity_matrix = similarity_matrix_tanimoto + (1 - similarity_matrix_rmsd) 
-
-# Pairs with S = tanimoto+(1-RMSE) > 0.8
-adjacency_matrix = adjacency_matrix & (similarity_matrix > S_threshold)
-
-
-# PAIRWISE LABLE DIFFERENCES MATRIX
-adjacency_matrix = adjacency_matrix & (pairwise_label_diff < label_threshold)
-
-
-# Set all rows and columns corresponding to test complexes to zero using train_or_test vector
-adjacency_matrix[train_or_test, :] = 0
-adjacency_matrix[:, train_or_test] = 0
-
-# Set all rows and columns corresponding to complexes NOT in the current training dataset to zero
-adjacency_matrix[non_train_dataset_indices, :] = 0
-adjacency_matrix[:, non_train_dataset_indices] = 0
-
-# Finalize the adjacency matrix
-adjacency_matrix = adjacency_matrix.astype(int)
-adjacency_matrix = np.maximum(adjacency_matrix, adjacency_matrix.T) # Make the adjacency matrix symmetric
-np.fill_diagonal(adjacency_matrix, 0)
+# The similarity matrices are read in blocks of rows, the pairs of training complexes with
+# TM-score > TM_threshold, S = tanimoto+(1-RMSE) > S_threshold and label difference < label_threshold
+# are collected as the edges of a sparse graph (CSR), memory is proportional to the number of similar pairs.
+# The similarities of the edges are kept for the log of the removals.
+block_size = 512
+edge_rows, edge_cols, edge_similarities = [], [], []
+
+with SimilarityMatrix(PSM_tanimoto_file) as tanimoto_matrix, \
+     SimilarityMatrix(PSM_tm_scores_file) as tm_scores_matrix, \
+     SimilarityMatrix(PSM_rmsd_file) as rmsd_matrix:
+
+    num_complexes = tm_scores_matrix.size
+    for r0 in range(0, num_complexes, block_size):
+        r1 = min(r0 + block_size, num_complexes)
+        if not train_mask[r0:r1].any(): continue
+        rows, cols = (r0, r1), (0, num_complexes)
+
+        tanimoto = tanimoto_matrix.block(rows, cols)
+        tm_scores = tm_scores_matrix.block(rows, cols)
+        rmsds = rmsd_matrix.block(rows, cols)
+
+        # Pairs with TM-score > 0.8
+        block = tm_scores > TM_threshold
+
+        # Pairs with S = tanimoto+(1-RMSE) > 1.3
+        block &= tanimoto + (1 - rmsds) > S_threshold
+
+        # Pairs with label difference < 0.5
+        block &= np.abs(labels[r0:r1, np.newaxis] - labels[np.newaxis, :]) < label_threshold
+
+        # Keep only the pairs of complexes in the current training dataset
+        block &= train_mask[r0:r1, np.newaxis] & train_mask[np.newaxis, :]
+
+        block_rows, block_cols = np.nonzero(block)
+        edge_rows.append(block_rows + r0)
+        edge_cols.append(block_cols)
+        edge_similarities.append(np.stack([tanimoto[block], tm_scores[block], rmsds[block]]))
+
+edge_rows = np.concatenate(edge_rows + [np.zeros(0, dtype=np.int64)])
+edge_cols = np.concatenate(edge_cols + [np.zeros(0, dtype=np.int64)])
+edge_similarities = np.concatenate(edge_similarities + [np.zeros((3, 0), dtype=np.float32)], axis=1)
+
+# Finalize the graph (without self-similarities, symmetric): The pairs of both directions are sorted by row and
+# column into the CSR order, a pair that is found in both directions keeps the similarities of its own direction
+keep = edge_rows != edge_cols
+edge_rows, edge_cols, edge_similarities = edge_rows[keep], edge_cols[keep], edge_similarities[:, keep]
+pairs, first = np.unique(np.concatenate([edge_rows * num_complexes + edge_cols, edge_cols * num_complexes + edge_rows]), return_index=True)
+edge_similarities = np.concatenate([edge_similarities, edge_similarities], axis=1)[:, first]
+
+indptr = np.concatenate([[0], np.cumsum(np.bincount(pairs // num_complexes, minlength=num_complexes))])
+graph = csr_matrix((np.ones(len(pairs), dtype=np.int8), pairs % num_complexes, indptr), shape=(num_complexes, num_complexes))
 # -----------------------------------------------------------------------------------------------
 
 
@@ -116,61 +135,59 @@ np.fill_diagonal(adjacency_matrix, 0)
 # Initialize the filtered training dataset
 train_dataset_filtered = train_dataset.copy()
 
-# Initialize the column sums
-column_sums = np.sum(adjacency_matrix, axis=0)
+# Initialize the column sums (degrees of the complexes in the similarity graph)
+column_sums = np.diff(graph.indptr).astype(np.int64)
+num_nonzero = graph.nnz
+
+# Complexes that have been removed from the graph (their edges are no longer counted)
+removed = np.zeros(num_complexes, dtype=bool)
 
-# List to keep track of which data points remain
-remaining_indices = np.arange(adjacency_matrix.shape[0])
+# Bucket queue of the complexes by their column sum: Each bucket is a heap ordered by the tie-breaking of the removal
+# (general before refined complexes, then higher resolution values, then lower index). The column sums only decrease,
+# a complex is pushed to its new bucket when its sum changes and outdated entries are skipped when they are popped
+def priority(i):
+    return (refined[i], -resolutions[i], i)
+
+buckets = [[] for _ in range(column_sums.max(initial=0) + 1)]
+for i in np.nonzero(column_sums)[0]:
+    buckets[column_sums[i]].append(priority(i))
+for bucket in buckets: heapq.heapify(bucket)
+max_sum_value = len(buckets) - 1
 
 while True:
 
-    # Step 3: Find the maximum sum and identify all indices with this sum
-    max_sum_value = np.max(column_sums)
+    # Step 3: Find the maximum sum and the complex with the highest priority with this sum
+    while max_sum_value > 0 and (len(buckets[max_sum_value]) == 0 or column_sums[buckets[max_sum_value][0][2]] != max_sum_value):
+        if len(buckets[max_sum_value]) == 0: max_sum_value -= 1
+        else: heapq.heappop(buckets[max_sum_value]) # Outdated entry
     if max_sum_value == 0: break # Break if all sums are zero (no more redundancies)
-    
-    # Save some information about the complexes with the maximum sum
-    info = [(i, sum, complexes[i], labels[i], pdbbind_data[complexes[i]]['dataset'], resolutions[i])
-            for i, sum in enumerate(column_sums) if sum == max_sum_value]    
 
     # Step 4: Remove the data point with the maximum sum, preferring general complexes with higher resolution values
-    max_indices = np.where(column_sums == max_sum_value)[0] # Select the columns with the maximum sum
-    refined_or_general = refined[max_indices]
-    general = max_indices[refined_or_general == 0]
-    if len(general) > 0: max_indices = general # If there are some general complexes, select them
-    to_remove_idx = max_indices[np.argmax(resolutions[max_indices])] # Select the one with the highest resolution value
-
-    # Step 5: Update the column sums incrementally
-    similarities = adjacency_matrix[to_remove_idx, :].copy()
-
-    # # Print some information about the similarities
-    # before = sorted([(column_sums[i], similarities[i]) for i in range(len(column_sums)) if similarities[i] > 0 or column_sums[i] == max_sum_value], reverse=True)
-    # print(f"Column sums before removal: {[tup[0] for tup in before]}")
-    # print(f"Similarities vector:        {[tup[1] for tup in before]}")
+    to_remove_idx = heapq.heappop(buckets[max_sum_value])[2]
+
+    # Step 5: Update the column sums incrementally with the neighbors that have not been removed yet
+    edges = np.arange(graph.indptr[to_remove_idx], graph.indptr[to_remove_idx + 1])
+    edges = edges[~removed[graph.indices[edges]]]
+    similar_complexes_idx = graph.indices[edges]
     
-    # Update the column sums
-    column_sums -= similarities
+    column_sums[similar_complexes_idx] -= 1
     column_sums[to_remove_idx] = 0  # Ensure the removed index is not considered again
+    for i in similar_complexes_idx:
+        if column_sums[i] > 0: heapq.heappush(buckets[column_sums[i]], priority(i))
 
-    # # Print some information about the similarities after the removal
-    # after = sorted([(column_sums[i], similarities[i]) for i in range(len(column_sums)) if similarities[i] > 0], reverse=True)
-    # print(f"Column sums after removal:  {[tup[0] for tup in after]}")
-
-    # Step 6: Zero out the row and column for the removed data point
-    adjacency_matrix[to_remove_idx, :] = 0
-    adjacency_matrix[:, to_remove_idx] = 0
+    # Step 6: Remove the edges of the removed data point
+    removed[to_remove_idx] = True
+    num_nonzero -= 2 * len(similar_complexes_idx)
     
 
     # Record the removal of this data point
     print("New removal iteration")
-    print(f"Non-zero entries in adjacency_matrix: {np.count_nonzero(adjacency_matrix)}")
+    print(f"Non-zero entries in adjacency_matrix: {num_nonzero}")
     print(f"Maximal number of similarities: {max_sum_value}")
-    #print(f"Info about the complexes with maximum similarities:")
-    #for inf in info: print(str(inf))
     print(f"To remove index: {to_remove_idx}, complex: {complexes[to_remove_idx]}")
 
 
     membership = "refined" if refined[to_remove_idx] == 1 else "general"
-    similar_complexes_idx = np.nonzero(similarities)[0]
 
 
     # If the complex is still in the current training dataset, remove it
@@ -184,8 +201,8 @@ while True:
 
         print(log_string)
 
-        for ind in similar_complexes_idx:
-            log_string += f'\n---{complexes[ind]} (Label:{labels[ind]:.2f} +-{pairwise_label_diff[to_remove_idx, ind]:.2f} with Tanimoto:{similarity_matrix_tanimoto[to_remove_idx, ind]:.2f}, TM-score:{similarity_matrix_tm[to_remove_idx, ind]:.2f}, RMSD:{similarity_matrix_rmsd[to_remove_idx, ind]:.2f})'
+        for ind, (tanimoto, tm_score, rmsd) in zip(similar_complexes_idx, edge_similarities[:, edges].T):
+            log_string += f'\n---{complexes[ind]} (Label:{labels[ind]:.2f} +-{np.abs(labels[to_remove_idx] - labels[ind]):.2f} with Tanimoto:{tanimoto:.2f}, TM-score:{tm_score:.2f}, RMSD:{rmsd:.2f})'
   
         print(log_string+ "\n\n")
 
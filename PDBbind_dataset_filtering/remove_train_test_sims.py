@@ -1,8 +1,11 @@
-import h5py
+import sys
 import numpy as np
 import os
 import json
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.similarity_matrix import SimilarityMatrix
+
 """
 This script removes data leakage by filtering out training complexes that are highly similar to test complexes 
 based on pairwise similarity metrics. The filtered datasets are saved in a new split dictionary, including a filtered training dataset
@@ -61,8 +64,11 @@ with open('../PDBbind_data/similarity/pairwise_similarity_matrix/pairwise_simila
 # Initialize the split of the filtered dataset
 split_dict = {'casf2016': casf2016, 'casf2013': casf2013}
 
+# Sets of the test complexes for fast membership tests
+test_dataset_set, casf2013_set, casf2016_set = set(test_dataset), set(casf2013), set(casf2016)
+
 # Create list of test complexes and a list of training complexes
-train_or_test = np.array([0 if complex in test_dataset else 1 for complex in complexes])
+train_or_test = np.array([0 if complex in test_dataset_set else 1 for complex in complexes])
 test_set = [(idx, complex) for idx, complex in enumerate(complexes) if train_or_test[idx] == 0] 
 train_set = [(idx, complex) for idx, complex in enumerate(complexes) if train_or_test[idx] == 1]
 
@@ -80,8 +86,8 @@ train_test_sims_casf2013_n = {}
 
 # Initialize the filtered datasets
 training_set_filtered = [complex for _, complex in train_set]
-casf2013_filtered = [complex for _, complex in test_set if complex in casf2013]
-casf2016_filtered = [complex for _, complex in test_set if complex in casf2016]
+casf2013_filtered = [complex for _, complex in test_set if complex in casf2013_set]
+casf2016_filtered = [complex for _, complex in test_set if complex in casf2016_set]
 
 
 print("Removing train-test similarites from")
@@ -91,81 +97,70 @@ print(f"Input CASF2013: N={len(casf2013_filtered)}")
 print(f"Input CASF2016: N={len(casf2016_filtered)}")
 print()
 
-# Iterate over the test complexes and look for similar training complexes
-for test_idx, test_complex in test_set:
+# Load the rows of all test complexes from the pairwise similarity matrices (test complexes x all complexes)
+test_indices = np.array([idx for idx, _ in test_set], dtype=np.int64)
+with SimilarityMatrix(PSM_tanimoto_file) as matrix: tanimoto = matrix.rows(test_indices)
+with SimilarityMatrix(PSM_tm_scores_file) as matrix: tm_scores = matrix.rows(test_indices)
+with SimilarityMatrix(PSM_rmsd_file) as matrix: rmsds = matrix.rows(test_indices)
+
+# Affinity differences between the test complexes and all complexes
+labels = np.array([affinity_data[complex]['log_kd_ki'] for complex in complexes])
+dpK = np.abs(labels[None, :] - labels[test_indices][:, None])
+
+# Find training complexes that fulfill the following conditions:
+# - have TM-score higher than 0.8 to the test complex
+# - Tanimoto similarity and ligand positioning RMSD compared to the test complex fulfill:
+#   Tanimoto + (1 - RMSD) > 0.8
+# - the absolute difference of the affinity values is lower than 1
+mask1 = (tanimoto > tanimoto_threshold) | ((tm_scores > TM_threshold) & (tanimoto + (1 - rmsds) > S_threshold))
+mask2 = (train_or_test == 1)
+mask = mask1 & mask2[None, :] & (dpK < label_threshold)
+
+# Similarities of the whole complex (otherwise only the ligands are similar)
+complex_similarity = (tm_scores > 0.8) & (tanimoto + (1 - rmsds) > 0.8)
+
+# A training complex is removed (and logged) at the first test complex it is similar to
+removed = mask.any(axis=0)
+first_match = np.argmax(mask, axis=0)
+
+# Test complexes with similar training complexes
+leaking_test_complexes = set()
+
+# Iterate over the test complexes and log the similar training complexes
+for t, (test_idx, test_complex) in enumerate(test_set):
 
     # Check if the test complex is in casf2013 or casf2016 or both
     membership = ""
-    if in_casf2013 := test_complex in casf2013:
+    if in_casf2013 := test_complex in casf2013_set:
         membership = membership + 'casf2013 '
-    if in_casf2016 := test_complex in casf2016:
+    if in_casf2016 := test_complex in casf2016_set:
         membership = membership + 'casf2016'
 
     test_complex_affinity = affinity_data[test_complex]['log_kd_ki']
     
     print(f"Processing {test_complex} with pK {test_complex_affinity} belonging to {membership}")
 
-    # Find training complexes that fulfill the following conditions:
-    # - have TM-score higher than 0.8 to the test complex
-    # - Tanimoto similarity and ligand positioning RMSD compared to the test complex fulfill:
-    #   Tanimoto + (1 - RMSD) > 0.8
-
-    # Load the pairwise similarity data
-    with h5py.File(PSM_tanimoto_file, 'r') as f:
-        tanimoto = f['similarities'][test_idx, :]
-
-    with h5py.File(PSM_tm_scores_file, 'r') as f:
-        tm_scores = f['similarities'][test_idx, :]
-
-    with h5py.File(PSM_rmsd_file, 'r') as f:
-        rmsds = f['similarities'][test_idx, :]
+    # Get the indexes and names of the complexes that satisfy the conditions
+    similar_complexes_idx = mask[t].nonzero()[0]
+    similarities = [complexes[idx] for idx in similar_complexes_idx[complex_similarity[t, similar_complexes_idx]]]
 
+    for idx in similar_complexes_idx[first_match[similar_complexes_idx] == t]:
 
-    # Filter the training complexes that fulfill the conditions
-    mask1 = (tanimoto > tanimoto_threshold) | ((tm_scores > TM_threshold) & (tanimoto + (1 - rmsds) > S_threshold))
-    mask2 = (train_or_test == 1)
-    mask = mask1 & mask2
-    
-    # Get the indexes and names of the complexes that satisfy the conditions
-    similar_complexes_idx = mask.nonzero()[0]
-    similar_complexes_names = [complexes[idx] for idx in similar_complexes_idx]
-
-
-    similarities = []
-    for complex, idx in zip(similar_complexes_names, similar_complexes_idx):
-        
-        # Check the difference between the affinity_values
-        # If the absolute difference is lower than 1, remove the training complex
-        dpK = np.abs(affinity_data[complex]['log_kd_ki'] - test_complex_affinity)
-        if dpK < label_threshold:
-
-            if (tm_scores[idx] > 0.8) & (tanimoto[idx] + (1 - rmsds[idx]) > 0.8):
-                reason = "COMPL SIMILARITY"
-                similarities.append(complex)
-            else:
-                reason = "LIGND SIMILARITY"
-
-            if complex in training_set_filtered:
-                training_set_filtered.remove(complex)
-
-                log_string = ('--- '
-                    f'Complex {complex} removed due to {reason}- '
-                    f'Tanimoto {tanimoto[idx]:.2f} '
-                    f'TMscore {tm_scores[idx]:.2f} '
-                    f'Ligand RMSD {rmsds[idx]:.2f} '
-                    f'dpK {dpK:.2f} '
-                    f'S = {tanimoto[idx] + (1 - rmsds[idx]) + tm_scores[idx] - dpK:.2f} '
-                    f'to complex {test_complex} ({membership})'
-                )
-                print(log_string)
+        reason = "COMPL SIMILARITY" if complex_similarity[t, idx] else "LIGND SIMILARITY"
+        log_string = ('--- '
+            f'Complex {complexes[idx]} removed due to {reason}- '
+            f'Tanimoto {tanimoto[t, idx]:.2f} '
+            f'TMscore {tm_scores[t, idx]:.2f} '
+            f'Ligand RMSD {rmsds[t, idx]:.2f} '
+            f'dpK {dpK[t, idx]:.2f} '
+            f'S = {tanimoto[t, idx] + (1 - rmsds[t, idx]) + tm_scores[t, idx] - dpK[t, idx]:.2f} '
+            f'to complex {test_complex} ({membership})'
+        )
+        print(log_string)
 
 
     # If similarites were found, remove the test complex from casf_filtered
-    if len(similarities) > 0: 
-        if test_complex in casf2013_filtered:
-            casf2013_filtered.remove(test_complex)
-        if test_complex in casf2016_filtered:
-            casf2016_filtered.remove(test_complex)
+    if len(similarities) > 0: leaking_test_complexes.add(test_complex)
 
     if in_casf2013:
         train_test_sims_casf2013[test_complex] = similarities
@@ -175,6 +170,12 @@ for test_idx, test_complex in test_set:
         train_test_sims_casf2016_n[test_complex] = len(similarities)
 
 
+# Update the filtered datasets
+training_set_filtered = [complex for idx, complex in train_set if not removed[idx]]
+casf2013_filtered = [complex for complex in casf2013_filtered if complex not in leaking_test_complexes]
+casf2016_filtered = [complex for complex in casf2016_filtered if complex not in leaking_test_complexes]
+
+
 print()
 print(f"Output Training Dataset: N={len(training_set_filtered)}")
 print(f"Output casf2013_indep: N={len(casf2013_filtered)}")
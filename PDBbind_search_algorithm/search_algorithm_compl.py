@@ -1,10 +1,13 @@
-import h5py
+import sys
 import numpy as np
 import os
 import json
 import torch
 import matplotlib.pyplot as plt
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.similarity_matrix import SimilarityMatrix
+
 
 class RMSELoss(torch.nn.Module):
     def __init__(self):
@@ -71,6 +74,11 @@ train_or_not = np.array([1 if complex in train_dataset else 0 for complex in com
 true_labels = [affinity_data[complex]['log_kd_ki'] for complex in test_complexes]
 predicted_labels = {}
 
+# Open the pairwise similarity matrices once, the rows of the test complexes are read in the loop
+tanimoto_matrix = SimilarityMatrix(PSM_tanimoto_file)
+tm_scores_matrix = SimilarityMatrix(PSM_tm_scores_file)
+rmsd_matrix = SimilarityMatrix(PSM_rmsd_file)
+
 for complex in test_complexes:
     print()
     print(f"Finding similar training complexes for {complex}")
@@ -78,14 +86,9 @@ for complex in test_complexes:
 
 
     # Load the pairwise similarity data
-    with h5py.File(PSM_tanimoto_file, 'r') as f:
-        tanimoto = f['similarities'][complex_idx, :]
-
-    with h5py.File(PSM_tm_scores_file, 'r') as f:
-        tm_scores = f['similarities'][complex_idx, :]
-
-    with h5py.File(PSM_rmsd_file, 'r') as f:
-        rmsds = f['similarities'][complex_idx, :]
+    tanimoto = tanimoto_matrix.row(complex_idx)
+    tm_scores = tm_scores_matrix.row(complex_idx)
+    rmsds = rmsd_matrix.row(complex_idx)
 
     # Calculate similarity scores
     similarity_scores = tanimoto + tm_scores# - rmsds # RMSD distorts the selection when no similar complexes are found
@@ -1,10 +1,13 @@
-import h5py
+import sys
 import numpy as np
 import os
 import json
 import torch
 import matplotlib.pyplot as plt
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.similarity_matrix import SimilarityMatrix
+
 
 class RMSELoss(torch.nn.Module):
     def __init__(self):
@@ -71,6 +74,9 @@ train_or_not = np.array([1 if complex in train_dataset else 0 for complex in com
 true_labels = [affinity_data[complex]['log_kd_ki'] for complex in test_complexes]
 predicted_labels = {}
 
+# Open the pairwise similarity matrices once, the rows of the test complexes are read in the loop
+tanimoto_matrix = SimilarityMatrix(PSM_tanimoto_file)
+
 for complex in test_complexes:
     print()
     print(f"Finding similar training complexes for {complex}")
@@ -78,8 +84,7 @@ for complex in test_complexes:
 
 
     # Load the pairwise similarity data
-    with h5py.File(PSM_tanimoto_file, 'r') as f:
-        similarity_scores = f['similarities'][complex_idx, :]
+    similarity_scores = tanimoto_matrix.row(complex_idx)
     # Calculate similarity scores (Tanimoto)
     similarity_scores[complex_idx] = -np.inf # Set the metrics of the complex itself to small number
     similarity_scores[train_or_not == 0] = -np.inf # Set the metrics of all complexes not in the training dataset to small number
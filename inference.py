@@ -7,7 +7,9 @@ import torch
 import matplotlib.pyplot as plt
 import numpy as np
 from torch_geometric.loader import DataLoader
+from Dataset import PDBbind_GraphStream
 from model.GATE18 import *
+from model.ensemble import GATE18Ensemble
 
 
 class RMSELoss(torch.nn.Module):
@@ -23,11 +25,27 @@ def load_model_state(model, state_dict_path, device):
         model.load_state_dict(torch.load(state_dict_path, map_location=torch.device('cpu')))
     else:
         model.load_state_dict(torch.load(state_dict_path))
-        model.eval()  # Set the model to evaluation mode
+    model.eval()  # Set the model to evaluation mode
     return model
 
 
 
+def ensemble_forward(models, graphbatch):
+    # The graph bookkeeping of the batch is prepared once and shared by all members
+    prepared = PreparedBatch.from_batch(graphbatch)
+
+    # Fused ensemble: all members are evaluated in a single pass over the batch
+    if isinstance(models, GATE18Ensemble):
+        output, _ = models(graphbatch, prepared)
+        return output
+
+    outputs = []
+    for model in models: 
+        outputs.append(model(graphbatch, prepared).view(-1))
+    return torch.mean(torch.stack(outputs), dim=0)
+
+
+
 # Evaluation Function
 #-------------------------------------------------------------------------------------------------------------------------------
 def evaluate(models, loader, criterion, device, labels):
@@ -45,10 +63,7 @@ def evaluate(models, loader, criterion, device, labels):
             targets = graphbatch.y
 
             # Forward pass ENSEMBLE MODEL
-            outputs = []
-            for model in models: 
-                outputs.append(model(graphbatch).view(-1))
-            output = torch.mean(torch.stack(outputs), dim=0)    
+            output = ensemble_forward(models, graphbatch)
             loss = criterion(output, targets)
 
             # Accumulate loss and collect the true and predicted values for later use
@@ -83,7 +98,73 @@ def evaluate(models, loader, criterion, device, labels):
         true_labels_unscaled = torch.tensor(y_true)
         predictions_unscaled = torch.tensor(y_pred) * (max - min) + min
         return true_labels_unscaled, predictions_unscaled, id
+
+
+
+# Streaming Evaluation Function
 #-------------------------------------------------------------------------------------------------------------------------------
+def evaluate_stream(models, stream, criterion, device, labels, writer, file):
+
+    # Predictions are written to the CSV batch by batch, only the (unscaled) labels and predictions are kept in memory
+    total_loss = 0.0
+    n_batches = 0
+    y_true = []
+    y_pred = []
+    id = []
+
+    min=0
+    max=16
+    with torch.no_grad():
+        for graphbatch in stream:
+            graphbatch.to(device)
+            targets = graphbatch.y
+
+            # Forward pass ENSEMBLE MODEL
+            output = ensemble_forward(models, graphbatch)
+            total_loss += criterion(output, targets).item()
+            n_batches += 1
+
+            batch_true = targets * (max - min) + min if labels else targets
+            batch_pred = output * (max - min) + min
+            writer.writerows(zip(graphbatch.id, batch_true.tolist(), batch_pred.tolist()))
+            file.flush()
+
+            y_true.extend(batch_true.tolist())
+            y_pred.extend(batch_pred.tolist())
+            id.extend(graphbatch.id)
+
+    true_labels_unscaled = torch.tensor(y_true)
+    predictions_unscaled = torch.tensor(y_pred)
+
+    if labels:
+        eval_loss = total_loss / n_batches
+        r = np.corrcoef(y_true, y_pred)[0, 1]
+        r2_score = 1 - np.sum((np.array(y_true) - np.array(y_pred)) ** 2) / np.sum((np.array(y_true) - np.mean(np.array(y_true))) ** 2)
+        rmse = criterion(predictions_unscaled, true_labels_unscaled)
+        return eval_loss, r, rmse, r2_score, true_labels_unscaled, predictions_unscaled, id
+
+    else:
+        return true_labels_unscaled, predictions_unscaled, id
+#-------------------------------------------------------------------------------------------------------------------------------
+
+
+# Quantization Report
+#-------------------------------------------------------------------------------------------------------------------------
+def quantization_report(quantized_metrics, reference_metrics, labels):
+    # Match the predictions by id, the test loader is shuffled
+    *_, y_pred_q, ids_q = quantized_metrics
+    *_, y_pred_ref, ids_ref = reference_metrics
+    reference = dict(zip(ids_ref, y_pred_ref.tolist()))
+    delta = np.abs(np.array(y_pred_q.tolist()) - np.array([reference[id] for id in ids_q]))
+
+    print(f"Quantization Report (int8 vs float32, {len(delta)} complexes):")
+    print(f"Prediction delta (pK): max {delta.max():.4f}, mean {delta.mean():.4f}, 95th percentile {np.percentile(delta, 95):.4f}")
+    if labels:
+        _, r_q, rmse_q, r2_q, *_ = quantized_metrics
+        _, r_ref, rmse_ref, r2_ref, *_ = reference_metrics
+        print(f"float32: R = {r_ref:.4f}, RMSE = {rmse_ref:.4f}, R2 = {r2_ref:.4f}")
+        print(f"int8:    R = {r_q:.4f}, RMSE = {rmse_q:.4f}, R2 = {r2_q:.4f}")
+#-------------------------------------------------------------------------------------------------------------------------
 
 
 # Plotting Functions
@@ -120,23 +201,63 @@ def plot_predictions(ax, y_true, y_pred, title, label):
 def parse_args():
     parser = argparse.ArgumentParser(description="Testing Parameters and Input Dataset Control")
 
-    # Model Parameters
-    parser.add_argument("--dataset_path", required=True, help="The path to the test dataset pt file")
+    # Input: Either a dataset pt file or a directory of graph.pth files that is streamed
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dataset_path", help="The path to the test dataset pt file")
+    source.add_argument("--data_dir", help="The path to a folder of graph.pth files that should be streamed without building a dataset pt file")
+
+    # Streaming Parameters (only used with --data_dir)
+    parser.add_argument('--protein_embeddings', nargs='+', default=['ankh_base', 'esm2_t6'], help='Protein embeddings that should be incorporated into the streamed graphs')
+    parser.add_argument('--ligand_embeddings', nargs='+', default=['ChemBERTa_77M'], help='Ligand embeddings that should be incorporated into the streamed graphs')
+    parser.add_argument("--data_dict", default=None, help="Path to dictionary containing the affinity labels of the streamed complexes as dict[complex_id] = {'log_kd_ki': affinity}")
+    parser.add_argument("--delete_protein", default=False, type=lambda x: x.lower() in ['true', '1', 'yes'], help="If protein nodes should be deleted from the streamed graphs (ablation)")
+    parser.add_argument("--batch_size", default=128, type=int, help="The number of graphs per batch in streaming mode")
+    parser.add_argument("--queue_size", default=1024, type=int, help="The maximal number of processed graphs held in memory in streaming mode")
+    parser.add_argument("--num_workers", default=2, type=int, help="The number of threads loading and processing graphs in streaming mode")
+
+    # Ensemble evaluation
+    parser.add_argument("--fused_ensemble", default=torch.cuda.is_available(), type=lambda x: x.lower() in ['true', '1', 'yes'], help="If all ensemble members should be evaluated in a single fused forward pass (default: True on GPU, False on CPU)")
+    parser.add_argument("--quantize", default=False, type=lambda x: x.lower() in ['true', '1', 'yes'], help="If dynamic int8 quantization should be applied to the linear layers (CPU only, BatchNorm layers folded). With --dataset_path, the predictions are compared to the float32 models")
+    parser.add_argument("--compile", default=False, type=lambda x: x.lower() in ['true', '1', 'yes'], help="If the models should be compiled with torch.compile before inference (recommended for large screening runs, the first batch includes the compilation time)")
     return parser.parse_args()
 
 args = parse_args()
 dataset_path = args.dataset_path
+streaming = args.data_dir is not None
+
+
+if streaming:
+    # Stream the graphs from the data directory, applying the dataset transformations on the fly
+    print(f"Streaming graphs from {args.data_dir}")
+    dataset = PDBbind_GraphStream(args.data_dir,
+                                  protein_embeddings=args.protein_embeddings,
+                                  ligand_embeddings=args.ligand_embeddings,
+                                  data_dict=args.data_dict,
+                                  delete_protein=args.delete_protein,
+                                  batch_size=args.batch_size,
+                                  queue_size=args.queue_size,
+                                  num_workers=args.num_workers)
+    if len(dataset.filepaths) == 0:
+        print(f"Aborted: No graph.pth files found in {args.data_dir}")
+        sys.exit(1)
+    example_graph = dataset.load(dataset.filepaths[0])
+    node_feat_dim = example_graph.x.shape[1]
+    edge_feat_dim = example_graph.edge_attr.shape[1]
+    labels = dataset.labels
+    output_path = os.path.normpath(args.data_dir)
 
+else:
+    # Load the dataset
+    print(f"Loading dataset from {dataset_path}")
+    dataset = torch.load(dataset_path)
+    node_feat_dim = dataset[0].x.shape[1]
+    edge_feat_dim = dataset[0].edge_attr.shape[1]
+    print(f"Dataset Loaded with {len(dataset)} samples")
 
-# Load the dataset
-print(f"Loading dataset from {dataset_path}")
-dataset = torch.load(dataset_path)
-node_feat_dim = dataset[0].x.shape[1]
-edge_feat_dim = dataset[0].edge_attr.shape[1]
-print(f"Dataset Loaded with {len(dataset)} samples")
+    # Check if the dataset has labels
+    labels = dataset[0].y > 0
+    output_path = dataset_path.split(".")[0]
 
-# Check if the dataset has labels
-labels = dataset[0].y > 0
 print(f"Dataset has labels: {labels}")
 
 
@@ -157,7 +278,7 @@ ligand_embeddings = dataset.ligand_embeddings
 print(f"Protein Embeddings: {protein_embeddings}")
 print(f"Ligand Embeddings: {ligand_embeddings}")
 
-dataset_id = os.path.basename(dataset_path)[0:6]
+dataset_id = os.path.basename(dataset_path)[0:6] if not streaming else None
 
 # Check if ablation is enabled
 try: ablation = dataset.delete_protein
@@ -203,16 +324,17 @@ for pattern in stdict_paths_patterns:
 
 
 
-print(f"Running Inference with {dataset_path} using model {model_arch}")
+print(f"Running Inference with {args.data_dir if streaming else dataset_path} using model {model_arch}")
 print(f"Model State Dict Paths:")
 for path in stdict_paths: print(path)
 
 # Loaders
-test_loader = DataLoader(dataset = dataset, batch_size=128, shuffle=True, num_workers=4, persistent_workers=True)
-print("Data Loader Created")
+if not streaming:
+    test_loader = DataLoader(dataset = dataset, batch_size=128, shuffle=True, num_workers=4, persistent_workers=True)
+    print("Data Loader Created")
 
 # Device Selection
-device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+device = torch.device('cuda:0' if torch.cuda.is_available() and not args.quantize else 'cpu')
 print(f"Device: {device}")
 
 # Ensemble Model
@@ -230,8 +352,31 @@ models = [model_class(
 model_paths = list(stdict_paths)
 models = [load_model_state(model, path, device) for model, path in zip(models, model_paths)]
 
+# Dynamic int8 quantization (CPU only), the float32 models are kept as a reference
+if args.quantize:
+    reference_models = models
+    models = [quantize_model(model) for model in models]
+    print("Dynamic int8 quantization applied, BatchNorm layers folded")
+
+if args.fused_ensemble and not args.quantize: models = GATE18Ensemble(models).to(device)
+if args.compile: 
+    if isinstance(models, GATE18Ensemble): models = compile_model(models)
+    else: models = [compile_model(model) for model in models]
+
 # Run inference
-test_metrics = evaluate(models, test_loader, criterion, device, labels)
+if streaming:
+    # Write the predictions incrementally to the CSV file while the graphs are streamed
+    with open(f'{output_path}_predictions.csv', mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['id', 'y_true', 'y_pred'])  # Write the header
+        test_metrics = evaluate_stream(models, dataset, criterion, device, labels, writer, file)
+else:
+    test_metrics = evaluate(models, test_loader, criterion, device, labels)
+
+# Compare the quantized predictions to the float32 predictions
+if args.quantize:
+    if streaming: print("Quantization report skipped in streaming mode, run on a labeled dataset with --dataset_path to compare against float32")
+    else: quantization_report(test_metrics, evaluate(reference_models, test_loader, criterion, device, labels), labels)
 
 
 
@@ -246,20 +391,21 @@ if labels:
     loss, r, rmse, r2, y_true, y_pred, ids = test_metrics
     plot_predictions(ax1, y_true, y_pred, f"Predictions Inference\nR = {r:.3f}, RMSE = {rmse:.3f}", "Inference Predictions")
 
-    # Save the y_true and y_pred in a single CSV file using the csv module
-    with open(f'{dataset_path.split(".")[0]}_predictions.csv', mode='w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(['id', 'y_true', 'y_pred'])  # Write the header
-        writer.writerows(sorted(zip(ids, y_true.tolist(), y_pred.tolist()), key=lambda x: x[0]))  # Write the data
+    # Save the y_true and y_pred in a single CSV file using the csv module (already written in streaming mode)
+    if not streaming:
+        with open(f'{output_path}_predictions.csv', mode='w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(['id', 'y_true', 'y_pred'])  # Write the header
+            writer.writerows(sorted(zip(ids, y_true.tolist(), y_pred.tolist()), key=lambda x: x[0]))  # Write the data
 
     plt.tight_layout()
-    plt.savefig(f'{dataset_path.split(".")[0]}_predictions.png', dpi=300)
+    plt.savefig(f'{output_path}_predictions.png', dpi=300)
 
-else:
+elif not streaming:
     y_true, y_pred, ids = test_metrics
 
     # Save the sorted y_true and y_pred in a single CSV file using the csv module
-    with open(f'{dataset_path.split(".")[0]}_predictions.csv', mode='w', newline='') as file:
+    with open(f'{output_path}_predictions.csv', mode='w', newline='') as file:
         writer = csv.writer(file)
         writer.writerow(['id', 'y_true', 'y_pred'])  # Write the header
         writer.writerows(sorted(zip(ids, y_true.tolist(), y_pred.tolist()), key=lambda x: x[0]))  # Write the sorted data
@@ -1,3 +1,4 @@
+import copy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -31,6 +32,53 @@ GATE18b: Global feature is 384 and node feature dim is reduced
 dropout and conv_dropout are possible
 '''
 
+
+class PreparedBatch:
+    '''
+    Graph bookkeeping of a batch that does not depend on the model parameters. It is built once per batch and shared by 
+    both MetaLayers and by all models that are evaluated on the same batch (e.g. the members of an ensemble).
+
+    - edge_index, the batch vector and the batch vector of the source node of each edge (for the MetaLayers)
+    - edge_index of the GATv2Conv layers, with existing self loops removed and a self loop appended for every node
+    - mask of the edges that are kept in the GATv2Conv edge_index and the in-degree of the nodes over these edges, 
+      used to fill the features of the self loops with the mean of the incoming edge features (fill_value='mean')
+    '''
+    def __init__(self, edge_index, batch, num_graphs):
+        self.edge_index = edge_index
+        self.row, self.col = edge_index[0], edge_index[1]
+        self.batch = batch
+        self.edge_batch = batch[self.row]
+        self.num_graphs = num_graphs
+        self.num_nodes = batch.size(0)
+
+        nodes = torch.arange(self.num_nodes, device=edge_index.device)
+        self.loop_mask = self.row != self.col
+        self.loop_dest = self.col[self.loop_mask]
+        self.conv_edge_index = torch.cat([edge_index[:, self.loop_mask], torch.stack([nodes, nodes])], dim=1)
+        self.deg = torch.bincount(self.loop_dest, minlength=self.num_nodes).clamp(min=1)
+
+    @classmethod
+    def from_batch(cls, graphbatch):
+        return cls(graphbatch.edge_index, graphbatch.batch, graphbatch.num_graphs)
+
+    def self_loop_attr(self, edge_attr):
+        # Drop the features of existing self loops and append the mean incoming edge features for the new self loops
+        edge_attr = edge_attr[self.loop_mask]
+        loop_attr = edge_attr.new_zeros(self.num_nodes, edge_attr.size(1)).index_add_(0, self.loop_dest, edge_attr)
+        return torch.cat([edge_attr, loop_attr / self.deg.view(-1, 1)], dim=0)
+
+
+class PreparedMetaLayer(geom_nn.MetaLayer):
+    '''
+    MetaLayer that takes the graph bookkeeping from a PreparedBatch instead of recomputing it in every call
+    '''
+    def forward(self, x, edge_attr, u, prepared):
+        edge_attr = self.edge_model(x[prepared.row], x[prepared.col], edge_attr, u, prepared.edge_batch)
+        x = self.node_model(x, prepared.edge_index, edge_attr, u, prepared.batch, prepared=prepared)
+        u = self.global_model(x, prepared.edge_index, edge_attr, u, prepared.batch, num_graphs=prepared.num_graphs)
+        return x, edge_attr, u
+
+
 class FeatureTransformMLP(nn.Module):
     def __init__(self, node_feature_dim, hidden_dim, out_dim, dropout):
         super(FeatureTransformMLP, self).__init__()
@@ -71,10 +119,12 @@ class NodeModel(torch.nn.Module):
         self.residuals = residuals
         self.heads = 4
 
-        self.conv = GATv2Conv(n_node_f, int(out_dim/self.heads), edge_dim=n_edge_f, heads=self.heads, dropout=dropout)
+        # Self loops are added from the PreparedBatch (equivalent to add_self_loops=True with fill_value='mean')
+        self.conv = GATv2Conv(n_node_f, int(out_dim/self.heads), edge_dim=n_edge_f, heads=self.heads, dropout=dropout, add_self_loops=False)
 
-    def forward(self, x, edge_index, edge_attr, u, batch):
-        out = F.relu(self.conv(x, edge_index, edge_attr))
+    def forward(self, x, edge_index, edge_attr, u, batch, prepared=None):
+        if prepared is None: prepared = PreparedBatch(edge_index, batch, None)
+        out = F.relu(self.conv(x, prepared.conv_edge_index, prepared.self_loop_attr(edge_attr)))
         if self.residuals:
             out = out + x
         return out
@@ -89,8 +139,9 @@ class GlobalModel(torch.nn.Module):
             nn.ReLU(), 
             nn.Linear(glob_f_hidden, glob_f_out))
 
-    def forward(self, x, edge_index, edge_attr, u, batch):
-        out = torch.cat([u, global_add_pool(x, batch=batch)], dim=1)
+    def forward(self, x, edge_index, edge_attr, u, batch, num_graphs=None):
+        # Node features are summed in float32, also under mixed precision
+        out = torch.cat([u, global_add_pool(x.float(), batch=batch, size=num_graphs)], dim=1)
         out = self.dropout_layer(out)
         return self.global_mlp(out)
 
@@ -129,23 +180,24 @@ class GATE18d(nn.Module):
                     edge_f, edge_f_hidden, edge_f_out,
                     glob_f, glob_f_hidden, glob_f_out,
                     residuals, dropout):
-        return geom_nn.MetaLayer(
+        return PreparedMetaLayer(
             edge_model=EdgeModel(node_f, edge_f, edge_f_hidden, edge_f_out, residuals=residuals, dropout=dropout),
             node_model=NodeModel(node_f, edge_f_out, node_f_hidden, node_f_out, residuals=residuals, dropout=dropout),
             global_model=GlobalModel(node_f_out, glob_f, glob_f_hidden, glob_f_out, dropout=dropout)
         )
 
-    def forward(self, graphbatch):
-        edge_index = graphbatch.edge_index
+    def forward(self, graphbatch, prepared=None):
+        # The PreparedBatch can be shared between models that are evaluated on the same batch
+        if prepared is None: prepared = PreparedBatch.from_batch(graphbatch)
         
         x = self.NodeTransform(graphbatch.x)
 
-        x, edge_attr, u = self.layer1(x, edge_index, graphbatch.edge_attr, u=graphbatch.lig_emb, batch=graphbatch.batch)
+        x, edge_attr, u = self.layer1(x, graphbatch.edge_attr, graphbatch.lig_emb, prepared)
         x = self.node_bn1(x)
         edge_attr = self.edge_bn1(edge_attr)
         u = self.u_bn1(u)
 
-        _, _, u = self.layer2(x, edge_index, edge_attr, u, batch=graphbatch.batch)
+        _, _, u = self.layer2(x, edge_attr, u, prepared)
         u = self.dropout_layer(u)
 
         # Fully-Connected Layers
@@ -187,28 +239,93 @@ class GATE18e(nn.Module):
                     edge_f, edge_f_hidden, edge_f_out,
                     glob_f, glob_f_hidden, glob_f_out,
                     residuals, dropout):
-        return geom_nn.MetaLayer(
+        return PreparedMetaLayer(
             edge_model=EdgeModel(node_f, edge_f, edge_f_hidden, edge_f_out, residuals=residuals, dropout=dropout),
             node_model=NodeModel(node_f, edge_f_out, node_f_hidden, node_f_out, residuals=residuals, dropout=dropout),
             global_model=GlobalModel(node_f_out, glob_f, glob_f_hidden, glob_f_out, dropout=dropout)
         )
 
-    def forward(self, graphbatch):
-        edge_index = graphbatch.edge_index
+    def forward(self, graphbatch, prepared=None):
+        # The PreparedBatch can be shared between models that are evaluated on the same batch
+        if prepared is None: prepared = PreparedBatch.from_batch(graphbatch)
         
         x = self.NodeTransform(graphbatch.x)
         u = torch.zeros((graphbatch.num_graphs, 384)).to(x.device)
 
-        x, edge_attr, u = self.layer1(x, edge_index, graphbatch.edge_attr, u=u, batch=graphbatch.batch)
+        x, edge_attr, u = self.layer1(x, graphbatch.edge_attr, u, prepared)
         x = self.node_bn1(x)
         edge_attr = self.edge_bn1(edge_attr)
         u = self.u_bn1(u)
 
-        _, _, u = self.layer2(x, edge_index, edge_attr, u, batch=graphbatch.batch)
+        _, _, u = self.layer2(x, edge_attr, u, prepared)
         u = self.dropout_layer(u)
 
         # Fully-Connected Layers
         out = self.fc1(u)
         out = F.relu(out)
         out = self.fc2(out)
-        return out
\ No newline at end of file
+        return out
+
+
+def compile_model(model):
+    '''
+    Deployment path: compiles the forward pass of a GATE18 model (or of a GATE18Ensemble) with torch.compile.
+    The graphs of a batch vary in size, so dynamic shapes are used to avoid recompiling for every batch. The forward 
+    method is replaced in place, so the model keeps its class and its state dict keys. The first batch triggers the 
+    compilation and is slow, the compiled kernels are cached by torch for later runs.
+    '''
+    model.forward = torch.compile(model.forward, dynamic=True)
+    return model
+
+
+
+def fold_batchnorm(model):
+    '''
+    Folds the BatchNorm1d layers between the two MetaLayers of a GATE18 model (in eval mode, running statistics) into 
+    linear layers and replaces them with identities.
+    - u_bn1 directly follows the last linear layer of the first GlobalModel and is folded into it
+    - node_bn1 and edge_bn1 normalize features that are also used unnormalized within the first MetaLayer, so they are 
+      folded into the linear layers of the second MetaLayer that consume them (EdgeModel input, GATv2Conv lin_l/lin_r)
+    '''
+    def affine(bn):
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        return scale, bn.bias - bn.running_mean * scale
+
+    def fold_into_input(linear, scale, shift, start):
+        # W (scale * x + shift) + b = (W * scale) x + (W shift + b) on the input columns [start, start + len(scale))
+        weight = linear.weight[:, start:start + scale.size(0)]
+        linear.bias.add_(weight @ shift)
+        weight.mul_(scale)
+
+    with torch.no_grad():
+        scale, shift = affine(model.u_bn1)
+        linear = model.layer1.global_model.global_mlp[2]
+        linear.bias.mul_(scale).add_(shift)
+        linear.weight.mul_(scale.view(-1, 1))
+
+        node_scale, node_shift = affine(model.node_bn1)
+        edge_scale, edge_shift = affine(model.edge_bn1)
+        n_node_f = node_scale.size(0)
+
+        edge_linear = model.layer2.edge_model.edge_mlp[0] # input is cat([src, dest, edge_attr])
+        fold_into_input(edge_linear, node_scale, node_shift, 0)
+        fold_into_input(edge_linear, node_scale, node_shift, n_node_f)
+        fold_into_input(edge_linear, edge_scale, edge_shift, 2 * n_node_f)
+        fold_into_input(model.layer2.node_model.conv.lin_l, node_scale, node_shift, 0)
+        fold_into_input(model.layer2.node_model.conv.lin_r, node_scale, node_shift, 0)
+
+    model.node_bn1 = nn.Identity()
+    model.edge_bn1 = nn.Identity()
+    model.u_bn1 = nn.Identity()
+    return model
+
+
+
+def quantize_model(model):
+    '''
+    CPU inference path: returns a copy of a GATE18 model (in eval mode) with the BatchNorm layers folded and dynamic int8 
+    quantization applied to the nn.Linear layers (NodeTransform, EdgeModel, GlobalModel, fc1, fc2). The GATv2Conv layers 
+    remain in float32. The accuracy should be checked against the float32 model before the quantized model is used.
+    '''
+    model = fold_batchnorm(copy.deepcopy(model).cpu().eval())
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
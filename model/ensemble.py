@@ -0,0 +1,181 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from model.GATE18 import PreparedBatch
+
+
+'''
+GATE18 ENSEMBLE
+Fused inference engine for an ensemble of GATE18d or GATE18e models (e.g. the five models of the cross-validation folds)
+
+- The state dicts of all members are stacked along a leading member dimension E
+- Every layer is evaluated for all members at once with batched matrix multiplications, so that each graph batch
+  is traversed a single time instead of once per member
+- The graph bookkeeping (self loops of the GATv2Conv layers, softmax groups, pooling) is taken from a PreparedBatch
+  that is computed once per batch
+- The concatenations of the EdgeModel and GlobalModel are replaced by splitting the weight matrices, so that the
+  node-level projections are computed once per node instead of once per edge
+
+The forward pass reproduces GATE18d/GATE18e in eval mode (BatchNorm with running statistics, no dropout) and returns
+the ensemble mean and the predictions of the individual members. It is meant for inference only.
+'''
+
+
+def stacked_linear(x, weight, bias=None):
+    # x: [E, N, in] or [N, in] (shared by all members), weight: [E, in, out], bias: [E, 1, out] -> [E, N, out]
+    if x.dim() == 2:
+        # Shared input: a single matrix multiplication with the weights of all members side by side
+        E, n_in, n_out = weight.shape
+        out = torch.mm(x, weight.transpose(0, 1).reshape(n_in, E * n_out)).view(-1, E, n_out).transpose(0, 1)
+        return out.contiguous() if bias is None else out + bias
+    if bias is None:
+        return torch.bmm(x, weight)
+    return torch.baddbmm(bias, x, weight)
+
+
+
+class StackedMetaLayer(nn.Module):
+    def __init__(self, layers):
+        super(StackedMetaLayer, self).__init__()
+
+        def stack(get):
+            return torch.stack([get(layer).detach() for layer in layers])
+
+        # EdgeModel: edge_mlp(cat([x_src, x_dest, edge_attr])), first weight matrix split into the three parts
+        n_node_f = layers[0].node_model.conv.in_channels
+        w0 = stack(lambda l: l.edge_model.edge_mlp[0].weight).transpose(1, 2)
+        self.register_buffer('edge_w_src', w0[:, :n_node_f].contiguous())
+        self.register_buffer('edge_w_dest', w0[:, n_node_f:2*n_node_f].contiguous())
+        self.register_buffer('edge_w_attr', w0[:, 2*n_node_f:].contiguous())
+        self.register_buffer('edge_b0', stack(lambda l: l.edge_model.edge_mlp[0].bias).unsqueeze(1))
+        self.register_buffer('edge_w2', stack(lambda l: l.edge_model.edge_mlp[2].weight).transpose(1, 2).contiguous())
+        self.register_buffer('edge_b2', stack(lambda l: l.edge_model.edge_mlp[2].bias).unsqueeze(1))
+
+        # NodeModel: GATv2Conv
+        conv = layers[0].node_model.conv
+        self.heads = conv.heads
+        self.out_channels = conv.out_channels
+        self.negative_slope = conv.negative_slope
+        self.register_buffer('lin_l_w', stack(lambda l: l.node_model.conv.lin_l.weight).transpose(1, 2).contiguous())
+        self.register_buffer('lin_l_b', stack(lambda l: l.node_model.conv.lin_l.bias).unsqueeze(1))
+        self.register_buffer('lin_r_w', stack(lambda l: l.node_model.conv.lin_r.weight).transpose(1, 2).contiguous())
+        self.register_buffer('lin_r_b', stack(lambda l: l.node_model.conv.lin_r.bias).unsqueeze(1))
+        self.register_buffer('lin_edge_w', stack(lambda l: l.node_model.conv.lin_edge.weight).transpose(1, 2).contiguous())
+        self.register_buffer('att', stack(lambda l: l.node_model.conv.att[0]))
+        self.register_buffer('conv_bias', stack(lambda l: l.node_model.conv.bias).unsqueeze(1))
+
+        # GlobalModel: global_mlp(cat([u, global_add_pool(x)])), first weight matrix split into the two parts
+        w0 = stack(lambda l: l.global_model.global_mlp[0].weight).transpose(1, 2)
+        n_glob_f = w0.shape[1] - conv.heads * conv.out_channels
+        self.register_buffer('glob_w_u', w0[:, :n_glob_f].contiguous())
+        self.register_buffer('glob_w_x', w0[:, n_glob_f:].contiguous())
+        self.register_buffer('glob_b0', stack(lambda l: l.global_model.global_mlp[0].bias).unsqueeze(1))
+        self.register_buffer('glob_w2', stack(lambda l: l.global_model.global_mlp[2].weight).transpose(1, 2).contiguous())
+        self.register_buffer('glob_b2', stack(lambda l: l.global_model.global_mlp[2].bias).unsqueeze(1))
+
+
+    def gatv2(self, x, edge_attr, prepared):
+        E, N = x.shape[0], x.shape[1]
+        H, C = self.heads, self.out_channels
+        src, dest = prepared.conv_edge_index[0], prepared.conv_edge_index[1]
+        kept, kept_dest, deg = prepared.loop_mask, prepared.loop_dest, prepared.deg.view(1, -1, 1)
+
+        x_l = stacked_linear(x, self.lin_l_w, self.lin_l_b).view(E, N, H, C)
+        x_r = stacked_linear(x, self.lin_r_w, self.lin_r_b).view(E, N, H, C)
+
+        # Remove existing self loops and add self loops with the mean of the incoming edge features (fill_value='mean')
+        edge_attr = edge_attr[:, kept]
+        loop_attr = edge_attr.new_zeros(E, N, edge_attr.shape[-1]).index_add_(1, kept_dest, edge_attr) / deg
+        edge_attr = torch.cat([edge_attr, loop_attr], dim=1)
+
+        # Attention coefficients
+        x_j = x_l.index_select(1, src)
+        alpha = stacked_linear(edge_attr, self.lin_edge_w).view(E, -1, H, C)
+        alpha += x_j
+        alpha += x_r.index_select(1, dest)
+        alpha = torch.einsum('enhc,ehc->enh', F.leaky_relu_(alpha, self.negative_slope), self.att)
+
+        # Softmax over the incoming edges of each node
+        index = dest.view(1, -1, 1).expand_as(alpha)
+        alpha_max = alpha.new_full((E, N, H), float('-inf')).scatter_reduce_(1, index, alpha, reduce='amax')
+        alpha = (alpha - alpha_max.index_select(1, dest)).exp_()
+        alpha_sum = alpha.new_zeros(E, N, H).index_add_(1, dest, alpha) + 1e-16
+        alpha = alpha / alpha_sum.index_select(1, dest)
+
+        out = x_l.new_zeros(E, N, H, C).index_add_(1, dest, x_j.mul_(alpha.unsqueeze(-1)))
+        return out.view(E, N, H * C) + self.conv_bias
+
+
+    def forward(self, x, edge_attr, u, prepared):
+        row, col, batch, num_graphs = prepared.row, prepared.col, prepared.batch, prepared.num_graphs
+
+        # EdgeModel
+        e = stacked_linear(edge_attr, self.edge_w_attr, self.edge_b0)
+        e += stacked_linear(x, self.edge_w_src).index_select(1, row)
+        e += stacked_linear(x, self.edge_w_dest).index_select(1, col)
+        edge_attr = stacked_linear(e.relu_(), self.edge_w2, self.edge_b2)
+
+        # NodeModel
+        x = F.relu(self.gatv2(x, edge_attr, prepared))
+
+        # GlobalModel (u is None for a zero-initialized global feature)
+        pooled = x.new_zeros(x.shape[0], num_graphs, x.shape[2]).index_add_(1, batch, x)
+        out = stacked_linear(pooled, self.glob_w_x, self.glob_b0)
+        if u is not None:
+            out = out + stacked_linear(u, self.glob_w_u)
+        u = stacked_linear(F.relu(out), self.glob_w2, self.glob_b2)
+
+        return x, edge_attr, u
+
+
+
+class GATE18Ensemble(nn.Module):
+    def __init__(self, models):
+        super(GATE18Ensemble, self).__init__()
+
+        def stack(get):
+            return torch.stack([get(model).detach() for model in models])
+
+        self.n_members = len(models)
+
+        # GATE18d initializes the global feature with the ligand embedding, GATE18e with zeros
+        self.lig_emb = type(models[0]).__name__ == 'GATE18d'
+
+        self.register_buffer('nt_w0', stack(lambda m: m.NodeTransform.mlp[0].weight).transpose(1, 2).contiguous())
+        self.register_buffer('nt_b0', stack(lambda m: m.NodeTransform.mlp[0].bias).unsqueeze(1))
+        self.register_buffer('nt_w2', stack(lambda m: m.NodeTransform.mlp[2].weight).transpose(1, 2).contiguous())
+        self.register_buffer('nt_b2', stack(lambda m: m.NodeTransform.mlp[2].bias).unsqueeze(1))
+
+        self.layer1 = StackedMetaLayer([model.layer1 for model in models])
+        self.layer2 = StackedMetaLayer([model.layer2 for model in models])
+
+        # BatchNorm layers in eval mode folded into a scale and a shift
+        for bn in ['node_bn1', 'edge_bn1', 'u_bn1']:
+            scale = stack(lambda m: getattr(m, bn).weight / torch.sqrt(getattr(m, bn).running_var + getattr(m, bn).eps))
+            shift = stack(lambda m: getattr(m, bn).bias) - stack(lambda m: getattr(m, bn).running_mean) * scale
+            self.register_buffer(f'{bn}_scale', scale.unsqueeze(1))
+            self.register_buffer(f'{bn}_shift', shift.unsqueeze(1))
+
+        self.register_buffer('fc1_w', stack(lambda m: m.fc1.weight).transpose(1, 2).contiguous())
+        self.register_buffer('fc1_b', stack(lambda m: m.fc1.bias).unsqueeze(1))
+        self.register_buffer('fc2_w', stack(lambda m: m.fc2.weight).transpose(1, 2).contiguous())
+        self.register_buffer('fc2_b', stack(lambda m: m.fc2.bias).unsqueeze(1))
+
+
+    def forward(self, graphbatch, prepared=None):
+        if prepared is None: prepared = PreparedBatch.from_batch(graphbatch)
+
+        x = stacked_linear(F.relu(stacked_linear(graphbatch.x, self.nt_w0, self.nt_b0)), self.nt_w2, self.nt_b2)
+        u = graphbatch.lig_emb if self.lig_emb else None
+
+        x, edge_attr, u = self.layer1(x, graphbatch.edge_attr, u, prepared)
+        x = x * self.node_bn1_scale + self.node_bn1_shift
+        edge_attr = edge_attr * self.edge_bn1_scale + self.edge_bn1_shift
+        u = u * self.u_bn1_scale + self.u_bn1_shift
+
+        _, _, u = self.layer2(x, edge_attr, u, prepared)
+
+        # Fully-Connected Layers
+        out = F.relu(stacked_linear(u, self.fc1_w, self.fc1_b))
+        member_outputs = stacked_linear(out, self.fc2_w, self.fc2_b).view(self.n_members, -1)
+        return member_outputs.mean(dim=0), member_outputs
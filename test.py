@@ -7,6 +7,7 @@ import numpy as np
 from Dataset import *
 from torch_geometric.loader import DataLoader
 from model.GATE18 import *
+from model.ensemble import GATE18Ensemble
 
 
 class RMSELoss(torch.nn.Module):
@@ -24,6 +25,22 @@ def load_model_state(model, state_dict_path):
 
 
 
+def ensemble_forward(models, graphbatch):
+    # The graph bookkeeping of the batch is prepared once and shared by all members
+    prepared = PreparedBatch.from_batch(graphbatch)
+
+    # Fused ensemble: all members are evaluated in a single pass over the batch
+    if isinstance(models, GATE18Ensemble):
+        output, _ = models(graphbatch, prepared)
+        return output
+
+    outputs = []
+    for model in models: 
+        outputs.append(model(graphbatch, prepared).view(-1))
+    return torch.mean(torch.stack(outputs), dim=0)
+
+
+
 # Evaluation Function
 #-------------------------------------------------------------------------------------------------------------------------------
 def evaluate(models, loader, criterion, device):
@@ -41,10 +58,7 @@ def evaluate(models, loader, criterion, device):
             targets = graphbatch.y
 
             # Forward pass EMSEMBLE MODEL
-            outputs = []
-            for model in models: 
-                outputs.append(model(graphbatch).view(-1))
-            output = torch.mean(torch.stack(outputs), dim=0)    
+            output = ensemble_forward(models, graphbatch)
             loss = criterion(output, targets)
 
             # Accumulate loss and collect the true and predicted values for later use
@@ -121,6 +135,7 @@ def parse_args():
     # OPTIONAL Arguments 
     parser.add_argument("--model_arch", default="GATE18d", help="The name of the model architecture")
     parser.add_argument("--save_path", default=None, help="The path where the results should be exported to")
+    parser.add_argument("--fused_ensemble", default=torch.cuda.is_available(), type=lambda x: x.lower() in ['true', '1', 'yes'], help="If all ensemble members should be evaluated in a single fused forward pass (default: True on GPU, False on CPU)")
 
     return parser.parse_args()
 
@@ -162,6 +177,7 @@ models = [model_class(
 model_paths = list(stdicts)
 #for m in model_paths: print(m)
 models = [load_model_state(model, path) for model, path in zip(models, model_paths)]
+if args.fused_ensemble: models = GATE18Ensemble(models).to(device)
 
 
 # Run inference
@@ -0,0 +1,81 @@
+import os
+import sys
+import json
+import zlib
+import h5py
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utils.similarity_matrix import TiledMatrixWriter, update_complex_list
+
+
+# The matrices of the similarity scripts that share the list of complexes
+TANIMOTO = ['pairwise_similarity_tanimoto.hdf5']
+TM_RMSD = ['pairwise_similarity_tm_scores_8.hdf5', 'pairwise_similarity_rmsd_ligand_8.hdf5']
+
+
+def similarity(complex1, complex2):
+    # Symmetric value that identifies the pair of complexes
+    return zlib.crc32(''.join(sorted((complex1, complex2))).encode()) % 1000 / 1000
+
+
+def compute(matrix_paths, complexes, update, tile_size=2):
+    # Mimics the similarity scripts: a full run writes the list, an update only computes the columns of new complexes
+    if update: complexes = update_complex_list('pairwise_similarity_complexes.json', complexes, matrix_paths)
+    else:
+        with open('pairwise_similarity_complexes.json', 'w') as f:
+            json.dump(complexes, f)
+
+    writers = [TiledMatrixWriter(path, len(complexes), tile_size) for path in matrix_paths]
+    for writer in writers:
+        with writer:
+            update_start = writer.update_start if update else 0
+            for rows, cols in writer.tiles(col_start=update_start):
+                block = np.array([[similarity(complexes[i], complexes[j]) for j in range(*cols)] for i in range(*rows)])
+                new_columns = np.arange(*cols)[None, :] >= update_start if cols[0] < update_start else None
+                writer.write(rows, cols, block, mask=new_columns)
+
+
+def check(matrix_paths):
+    with open('pairwise_similarity_complexes.json', 'r') as f:
+        complexes = json.load(f)
+    expected = np.array([[similarity(c1, c2) for c2 in complexes] for c1 in complexes], dtype=np.float32)
+    for path in matrix_paths:
+        with h5py.File(path, 'r') as f:
+            matrix = f['similarities'][:]
+        assert np.array_equal(matrix, expected), path
+
+
+@pytest.mark.parametrize('first, second', [(TM_RMSD, TANIMOTO), (TANIMOTO, TM_RMSD)])
+def test_update_both_scripts_in_sequence(tmp_path, monkeypatch, first, second):
+    monkeypatch.chdir(tmp_path)
+    old = ['1aaa', '1ccc', '1eee', '2aaa', '2ccc', '2eee']
+    new = old + ['1bbb', '1ddd', '3aaa']
+
+    compute(TANIMOTO, old, update=False)
+    compute(TM_RMSD, old, update=False)
+
+    compute(first, new, update=True)
+    compute(second, new, update=True)
+
+    with open('pairwise_similarity_complexes.json', 'r') as f:
+        assert json.load(f) == old + ['1bbb', '1ddd', '3aaa']
+    check(TANIMOTO + TM_RMSD)
+
+
+def test_update_rejects_list_that_does_not_match(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    old = ['1aaa', '1ccc', '1eee']
+    compute(TANIMOTO, old, update=False)
+
+    with open('pairwise_similarity_complexes.json', 'w') as f:
+        json.dump(old[:2], f)
+    with pytest.raises(ValueError):
+        update_complex_list('pairwise_similarity_complexes.json', old + ['1bbb'], TANIMOTO)
+    with open('pairwise_similarity_complexes.json', 'r') as f:
+        assert json.load(f) == old[:2]
+
+    os.remove('pairwise_similarity_complexes.json')
+    with pytest.raises(FileNotFoundError):
+        update_complex_list('pairwise_similarity_complexes.json', old + ['1bbb'], TANIMOTO)
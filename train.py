@@ -6,12 +6,23 @@ import matplotlib.pyplot as plt
 import numpy as np
 import wandb
 import time
+import random
+import json
+import csv
+import math
+import itertools
+import hashlib
+import threading
+import torch.distributed as dist
+from concurrent.futures import ThreadPoolExecutor
 
 from torch_geometric.data import Dataset
 from Dataset import *
 from torch_geometric.loader import DataLoader
 from sklearn.model_selection import StratifiedKFold
-from torch.utils.data import Subset
+from torch.utils.data import Subset, RandomSampler
+from torch.utils.data.distributed import DistributedSampler
+from torch.nn.parallel import DistributedDataParallel
 from model.GATE18 import *
 
 
@@ -41,6 +52,7 @@ OPTIONAL Command-line Arguments (with default values):
     TRAIN-VALIDATION SPLIT
     --n_folds:              OPTIONAL - Number of stratified folds for n-fold cross-validation
     --fold_to_train:        OPTIONAL - Fold to be used for training
+    --folds:                OPTIONAL - Train several folds concurrently in one process ('all' or comma-separated folds)
     --random_seed:          OPTIONAL - Random seed for dataset splitting.
 
     MODEL PARAMETERS
@@ -49,6 +61,7 @@ OPTIONAL Command-line Arguments (with default values):
     --optim:                OPTIONAL - Optimizer to be used ['Adam', 'Adagrad', 'SGD'].
     --num_epochs:           OPTIONAL - Number of epochs for training.
     --batch_size:           OPTIONAL - Batch size for training.
+    --device_dataset:       OPTIONAL - Keep the whole dataset on the device and gather the batches there (no DataLoader).
     --learning_rate:        OPTIONAL - Learning rate for training.
     --weight_decay:         OPTIONAL - Weight decay parameter for training.
     --conv_dropout:         OPTIONAL - Dropout probability for convolutional layers.
@@ -57,6 +70,11 @@ OPTIONAL Command-line Arguments (with default values):
     --early_stop_patience:  OPTIONAL - Patience for early stopping.
     --early_stop_min_delta: OPTIONAL - Minimum delta for early stopping.
 
+    TRAINING SET METRICS
+    --train_metrics:        OPTIONAL - Source of the training metrics ['inflight', 'eval'].
+    --train_eval_every:     OPTIONAL - With train_metrics eval, evaluate the training set every N epochs.
+    --train_eval_subsample: OPTIONAL - With train_metrics eval, evaluate on a fixed subsample of N training graphs.
+
     ADAPTIVE LEARNING RATE
     --alr_lin:              OPTIONAL - Whether to use linear learning rate reduction scheme.
     --start_factor:         OPTIONAL - Start factor for linear learning rate reduction.
@@ -73,6 +91,25 @@ OPTIONAL Command-line Arguments (with default values):
     --pretrained:           OPTIONAL - Path of a state dict to be imported for pretrained model.
     --start_epoch:          OPTIONAL - Starting epoch in case of importing pretrained model.
 
+    RESUMABLE CHECKPOINTS
+    --checkpoint_every:     OPTIONAL - Interval (epochs) for saving the full training state to save_dir/checkpoint.pt.
+    --resume:               OPTIONAL - Resume the training from save_dir/checkpoint.pt (if it exists).
+    --background_writes:    OPTIONAL - Write checkpoints and render plots in a background thread.
+
+    HYPERPARAMETER SWEEP
+    --sweep:                OPTIONAL - JSON file with lists of values for learning_rate, weight_decay, dropout, conv_dropout, alr.
+    --sweep_trials:         OPTIONAL - Number of trials sampled from the grid of the sweep (default: all combinations).
+    --sweep_min_epochs:     OPTIONAL - Epochs until the first pruning of the trials (successive halving).
+    --sweep_eta:            OPTIONAL - Fraction 1/eta of the trials is kept at each pruning, every eta times more epochs.
+    --sweep_workers:        OPTIONAL - Number of trials that are trained concurrently in worker threads (the batches are then
+                            loaded in the threads without DataLoader workers).
+
+    MIXED PRECISION
+    --amp:                  OPTIONAL - Mixed precision training and evaluation with autocast ['bf16', 'fp16'].
+
+    DISTRIBUTED TRAINING (launch with torchrun --nproc_per_node <N> train.py ...)
+    --dist_backend:         OPTIONAL - Backend of the process group ['nccl', 'gloo']. Default: nccl on GPUs, gloo on CPU.
+
     W&B TRACKING
     --wandb:                OPTIONAL - Whether or not to stream the run to Weights and Biases.
     --project_name:         OPTIONAL - Project name for saving run data to Weights and Biases.
@@ -97,8 +134,10 @@ def parse_args():
     parser.add_argument("--project_name", default=None, help="Project Name for the saving of run data to Weights and Biases")
     parser.add_argument("--n_folds", default=5, type=int, help="The number of stratified folds that should be generated (n-fold-CV)")
     parser.add_argument("--fold_to_train", default=0, type=int, help="Of the n_folds generated, on which fold should the model be trained")
+    parser.add_argument("--folds", default=None, help="Train several folds concurrently in one process, loading the dataset once ('all' or comma-separated folds, overrides --fold_to_train)")
     parser.add_argument("--num_epochs", default=2000, type=int, help="Number of Epochs the model should be trained (int)")
     parser.add_argument("--batch_size", default=256, type=int, help="The Batch Size that should be used for training (int)")
+    parser.add_argument("--device_dataset", default=False, type=lambda x: x.lower() in ['true', '1', 'yes'], help="If the whole dataset should be kept on the device and the batches gathered there instead of loading them with DataLoader workers")
     parser.add_argument("--learning_rate", default=0.001, type=float, help="The learning rate with which the model should train (float)")
     parser.add_argument("--weight_decay", default=0.001, type=float, help="The weight decay parameter with which the model should train (float)")
     parser.add_argument("--conv_dropout", default=0, type=float, help="The dropout probability that should be applied in the convolutional layers")
@@ -110,6 +149,11 @@ def parse_args():
     parser.add_argument("--early_stop_patience", default=100, type=int, help="For how many epochs the validation loss can cease to decrease without triggering early stop")
     parser.add_argument("--early_stop_min_delta", default=0.7, type=float, help="How far train loss and val loss are allowed to diverge without triggering early stop")
 
+    # Training set metrics
+    parser.add_argument("--train_metrics", default='inflight', choices=['inflight', 'eval'], help="If the training metrics are computed from the predictions of the training pass (inflight) or from an additional evaluation pass over the training set in eval mode (eval)")
+    parser.add_argument("--train_eval_every", default=1, type=int, help="With --train_metrics eval: Evaluate the training set every N epochs, the in-flight metrics are used in between")
+    parser.add_argument("--train_eval_subsample", default=None, type=int, help="With --train_metrics eval: Evaluate a fixed random subsample of N training graphs instead of the whole training set")
+
     # If the learning rate should be adaptive LINEAR
     parser.add_argument("--alr_lin",  default=False, type=lambda x: x.lower() in ['true', '1', 'yes'], help="Linear learning rate reduction scheme will be used")
     parser.add_argument("--start_factor", default=1, type=float,help="Factor by which the learning rate will be reduced. new_lr = lr * factor.")
@@ -130,6 +174,24 @@ def parse_args():
     parser.add_argument("--pretrained",  default=False, type=lambda x: x.lower() in ['true', '1', 'yes'], help="Provide the path of a state dict that should be imported")
     parser.add_argument("--start_epoch", default=0, type=int, help="Provide the starting epoch (in case of importing pretrained model)")
 
+    # Resumable checkpoints of the full training state
+    parser.add_argument("--checkpoint_every", default=10, type=int, help="Interval (in epochs) in which the full training state is saved to save_dir/checkpoint.pt (0 to disable)")
+    parser.add_argument("--resume", default=False, type=lambda x: x.lower() in ['true', '1', 'yes'], help="Resume the training from the checkpoint in the existing save_dir (starts a new training if there is no checkpoint)")
+    parser.add_argument("--background_writes", default=True, type=lambda x: x.lower() in ['true', '1', 'yes'], help="If checkpoints and plots should be written by a background thread from CPU snapshots, so that the training does not wait for them")
+
+    # Hyperparameter sweep with successive halving
+    parser.add_argument("--sweep", default=None, help="Path to a JSON file with lists of values for the hyperparameters ['learning_rate', 'weight_decay', 'dropout', 'conv_dropout', 'alr'] (alr in ['none', 'lin', 'mult', 'plateau']), the trials are the combinations of the values")
+    parser.add_argument("--sweep_trials", default=None, type=int, help="Number of trials sampled randomly from the combinations of the sweep (default: all combinations)")
+    parser.add_argument("--sweep_min_epochs", default=50, type=int, help="Number of epochs after which the trials are pruned for the first time (successive halving)")
+    parser.add_argument("--sweep_eta", default=3, type=int, help="At each pruning, the best 1/eta of the running trials (by best validation R) are kept, the next pruning is after eta times more epochs")
+    parser.add_argument("--sweep_workers", default=1, type=int, help="Number of trials that are trained concurrently in worker threads (the batches are then loaded in the threads without DataLoader workers)")
+
+    # Distributed data parallel training (launched with torchrun)
+    parser.add_argument("--dist_backend", default=None, choices=['nccl', 'gloo'], help="Backend of the process group for distributed training with torchrun (default: nccl on GPUs, gloo on CPU)")
+
+    # Mixed precision
+    parser.add_argument("--amp", default=None, choices=['bf16', 'fp16'], help="Mixed precision training and evaluation with autocast, fp16 with gradient scaling (GPU only), bf16 also on CPU")
+
     return parser.parse_args()
 
 args = parse_args()
@@ -169,7 +231,6 @@ n_folds = args.n_folds
 fold_to_train = args.fold_to_train
 
 wandb_dir = save_dir
-run_name = f'{run_name}_f{fold_to_train}' 
 
 
 # Early Stopping
@@ -197,8 +258,6 @@ if early_stopping:
                     print(f'Early Stopping: Validation R has not decreased for {self.patience} epochs')
                     return True
             return False
-        
-    early_stopper = EarlyStopper(patience=args.early_stop_patience, min_delta=args.early_stop_min_delta)
 
 
 
@@ -237,18 +296,51 @@ if wandb_tracking:
                 "Splitting Random Seed":random_seed,
                 "Dropout Probability": dropout_prob,
                 "Dropout Prob Convolutional Layers":conv_dropout_prob,
-                "Adaptive LR Scheme": alr
+                "Adaptive LR Scheme": alr,
+                "Mixed Precision": args.amp,
+                "Training Metrics": args.train_metrics
                 }
 
 pretrained = args.pretrained
 start_epoch = args.start_epoch
 
-if os.path.exists(save_dir):
+
+# Distributed data parallel training, launched with torchrun (one process per device). The gradients are all-reduced by
+# DistributedDataParallel, the metrics are computed from the gathered predictions of all processes and only rank 0
+# prints, logs, plots and saves checkpoints. nccl is used on GPUs, gloo across CPU processes
+distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+if distributed:
+    dist.init_process_group(backend=args.dist_backend or ('nccl' if torch.cuda.is_available() else 'gloo'))
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+else:
+    rank, world_size, local_rank = 0, 1, 0
+
+main_process = rank == 0
+wandb_tracking = wandb_tracking and main_process
+
+# Messages are only printed by the main process (errors are printed by all processes)
+def log(*args, **kwargs):
+    if main_process: print(*args, **kwargs)
+
+if distributed: log(f'Distributed Training with {world_size} processes ({dist.get_backend()} backend)')
+
+# Resume from the full training state checkpoint in the save directory (if there is one)
+checkpoint_path = os.path.join(save_dir, 'checkpoint.pt')
+checkpoint = None
+if args.resume and os.path.exists(checkpoint_path):
+    checkpoint = torch.load(checkpoint_path, map_location='cpu', weights_only=False)
+    log(f'Resuming from checkpoint {checkpoint_path} (epoch {checkpoint["epoch"]})')
+
+save_dir_exists = os.path.exists(save_dir)
+if distributed: dist.barrier()
+if save_dir_exists and not args.resume:
     print(f'Aborted: Saving Directory  {save_dir} exists already')
     sys.exit()
-else:
+elif main_process and not save_dir_exists:
     os.makedirs(save_dir)
-    print(f'Saving Directory generated')
+    log(f'Saving Directory generated')
 #----------------------------------------------------------------------------------------------------
 
 
@@ -263,44 +355,114 @@ dataset = torch.load(dataset_path)
 node_feat_dim = dataset[0].x.shape[1]
 edge_feat_dim = dataset[0].edge_attr.shape[1]
 
-labels = [graph.y.item() for graph in dataset]
-print(max(labels), len(labels))
-
-
-# Initialize StratifiedKFold
-skf = StratifiedKFold(n_splits=n_folds, random_state=random_seed, shuffle=True)
-
-group_assignment = np.array( [round(lab) for lab in labels] )
+# Labels and ids from the header of the dataset (see PDBbind_Dataset), dataset files without header are read graph by graph
+if getattr(dataset, 'label_vector', None) is not None:
+    dataset_indices = list(dataset.indices())
+    labels = dataset.label_vector[dataset_indices].tolist()
+    ids = [dataset.ids[idx] for idx in dataset_indices]
+else:
+    graphs = [dataset[idx] for idx in range(len(dataset))]
+    labels = [graph.y.item() for graph in graphs]
+    ids = [graph['id'] if 'id' in graph.keys() else None for graph in graphs]
+    del graphs
+log(max(labels), len(labels))
+
+
+# The stratified folds are cached next to the dataset file, keyed by the hash of the labels and ids, the number of folds
+# and the random seed, so that they are computed once and stay identical across runs (and scikit-learn versions)
+dataset_hash = hashlib.sha256(np.asarray(labels, dtype=np.float32).tobytes() + '\n'.join(map(str, ids)).encode()).hexdigest()
+split_key = f'{dataset_hash[:16]}_n{n_folds}_s{random_seed}'
+split_cache_path = f'{os.path.splitext(dataset_path)[0]}_folds.json'
+split_cache = {}
+if os.path.exists(split_cache_path):
+    with open(split_cache_path, 'r', encoding='utf-8') as json_file:
+        split_cache = json.load(json_file)
+
+if split_key in split_cache:
+    val_indices = split_cache[split_key]
+    log(f'Folds loaded from {split_cache_path}')
 
+else:
+    # Initialize StratifiedKFold
+    skf = StratifiedKFold(n_splits=n_folds, random_state=random_seed, shuffle=True)
+
+    group_assignment = np.array( [round(lab) for lab in labels] )
+
+    val_indices = []
+    for i, (train_index, val_index) in enumerate(skf.split(np.zeros(len(dataset)), group_assignment)):
+        val_indices.append(val_index.tolist())
+
+    if main_process:
+        split_cache[split_key] = val_indices
+        try:
+            with open(f'{split_cache_path}.tmp', 'w', encoding='utf-8') as json_file:
+                json.dump(split_cache, json_file)
+            os.replace(f'{split_cache_path}.tmp', split_cache_path)
+            log(f'Folds saved to {split_cache_path}')
+        except OSError as e:
+            log(f'Folds could not be cached at {split_cache_path}: {e}')
+
+# The training set of a fold is the (sorted) complement of its validation set
 train_indices = []
-val_indices = []
-for i, (train_index, val_index) in enumerate(skf.split(np.zeros(len(dataset)), group_assignment)):
-    val_indices.append(val_index.tolist())
-    train_indices.append(train_index.tolist())
-
-
-# Select the fold that should be used for the training
-train_idx = train_indices[fold_to_train]
-val_idx = val_indices[fold_to_train]
-
-train_dataset = Subset(dataset, train_idx)
-val_dataset = Subset(dataset, val_idx)
-
-# Save split dictionary to json at save dir (if the dataset contains the key "id")
-if 'id' in train_dataset[0].keys():
-    split = {}
-    split['validation'] = [grph['id'] for grph in val_dataset]
-    split['train'] = [grph['id'] for grph in train_dataset]
-    with open(f'{save_dir}/train_val_split.json', 'w', encoding='utf-8') as json_file:
-        json.dump(split, json_file, ensure_ascii=False, indent=4)
-
-print(f'Length Training Dataset: {len(train_dataset)}')
-print(f'Length Validation Dataset: {len(val_dataset)}')
-print(f'Example Graph: {train_dataset[0]}')
-
-train_loader = DataLoader(dataset = train_dataset, batch_size=batch_size, shuffle=True, num_workers=4, persistent_workers=True, pin_memory=True)
-eval_loader_train = DataLoader(dataset = train_dataset, batch_size=512, shuffle=True, num_workers=4, persistent_workers=True, pin_memory=True)
-eval_loader_val = DataLoader(dataset = val_dataset, batch_size=512, shuffle=True, num_workers=4, persistent_workers=True, pin_memory=True)
+for val_index in val_indices:
+    in_val = np.zeros(len(dataset), dtype=bool)
+    in_val[val_index] = True
+    train_indices.append(np.flatnonzero(~in_val).tolist())
+
+
+# Select the folds that should be trained. Several folds share the loaded dataset and are trained concurrently in this
+# process by interleaving their epochs, each fold saves its outputs to its own subdirectory of the save directory
+if args.folds is None: folds = [fold_to_train]
+elif args.folds == 'all': folds = list(range(n_folds))
+else: folds = [int(fold) for fold in args.folds.split(',')]
+multi_fold = len(folds) > 1
+
+log(f'Folds to train: {folds}')
+
+
+# Hyperparameter sweep: The trials are trained concurrently on the same fold (sharing the loaded dataset) by interleaving 
+# their epochs (or in worker threads) and are pruned with successive halving on their best validation Pearson R. Each 
+# trial saves its outputs to its own subdirectory of the save directory, the results are collected in sweep_results.csv
+sweep_parameters = ['learning_rate', 'weight_decay', 'dropout', 'conv_dropout', 'alr']
+default_hparams = {'learning_rate': learning_rate,
+                   'weight_decay': weight_decay,
+                   'dropout': dropout_prob,
+                   'conv_dropout': conv_dropout_prob,
+                   'alr': 'lin' if alr_lin else 'mult' if alr_mult else 'plateau' if alr_plateau else 'none'}
+
+trials = [None]
+sweep = args.sweep is not None
+if sweep:
+    if multi_fold or distributed:
+        print('Aborted: A sweep trains a single fold (--fold_to_train) in a single process')
+        sys.exit()
+
+    with open(args.sweep, 'r', encoding='utf-8') as json_file:
+        search_space = json.load(json_file)
+    unknown = [parameter for parameter in search_space if parameter not in sweep_parameters]
+    if unknown:
+        print(f'Aborted: Hyperparameters {unknown} cannot be swept, choose from {sweep_parameters}')
+        sys.exit()
+
+    trials = [dict(zip(search_space, values)) for values in itertools.product(*search_space.values())]
+    if args.sweep_trials is not None and args.sweep_trials < len(trials):
+        trials = random.Random(random_seed).sample(trials, args.sweep_trials)
+
+    # Pruning epochs (rungs) of the successive halving
+    rungs = []
+    rung = args.sweep_min_epochs
+    while rung < num_epochs:
+        rungs.append(rung)
+        rung *= args.sweep_eta
+
+    log(f'Sweep: {len(trials)} trials over {list(search_space)}, pruning at epochs {rungs} (eta {args.sweep_eta})')
+
+# Several runs (folds or trials) are saved to subdirectories and log with a prefix
+multi_run = multi_fold or sweep
+
+# Training set evaluation in eval mode, by default only before the training (the training metrics of the epochs are
+# computed from the training pass itself), optionally every N epochs and on a fixed subsample of the training set
+train_metrics = args.train_metrics
 #----------------------------------------------------------------------------------------------------
 
 
@@ -309,10 +471,6 @@ eval_loader_val = DataLoader(dataset = val_dataset, batch_size=512, shuffle=True
 
 # Plot the distributions of the datasets
 #----------------------------------------------------------------------------------------------------
-training_labels = [graph.y.item() for graph in train_dataset]
-validation_labels = [graph.y.item() for graph in val_dataset]
-highest_label = max([max(training_labels), max(validation_labels)])
-
 def create_histogram(data, title, xlim, num_bins=50):
 
     plt.style.use('ggplot')
@@ -335,9 +493,6 @@ def create_histogram(data, title, xlim, num_bins=50):
     plt.xlim(0, np.ceil(xlim))
 
     return fig
-
-hist_training_labels = create_histogram(training_labels, f'Labels Training Dataset', highest_label)
-hist_validation_labels = create_histogram(validation_labels, f'Labels Validation Dataset', highest_label)
 #----------------------------------------------------------------------------------------------------
 
 
@@ -346,7 +501,7 @@ hist_validation_labels = create_histogram(validation_labels, f'Labels Validation
 
 # Initialize Model, Optimizer and Loss Function
 #-------------------------------------------------------------------------------------------------------------------------------
- 
+
 # Function to count number of trainable parameters
 def count_parameters(model, trainable=True):
     return sum(p.numel() for p in model.parameters() if p.requires_grad or not trainable)
@@ -365,45 +520,48 @@ num_threads = int(os.environ.get('OMP_NUM_THREADS', torch.get_num_threads()))
 torch.set_num_threads(num_threads)
 
 # Since SLURM sets CUDA_VISIBLE_DEVICES for us, the first available GPU will be "cuda:0" from this script's perspective.
-device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
-print(device, torch.cuda.current_device(), torch.cuda.get_device_name())
+device = torch.device(f'cuda:{local_rank}' if torch.cuda.is_available() else 'cpu')
+if device.type == 'cuda': torch.cuda.set_device(device)
+device_name = torch.cuda.get_device_name() if device.type == 'cuda' else 'CPU'
+log(device, device_name)
 
 
-# Initialize the model and optimizer
-model_class = getattr(sys.modules[__name__], args.model)
-Model = model_class(dropout_prob=dropout_prob, in_channels=node_feat_dim, edge_dim=edge_feat_dim, conv_dropout_prob=conv_dropout_prob).to(device)
-Model = Model.float()
-torch.save(Model, f'{save_dir}/model_configuration.pt')
+# Mixed precision: Autocast of the forward passes (Linear layers of the MLPs and of the GATv2Conv attention run in
+# reduced precision, the model weights stay in float32). fp16 requires gradient scaling, bf16 has the range of float32
+amp = args.amp
+if amp == 'fp16' and device.type != 'cuda':
+    print('Aborted: Mixed precision with fp16 requires a GPU, use --amp bf16 on CPU')
+    sys.exit()
 
-parameters = count_parameters(Model)
-print(f'Model architecture {model_arch} with {parameters} parameters')
+amp_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}.get(amp, torch.float32)
 
-if wandb_tracking: 
-    config['Number of Parameters'] = parameters
-    config['Device'] = torch.cuda.get_device_name()
+def autocast():
+    return torch.autocast(device_type=device.type, dtype=amp_dtype, enabled=amp is not None)
 
 
+# Device-resident dataset: All graphs are concatenated once into flat tensors on the device and the batches are gathered
+# on the device (DeviceGraphLoader), without DataLoader workers and without host to device copies in each step
+device_dataset = args.device_dataset
+if device_dataset:
+    device_graphs = DeviceGraphs(dataset, device)
+    log(f'Dataset Resident on the Device ({device_name})')
 
-if optim == 'Adam': optimizer = torch.optim.Adam(list(Model.parameters()),lr=learning_rate, weight_decay=weight_decay)
-elif optim == 'Adagrad': optimizer = torch.optim.Adagrad(Model.parameters(), learning_rate, weight_decay=weight_decay)
-elif optim == 'SGD': optimizer = torch.optim.SGD(Model.parameters(), lr=learning_rate, momentum=0.9, weight_decay=weight_decay)
 
+# The model class, the models and optimizers are initialized for each fold (see FoldRun)
+model_class = getattr(sys.modules[__name__], args.model)
 
 
-# Apply adaptive learning rate (alr) scheme
-if alr_lin: 
-    lin_scheduler = torch.optim.lr_scheduler.LinearLR(optimizer, start_factor=start_factor, end_factor=end_factor, total_iters=total_iters)
+# Adaptive learning rate (alr) scheme
+if alr_lin:
     learning_rate_reduction_scheme = f'Linear LR Scheduler enabled with start factor {start_factor}, end factor {end_factor} and total iters {total_iters}'
 elif alr_mult:
-    mult_scheduler = torch.optim.lr_scheduler.MultiplicativeLR(optimizer, lr_lambda=lambda epoch: factor)
     learning_rate_reduction_scheme = f'Multiplicative LR Scheduler enabled with factor {factor}'
-elif alr_plateau: 
-    plat_scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, factor=reduction, patience=patience, min_lr=min_lr)
+elif alr_plateau:
     learning_rate_reduction_scheme = f'ReduceLRonPlateau LR Scheduler enabled with patience {patience}, factor {reduction} and min LR {min_lr}'
-else: 
+else:
     learning_rate_reduction_scheme = 'No learning rate scheduler has been selected'
 
-print(learning_rate_reduction_scheme)
+log(learning_rate_reduction_scheme)
 
 
 
@@ -426,23 +584,23 @@ class RMSELoss(torch.nn.Module):
 
 if loss_function == 'Huber':
     criterion = torch.nn.HuberLoss(reduction='mean', delta=1.0)
-    print(f'Loss Function: Huber Loss')
+    log(f'Loss Function: Huber Loss')
 
 elif loss_function == 'L1':
     criterion = torch.nn.L1Loss(size_average=None, reduce=None, reduction='mean')
-    print(f'Loss Function: L1 Loss')
+    log(f'Loss Function: L1 Loss')
 
 elif loss_function == 'wMSE':
     criterion = wMSELoss()
-    print(f'Loss Function: wMSE Loss')
+    log(f'Loss Function: wMSE Loss')
 
 elif loss_function == 'RMSE':
     criterion = RMSELoss()
-    print(f'Loss Function: RMSE Loss')
+    log(f'Loss Function: RMSE Loss')
 
 else: 
     criterion = torch.nn.MSELoss()
-    print(f'Loss Function: MSE Loss')
+    log(f'Loss Function: MSE Loss')
 
 #----------------------------------------------------------------------------------------------------
 
@@ -450,49 +608,76 @@ else:
 
 # Training Function for 1 Epoch
 #-------------------------------------------------------------------------------------------------------------------------------
-def train(Model, loader, criterion, optimizer, device):
+def gather(tensor):
+    # Distributed training: Stacks the (equally sized) tensors of all processes along a new first dimension
+    tensors = [torch.empty_like(tensor) for _ in range(world_size)]
+    dist.all_gather(tensors, tensor)
+    return torch.stack(tensors)
+
+
+def epoch_metrics(total_loss, n_batches, y_true, y_pred, n_samples):
+    # In distributed training, the loss is summed and the true and predicted values are gathered from all processes. 
+    # The DistributedSampler assigns the samples to the processes round robin (padded to equal length), so interleaving 
+    # the gathered values restores the sample order and the padding is removed by keeping the first n_samples values
+    if distributed:
+        total_loss = gather(total_loss).sum()
+        n_batches = n_batches * world_size
+        y_true = gather(y_true).t().reshape(-1)[:n_samples]
+        y_pred = gather(y_pred).t().reshape(-1)[:n_samples]
+
+    # Pearson Correlation Coefficient, R2 Score and RMSE in pK unit computed on the device (in float64). The metrics, the
+    # labels and the predictions are copied to the CPU together, so that there is a single synchronization per epoch
+    y_true_64 = y_true.double()
+    y_pred_64 = y_pred.double()
+    true_centered = y_true_64 - y_true_64.mean()
+    pred_centered = y_pred_64 - y_pred_64.mean()
+    squared_errors = (y_true_64 - y_pred_64) ** 2
+
+    r = (true_centered * pred_centered).sum() / torch.sqrt((true_centered ** 2).sum() * (pred_centered ** 2).sum())
+    r2_score = 1 - squared_errors.sum() / (true_centered ** 2).sum()
+
+    min=0
+    max=16
+    rmse = torch.sqrt(squared_errors.mean()) * (max - min)
+
+    metrics = torch.stack([total_loss.double() / n_batches, r, rmse, r2_score])
+    values = torch.cat([metrics, y_true_64, y_pred_64]).tolist()
+    n = y_true.size(0)
+    loss, r, rmse, r2_score = values[:4]
+    return loss, r, rmse, r2_score, values[4:4+n], values[4+n:]
+
+
+def train(Model, loader, criterion, optimizer, scaler, device):
     Model.train()
         
-    # Initialize variables to accumulate metrics
-    total_loss = 0.0
-    y_true = []
-    y_pred = []
+    # Initialize tensors on the device to accumulate the loss, the true and the predicted values
+    total_loss = torch.zeros((), device=device)
+    y_true = torch.empty(len(loader.dataset), device=device)
+    y_pred = torch.empty(len(loader.dataset), device=device)
+    n = 0
                 
     for graphbatch in loader:
-        graphbatch.to(device)
+        graphbatch.to(device, non_blocking=True)
         targets = graphbatch.y
 
-        # Forward pass
+        # Forward pass (the loss is computed in float32)
         optimizer.zero_grad()
-        output = Model(graphbatch).view(-1)
+        with autocast():
+            output = Model(graphbatch).view(-1).float()
         loss = criterion(output, targets)
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
-        # Accumulate loss collect the true and predicted values for later use
-        total_loss += loss.item()
-        y_true.extend(targets.tolist())
-        y_pred.extend(output.tolist())
+        # Accumulate loss collect the true and predicted values for later use (without synchronizing)
+        batch_size = targets.size(0)
+        total_loss += loss.detach()
+        y_true[n:n+batch_size] = targets
+        y_pred[n:n+batch_size] = output.detach()
+        n += batch_size
 
     # Calculate evaluation metrics
-    avg_loss = total_loss / len(loader)
-
-    # Pearson Correlation Coefficient
-    corr_matrix = np.corrcoef(y_true, y_pred)
-    r = corr_matrix[0, 1]
-
-    # R2 Score
-    r2_score = 1 - np.sum((np.array(y_true) - np.array(y_pred)) ** 2) / np.sum((np.array(y_true) - np.mean(np.array(y_true))) ** 2)
-
-    # RMSE in pK unit
-    min=0
-    max=16
-    true_labels_unscaled = torch.tensor(y_true) * (max - min) + min
-    predictions_unscaled = torch.tensor(y_pred) * (max - min) + min
-    criter = RMSELoss()
-    rmse = criter(predictions_unscaled, true_labels_unscaled)
-
-    return avg_loss, r, rmse, r2_score, y_true, y_pred
+    return epoch_metrics(total_loss, len(loader), y_true[:n], y_pred[:n], len(loader.dataset))
 #-------------------------------------------------------------------------------------------------------------------------------
 
 
@@ -501,89 +686,38 @@ def train(Model, loader, criterion, optimizer, device):
 def evaluate(Model, loader, criterion, device):
     Model.eval()
 
-    # Initialize variables to accumulate the evaluation results
-    total_loss = 0.0
-    y_true = []
-    y_pred = []
+    # Initialize tensors on the device to accumulate the loss, the true and the predicted values
+    total_loss = torch.zeros((), device=device)
+    y_true = torch.empty(len(loader.dataset), device=device)
+    y_pred = torch.empty(len(loader.dataset), device=device)
+    n = 0
 
     # Disable gradient calculation during evaluation
     with torch.no_grad():
         for graphbatch in loader:
 
-            graphbatch.to(device)
+            graphbatch.to(device, non_blocking=True)
             targets = graphbatch.y
 
             # Forward pass
-            output = Model(graphbatch).view(-1)
+            with autocast():
+                output = Model(graphbatch).view(-1).float()
             loss = criterion(output, targets)
 
-            # Accumulate loss and collect the true and predicted values for later use
-            total_loss += loss.item()
-            y_true.extend(targets.tolist())
-            y_pred.extend(output.tolist())
-
+            # Accumulate loss and collect the true and predicted values for later use (without synchronizing)
+            batch_size = targets.size(0)
+            total_loss += loss
+            y_true[n:n+batch_size] = targets
+            y_pred[n:n+batch_size] = output
+            n += batch_size
 
     # Calculate evaluation metrics
-    eval_loss = total_loss / len(loader)
-
-    # Pearson Correlation Coefficient
-    corr_matrix = np.corrcoef(y_true, y_pred)
-    r = corr_matrix[0, 1]
-
-    # R2 Score
-    r2_score = 1 - np.sum((np.array(y_true) - np.array(y_pred)) ** 2) / np.sum((np.array(y_true) - np.mean(np.array(y_true))) ** 2)
-
-    # RMSE in pK unit
-    min=0
-    max=16
-    true_labels_unscaled = torch.tensor(y_true) * (max - min) + min
-    predictions_unscaled = torch.tensor(y_pred) * (max - min) + min
-    criter = RMSELoss()
-    rmse = criter(predictions_unscaled, true_labels_unscaled)
-
-    return eval_loss, r, rmse, r2_score, y_true, y_pred
+    return epoch_metrics(total_loss, len(loader), y_true[:n], y_pred[:n], len(loader.dataset))
 #-------------------------------------------------------------------------------------------------------------------------------
 
 
 
 
-
-
-
-
-# Initialize WandB tracking with config dictionary
-#-----------------------------------------------------------------------------------
-if wandb_tracking:
-    wandb.login()
-    wandb.init(project=project_name, name = run_name, config=config, dir=wandb_dir)
-    
-    wandb.log({"Training Labels": wandb.Image(hist_training_labels),
-               "Validation Labels": wandb.Image(hist_validation_labels)})
-
-
-if pretrained:
-    Model.load_state_dict(torch.load(pretrained))
-    print(f'State Dict Loaded: {pretrained}')
-    print(f'Start Epoch: {start_epoch}')
-    epoch = start_epoch
-
-else: 
-    epoch = 0
-
-
-print(f'Model Architecture {model_arch} - Fold {fold_to_train} ({run_name})')
-print(f'Number of Parameters: {parameters}')
-print(f'Learning Rate: {learning_rate}')
-print(f'Weight Decay: {weight_decay}')
-print(f'Batch Size: {batch_size}')
-print(f'Loss Function: {loss_function}')    
-print(f'Number of Epochs: {num_epochs}')
-print(f'{learning_rate_reduction_scheme}\n')
-
-print(f'Model Training Output ({run_name})')
-
-
-
 # Plotting Functions
 #-------------------------------------------------------------------------------------------------------------------------
 def plot_predictions(train_y_true, train_y_pred, val_y_true, val_y_pred, title):
@@ -634,6 +768,29 @@ def residuals_plot(train_y_true, train_y_pred, val_y_true, val_y_pred, title):
     plt.legend()  # Add a legend to differentiate training and validation data
     plt.show()
     return fig
+
+
+def plot_best_predictions(run_name, save_dir, epoch, best_train, best_val, wandb_log=None):
+
+    # Load the best metrics
+    val_loss, val_r, val_rmse, val_r2, val_y_true, val_y_pred = best_val
+    train_loss, train_r, train_rmse, train_r2, train_y_true, train_y_pred = best_train
+
+    # Plot the predictions and the residuals plot
+    best_predictions = plot_predictions( train_y_true, train_y_pred,
+                            val_y_true, val_y_pred,
+                            f"{run_name}: Epoch {epoch}\nTrain R = {train_r:.3f}, Validation R = {val_r:.3f}\nTrain RMSE = {train_rmse:.3f}, Validation RMSE = {val_rmse:.3f}")
+    best_predictions.savefig(f'{save_dir}/train_predictions.png')
+
+    residuals = residuals_plot(train_y_true, train_y_pred, val_y_true, val_y_pred,
+                            f"{run_name}: Epoch {epoch}\nTrain R = {train_r:.3f}, Validation R = {val_r:.3f}\nTrain RMSE = {train_rmse:.3f}, Validation RMSE = {val_rmse:.3f}")
+    residuals.savefig(f'{save_dir}/train_residuals.png')
+
+    if wandb_log is not None:
+        wandb_log({"Best Predictions Scatterplot": wandb.Image(best_predictions),
+                   "Residuals Plot":wandb.Image(residuals)})
+
+    plt.close('all')
 #-------------------------------------------------------------------------------------------------------------------------
 
 
@@ -641,146 +798,498 @@ def residuals_plot(train_y_true, train_y_pred, val_y_true, val_y_pred, title):
 
 
 
+# Background Writing of Checkpoints and Plots
+#-------------------------------------------------------------------------------------------------------------------------
+def cpu_snapshot(obj):
+    # Copy of a (nested) state in which all tensors are copied to the CPU, the training can modify the original meanwhile
+    if torch.is_tensor(obj): return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        snapshot = type(obj)((key, cpu_snapshot(value)) for key, value in obj.items())
+        if hasattr(obj, '_metadata'): snapshot._metadata = obj._metadata
+        return snapshot
+    if isinstance(obj, (list, tuple)): return type(obj)(cpu_snapshot(value) for value in obj)
+    return obj
+
+
+class BackgroundWriter:
+    '''
+    Runs the writing of checkpoints and the rendering of plots in a single background thread (in the order of submission,
+    pyplot is only used by this thread during the training). At most max_pending jobs are queued, the submission waits
+    for the oldest job otherwise. Exceptions of a job are raised in the training loop at the next submission or at close.
+    If disabled, the jobs are run immediately.
+    '''
+    def __init__(self, enabled=True, max_pending=4):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='writer') if enabled else None
+        self.max_pending = max_pending
+        self.pending = []
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        # The lock serializes the jobs of runs that are trained concurrently in worker threads (sweep)
+        with self.lock:
+            if self.executor is None:
+                fn(*args, **kwargs)
+                return
+            for future in [future for future in self.pending if future.done()]: future.result()
+            self.pending = [future for future in self.pending if not future.done()]
+            if len(self.pending) >= self.max_pending: self.pending.pop(0).result()
+            self.pending.append(self.executor.submit(fn, *args, **kwargs))
+
+    def close(self):
+        if self.executor is None: return
+        self.executor.shutdown(wait=True)
+        for future in self.pending: future.result()
+        self.pending = []
+
+
+writer = BackgroundWriter(enabled=args.background_writes)
+#-------------------------------------------------------------------------------------------------------------------------
 
-# Training and Validation Set Performance BEFORE Training
+
+
+
+
+
+# Training of a Fold
 #-------------------------------------------------------------------------------------------------------------------------------
+class FoldRun:
+    '''
+    Training state of one fold: data split, loaders, model, optimizer, LR scheduler, early stopping and best metrics.
+    With several folds, the runs share the loaded dataset and each one logs to its own log file and subdirectory.
+    In a sweep, each run is a trial that trains the fold with its own hyperparameters (see default_hparams).
+    '''
+    def __init__(self, fold, trial=None):
+        self.fold = fold
+        self.trial = trial
+        self.hparams = dict(default_hparams, **trials[trial]) if trial is not None else default_hparams
+        self.key = trial if trial is not None else fold
+        self.label = f'Trial {trial}' if trial is not None else f'Fold {fold}'
+        subdir = f't{trial}' if trial is not None else f'f{fold}'
+
+        self.run_name = f'{run_name}_t{trial}_f{fold}' if trial is not None else f'{run_name}_f{fold}'
+        self.save_dir = os.path.join(save_dir, subdir) if multi_run else save_dir
+        self.wandb_prefix = f'{self.label}/' if multi_run else ''
+        if multi_run and main_process: os.makedirs(self.save_dir, exist_ok=args.resume)
+        self.log_file = open(os.path.join(self.save_dir, f'{self.run_name}.log'), 'a' if checkpoint else 'w') if multi_run and main_process else None
+        if trial is not None: self.log(f'Hyperparameters: {self.hparams}')
+
+        # Select the fold that should be used for the training
+        self.train_dataset = Subset(dataset, train_indices[fold])
+        self.val_dataset = Subset(dataset, val_indices[fold])
+
+        # Save split dictionary to json at save dir (if the dataset contains the key "id")
+        if ids[0] is not None and main_process:
+            split = {}
+            split['validation'] = [ids[idx] for idx in val_indices[fold]]
+            split['train'] = [ids[idx] for idx in train_indices[fold]]
+            with open(f'{self.save_dir}/train_val_split.json', 'w', encoding='utf-8') as json_file:
+                json.dump(split, json_file, ensure_ascii=False, indent=4)
+
+        self.log(f'Length Training Dataset: {len(self.train_dataset)}')
+        self.log(f'Length Validation Dataset: {len(self.val_dataset)}')
+        self.log(f'Example Graph: {self.train_dataset[0]}')
+
+        self.train_eval_dataset = self.train_dataset
+        if args.train_eval_subsample is not None and args.train_eval_subsample < len(self.train_dataset):
+            subsample = np.random.default_rng(random_seed).choice(len(self.train_dataset), args.train_eval_subsample, replace=False)
+            self.train_eval_dataset = Subset(self.train_dataset, sorted(subsample.tolist()))
+            self.log(f'Training Set Evaluation on a Subsample of {len(self.train_eval_dataset)} Graphs')
+
+        # The training set is shuffled by a generator that is seeded with the epoch (like the DistributedSampler) and the 
+        # loaders draw the seeds of their workers from their own generator. The global RNG is then only used by the model 
+        # (dropout), so that a training resumed from a checkpoint continues exactly where it stopped
+        self.loader_generator = torch.Generator()
+        if distributed:
+            # Each process trains on a shard of the fold (the batch size is divided between the processes) and evaluates 
+            # a shard of the evaluation sets, the metrics are computed from the gathered predictions
+            self.train_sampler = DistributedSampler(self.train_dataset, shuffle=True, seed=random_seed)
+            eval_sampler_train = DistributedSampler(self.train_eval_dataset, shuffle=False)
+            eval_sampler_val = DistributedSampler(self.val_dataset, shuffle=False)
+        else:
+            self.shuffle_generator = torch.Generator()
+            self.train_sampler = RandomSampler(self.train_dataset, generator=self.shuffle_generator)
+            eval_sampler_train = eval_sampler_val = None
+
+        # With several runs, the workers are not persistent, so that only the loaders of the current run hold workers.
+        # Trials that are trained concurrently in threads load their batches in the thread (forking DataLoader workers
+        # from several threads crashes the workers)
+        persistent = not multi_run
+        loader_workers = 0 if sweep and args.sweep_workers > 1 else 4
+        if device_dataset:
+            self.train_loader = DeviceGraphLoader(device_graphs, self.train_dataset, batch_size // world_size, sampler=self.train_sampler)
+            self.eval_loader_train = DeviceGraphLoader(device_graphs, self.train_eval_dataset, 512, sampler=eval_sampler_train)
+            self.eval_loader_val = DeviceGraphLoader(device_graphs, self.val_dataset, 512, sampler=eval_sampler_val)
+        else:
+            self.train_loader = DataLoader(dataset = self.train_dataset, batch_size=batch_size // world_size, sampler=self.train_sampler, generator=self.loader_generator, num_workers=loader_workers, persistent_workers=persistent, pin_memory=True)
+            self.eval_loader_train = DataLoader(dataset = self.train_eval_dataset, batch_size=512, sampler=eval_sampler_train, generator=self.loader_generator, num_workers=loader_workers, persistent_workers=persistent and train_metrics == 'eval', pin_memory=True)
+            self.eval_loader_val = DataLoader(dataset = self.val_dataset, batch_size=512, sampler=eval_sampler_val, generator=self.loader_generator, num_workers=loader_workers, persistent_workers=persistent, pin_memory=True)
+
+        # Plot the distributions of the datasets (logged to wandb)
+        if wandb_tracking:
+            training_labels = [labels[idx] for idx in train_indices[fold]]
+            validation_labels = [labels[idx] for idx in val_indices[fold]]
+            highest_label = max([max(training_labels), max(validation_labels)])
+            self.hist_training_labels = create_histogram(training_labels, f'Labels Training Dataset', highest_label)
+            self.hist_validation_labels = create_histogram(validation_labels, f'Labels Validation Dataset', highest_label)
+
+        # Initialize the model (every fold starts from the same initialization as in a separate run) and optimizer
+        torch.manual_seed(0)
+        self.model = model_class(dropout_prob=self.hparams['dropout'], in_channels=node_feat_dim, edge_dim=edge_feat_dim, conv_dropout_prob=self.hparams['conv_dropout']).to(device)
+        self.model = self.model.float()
+
+        if pretrained:
+            self.model.load_state_dict(torch.load(pretrained, map_location=device))
+            self.log(f'State Dict Loaded: {pretrained}')
+
+        # In distributed training, the model is wrapped to all-reduce the gradients (self.model is the unwrapped model)
+        if distributed: self.Model = DistributedDataParallel(self.model, device_ids=[device.index] if device.type == 'cuda' else None)
+        else: self.Model = self.model
+
+        lr, wd = self.hparams['learning_rate'], self.hparams['weight_decay']
+        if optim == 'Adam': self.optimizer = torch.optim.Adam(list(self.Model.parameters()),lr=lr, weight_decay=wd)
+        elif optim == 'Adagrad': self.optimizer = torch.optim.Adagrad(self.Model.parameters(), lr, weight_decay=wd)
+        elif optim == 'SGD': self.optimizer = torch.optim.SGD(self.Model.parameters(), lr=lr, momentum=0.9, weight_decay=wd)
+
+        # Apply adaptive learning rate (alr) scheme
+        alr_scheme = self.hparams['alr']
+        if alr_scheme == 'lin': self.scheduler = torch.optim.lr_scheduler.LinearLR(self.optimizer, start_factor=args.start_factor, end_factor=args.end_factor, total_iters=args.total_iters)
+        elif alr_scheme == 'mult': self.scheduler = torch.optim.lr_scheduler.MultiplicativeLR(self.optimizer, lr_lambda=lambda epoch: args.factor)
+        elif alr_scheme == 'plateau': self.scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(self.optimizer, factor=args.reduction, patience=args.patience, min_lr=args.min_lr)
+        else: self.scheduler = None
+
+        # Gradient scaling for mixed precision with fp16 (no-op otherwise)
+        self.scaler = torch.amp.GradScaler(device.type, enabled=amp == 'fp16')
+
+        self.early_stopper = EarlyStopper(patience=args.early_stop_patience, min_delta=args.early_stop_min_delta) if early_stopping else None
+
+        self.plotted = []
+        self.last_saved_epoch = 0
+        self.stopped = False
+        self.epoch = 0
+        self.pruned_epoch = None
+
+
+    # Full training state of the fold for resumable checkpoints
+    def state_dict(self):
+        return {'model': self.model.state_dict(),
+                'optimizer': self.optimizer.state_dict(),
+                'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+                'scaler': self.scaler.state_dict(),
+                'early_stopper': dict(vars(self.early_stopper)) if self.early_stopper is not None else None,
+                'best_epoch': self.best_epoch,
+                'best_metrics': self.best_metrics,
+                'plotted': self.plotted,
+                'last_saved_epoch': self.last_saved_epoch,
+                'stopped': self.stopped,
+                'epoch': self.epoch,
+                'pruned_epoch': self.pruned_epoch,
+                'loader_generator': self.loader_generator.get_state()}
+
+
+    def load_state_dict(self, state):
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        if self.scheduler is not None: self.scheduler.load_state_dict(state['scheduler'])
+        self.scaler.load_state_dict(state['scaler'])
+        if self.early_stopper is not None: vars(self.early_stopper).update(state['early_stopper'])
+        self.best_epoch = state['best_epoch']
+        self.best_metrics = state['best_metrics']
+        self.plotted = state['plotted']
+        self.last_saved_epoch = state['last_saved_epoch']
+        self.stopped = state['stopped']
+        self.epoch = state['epoch']
+        self.pruned_epoch = state['pruned_epoch']
+        self.loader_generator.set_state(state['loader_generator'])
+
+
+    def log(self, message):
+        log(f'[{self.label}] {message}' if multi_run else message, flush=True)
+        if self.log_file is not None:
+            self.log_file.write(message + '\n')
+            self.log_file.flush()
+
+
+    def wandb_log(self, metrics):
+        if wandb_tracking: wandb.log({f'{self.wandb_prefix}{key}': value for key, value in metrics.items()})
+
+
+    def log_metrics(self, epoch, log_string):
+        self.log(log_string)
+        self.wandb_log({
+                "Epoch": epoch,
+                "Learning Rate": self.optimizer.param_groups[0]['lr'],
+                "Training Loss":self.train_loss,
+                "Training Pearson Correlation": self.train_r,
+                "Training RMSE": self.train_rmse,
+                "Training R2": self.train_r2,
+                "Validation Loss":self.val_loss,
+                "Validation R2": self.val_r2,
+                "Validation Pearson Correlation": self.val_r,
+                "Validation RMSE": self.val_rmse
+                })
 
-train_loss, train_r, train_rmse, train_r2, train_y_true, train_y_pred = evaluate(Model, eval_loader_train, criterion, device)
-val_loss, val_r, val_rmse, val_r2, val_y_true, val_y_pred = evaluate(Model, eval_loader_val, criterion, device)
 
-log_string = f'Before Train: Train Loss: {train_loss:6.3f}|  Pearson:{train_r:6.3f}|  R2:{train_r2:6.3f}|  RMSE:{train_rmse:6.3f}|  -- Val Loss: {val_loss:6.3f}|  Pearson:{val_r:6.3f}|  R2:{val_r2:6.3f}|  RMSE:{val_rmse:6.3f}| '
-print(log_string)
+    def metrics_string(self):
+        return f'Train Loss: {self.train_loss:6.3f}|  Pearson:{self.train_r:6.3f}|  R2:{self.train_r2:6.3f}|  RMSE:{self.train_rmse:6.3f}|  -- Val Loss: {self.val_loss:6.3f}|  Pearson:{self.val_r:6.3f}|  R2:{self.val_r2:6.3f}|  RMSE:{self.val_rmse:6.3f}| '
 
-if wandb_tracking:
-    wandb.log({
-            "Epoch": epoch,
-            "Learning Rate": optimizer.param_groups[0]['lr'],
-            "Training Loss":train_loss,
-            "Training Pearson Correlation": train_r,
-            "Training RMSE": train_rmse,
-            "Training R2": train_r2,
-            "Validation Loss":val_loss,
-            "Validation R2": val_r2,
-            "Validation Pearson Correlation": val_r,
-            "Validation RMSE": val_rmse
-            })
+
+    # Training and Validation Set Performance BEFORE Training
+    #-------------------------------------------------------------------------------------------------------------------------------
+    def evaluate_before_training(self, epoch):
+        if wandb_tracking:
+            self.wandb_log({"Training Labels": wandb.Image(self.hist_training_labels),
+                            "Validation Labels": wandb.Image(self.hist_validation_labels)})
+
+        self.train_loss, self.train_r, self.train_rmse, self.train_r2, self.train_y_true, self.train_y_pred = evaluate(self.Model, self.eval_loader_train, criterion, device)
+        self.val_loss, self.val_r, self.val_rmse, self.val_r2, self.val_y_true, self.val_y_pred = evaluate(self.Model, self.eval_loader_val, criterion, device)
+        self.log_metrics(epoch, f'Before Train: {self.metrics_string()}')
+
+        # Initialize dictionary to store the current best epochs metrics
+        self.best_epoch = self.val_r
+        self.best_metrics = {'val': (self.val_loss, self.val_r, self.val_rmse, self.val_r2, self.val_y_true, self.val_y_pred),
+                             'train': (self.train_loss, self.train_r, self.train_rmse, self.train_r2, self.train_y_true, self.train_y_pred)}
+
+
+    # Training and Validation Set Performance of one Epoch
+    #-------------------------------------------------------------------------------------------------------------------------------
+    def train_epoch(self, epoch):
+        self.epoch = epoch
+
+        if distributed: self.train_sampler.set_epoch(epoch)
+        else: self.shuffle_generator.manual_seed(random_seed + epoch)
+        self.train_loss, self.train_r, self.train_rmse, self.train_r2, self.train_y_true, self.train_y_pred = train(self.Model, self.train_loader, criterion, self.optimizer, self.scaler, device)
+
+        # Training set metrics from an evaluation pass in eval mode instead of the in-flight metrics of the training pass
+        if train_metrics == 'eval' and epoch % args.train_eval_every == 0:
+            self.train_loss, self.train_r, self.train_rmse, self.train_r2, self.train_y_true, self.train_y_pred = evaluate(self.Model, self.eval_loader_train, criterion, device)
+
+        # Validation Set Performance Between Training Epochs
+        self.val_loss, self.val_r, self.val_rmse, self.val_r2, self.val_y_true, self.val_y_pred = evaluate(self.Model, self.eval_loader_val, criterion, device)
+
+        log_string = f'Epoch {epoch:05d}:  {self.metrics_string()}'
+
+        # Take a step in the activated learning rate reduction scheme
+        if isinstance(self.scheduler, torch.optim.lr_scheduler.ReduceLROnPlateau): self.scheduler.step(self.val_loss)
+        elif self.scheduler is not None: self.scheduler.step()
+
+
+        # If the previous best val_loss is beaten, save the model and update the best metrics dict
+        if self.val_r > self.best_epoch:
+            if main_process: writer.submit(torch.save, cpu_snapshot(self.model.state_dict()), f'{self.save_dir}/{self.run_name}_best_stdict.pt')
+            log_string += ' Saved'
+            self.last_saved_epoch = epoch
+
+            self.best_epoch = self.val_r
+            self.best_metrics['val'] = (self.val_loss, self.val_r, self.val_rmse, self.val_r2, self.val_y_true, self.val_y_pred)
+            self.best_metrics['train'] = (self.train_loss, self.train_r, self.train_rmse, self.train_r2, self.train_y_true, self.train_y_pred)
+
+        self.log_metrics(epoch, log_string)
+
+
+        early_stop = False
+        if early_stopping: early_stop = self.early_stopper.early_stop(self.val_r, self.train_r)
+
+
+        # After regular intervals, plot the predictions of the current and the best model
+        # -------------------------------------------------------------------------------------------------------------------------------
+        if (epoch % 100 == 0 or epoch == num_epochs or early_stop) and main_process:
+            self.plot_best()
+
+        # Is it time for early stopping?
+        if early_stop: self.stopped = True
+
+
+    def plot_best(self):
+
+        # If there has been a new best epoch in the last interval of epochs, plot the predictions of this model (rendered
+        # by the background writer, the best metrics are not modified in place)
+        if self.last_saved_epoch not in self.plotted:
+            writer.submit(plot_best_predictions, self.run_name, self.save_dir, self.last_saved_epoch,
+                          self.best_metrics['train'], self.best_metrics['val'], self.wandb_log if wandb_tracking else None)
+            self.plotted.append(self.last_saved_epoch)
 #-------------------------------------------------------------------------------------------------------------------------------
 
-# Initialize dictionary to store the current best epochs metrics
-best_epoch = val_r
-best_metrics = {'val': (val_loss, val_r, val_rmse, val_r2, val_y_true, val_y_pred),
-                'train': (train_loss, train_r, train_rmse, train_r2, train_y_true, train_y_pred)}
 
 
-plotted = []
-last_saved_epoch = 0
+if sweep: runs = [FoldRun(fold_to_train, trial) for trial in range(len(trials))]
+else: runs = [FoldRun(fold) for fold in folds]
+if main_process: torch.save(runs[0].model, f'{save_dir}/model_configuration.pt')
 
+parameters = count_parameters(runs[0].model)
+log(f'Model architecture {model_arch} with {parameters} parameters')
 
+if wandb_tracking:
+    config['Number of Parameters'] = parameters
+    config['Device'] = device_name
+    config['Folds'] = folds
+    if sweep: config['Sweep Trials'] = trials
 
-#===============================================================================================================================================
-# Training and Evaluation
-#===============================================================================================================================================
-tic = time.time()
-for epoch in range(epoch+1, num_epochs+1):
 
-    train_loss, train_r, train_rmse, train_r2, train_y_true, train_y_pred = train(Model, train_loader, criterion, optimizer, device)
 
+# Initialize WandB tracking with config dictionary (one run, with several folds the metrics are prefixed with the fold)
+#-----------------------------------------------------------------------------------
+if wandb_tracking:
+    wandb.login()
+    wandb_id = checkpoint['wandb_id'] if checkpoint is not None else None
+    wandb.init(project=project_name, name = run_name if multi_run else runs[0].run_name, config=config, dir=wandb_dir, id=wandb_id, resume='allow' if wandb_id else None)
 
-    # Validation Set Performance Between Training Epochs
-    #-------------------------------------------------------------------------------------------------------------------------------    
-    val_loss, val_r, val_rmse, val_r2, val_y_true, val_y_pred = evaluate(Model, eval_loader_val, criterion, device)
 
-    log_string = f'Epoch {epoch:05d}:  Train Loss: {train_loss:6.3f}|  Pearson:{train_r:6.3f}|  R2:{train_r2:6.3f}|  RMSE:{train_rmse:6.3f}|  -- Val Loss: {val_loss:6.3f}|  Pearson:{val_r:6.3f}|  R2:{val_r2:6.3f}|  RMSE:{val_rmse:6.3f}| '
 
-    if wandb_tracking:
-        wandb.log({
-                "Epoch": epoch,
-                "Learning Rate": optimizer.param_groups[0]['lr'],
-                "Training Loss":train_loss,
-                "Training Pearson Correlation": train_r,
-                "Training RMSE": train_rmse,
-                "Training R2": train_r2,
-                "Validation Loss":val_loss,
-                "Validation R2": val_r2,
-                "Validation Pearson Correlation": val_r,
-                "Validation RMSE": val_rmse
-                })
-        
-    # Take a step in the activated learning rate reduction schemes
-    if alr_plateau: plat_scheduler.step(val_loss)
-    if alr_lin: lin_scheduler.step()
-    if alr_mult: mult_scheduler.step()
+# Resumable Checkpoints
+#-------------------------------------------------------------------------------------------------------------------------------
+def write_checkpoint(state):
+    # Written to a temporary file that atomically replaces the previous checkpoint, so that an interrupted write never 
+    # corrupts it
+    tmp_path = f'{checkpoint_path}.tmp'
+    with open(tmp_path, 'wb') as file:
+        torch.save(state, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, checkpoint_path)
+
+
+def save_checkpoint(epoch):
+    # Full training state of all runs and the random number generators, snapshot on the CPU and written in the background
+    state = {'epoch': epoch,
+             'folds': {run.key: run.state_dict() for run in runs},
+             'trials': trials,
+             'rng': {'torch': torch.get_rng_state(),
+                     'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+                     'numpy': np.random.get_state(),
+                     'python': random.getstate()},
+             'wandb_id': wandb.run.id if wandb_tracking else None}
+    writer.submit(write_checkpoint, cpu_snapshot(state))
+
+
+def load_checkpoint(checkpoint):
+    if sorted(checkpoint['folds']) != sorted(run.key for run in runs) or checkpoint['trials'] != trials:
+        print(f'Aborted: Checkpoint contains the runs {sorted(checkpoint["folds"])}, which do not match the runs that should be trained')
+        sys.exit()
+    for run in runs: run.load_state_dict(checkpoint['folds'][run.key])
+
+    torch.set_rng_state(checkpoint['rng']['torch'])
+    if checkpoint['rng']['cuda'] is not None and torch.cuda.is_available(): torch.cuda.set_rng_state_all(checkpoint['rng']['cuda'])
+    np.random.set_state(checkpoint['rng']['numpy'])
+    random.setstate(checkpoint['rng']['python'])
+    return checkpoint['epoch']
+#-------------------------------------------------------------------------------------------------------------------------------
 
 
-    # If the previous best val_loss is beaten, save the model and update the best metrics dict
-    if val_r > best_epoch: 
-        torch.save(Model.state_dict(), f'{save_dir}/{run_name}_best_stdict.pt')
-        log_string += ' Saved'
-        last_saved_epoch = epoch
 
-        best_epoch = val_r
-        best_metrics['val'] = (val_loss, val_r, val_rmse, val_r2, val_y_true, val_y_pred)
-        best_metrics['train'] = (train_loss, train_r, train_rmse, train_r2, train_y_true, train_y_pred)
+# Hyperparameter Sweep
+#-------------------------------------------------------------------------------------------------------------------------------
+def prune_trials(epoch):
+    # Successive halving: The best 1/eta of the running trials by best validation Pearson R are kept, the others are stopped
+    running = [run for run in runs if not run.stopped]
+    n_keep = max(1, math.ceil(len(running) / args.sweep_eta))
+    ranked = sorted(running, key=lambda run: run.best_epoch, reverse=True)
+    for run in ranked[n_keep:]:
+        run.log(f'Pruned at Epoch {epoch} (Best Validation R {run.best_epoch:.3f})')
+        run.stopped = True
+        run.pruned_epoch = epoch
+        if main_process: run.plot_best()
+    log(f'Sweep: {n_keep} of {len(running)} trials continue after epoch {epoch}')
+
+
+def write_sweep_results():
+    # Table of the hyperparameters, the status and the best metrics of all trials, sorted by best validation R
+    rows = []
+    for run in sorted(runs, key=lambda run: run.best_epoch, reverse=True):
+        val_loss, val_r, val_rmse, val_r2, _, _ = run.best_metrics['val']
+        train_loss, train_r, train_rmse, train_r2, _, _ = run.best_metrics['train']
+        if run.pruned_epoch is not None: status = 'pruned'
+        elif run.stopped: status = 'early stopped'
+        elif run.epoch == num_epochs: status = 'completed'
+        else: status = 'running'
+        rows.append({'trial': run.trial, **{parameter: run.hparams[parameter] for parameter in sweep_parameters},
+                     'status': status, 'epochs': run.epoch, 'best_epoch': run.last_saved_epoch,
+                     'val_r': val_r, 'val_rmse': val_rmse, 'val_r2': val_r2, 'val_loss': val_loss,
+                     'train_r': train_r, 'train_rmse': train_rmse})
+
+    with open(os.path.join(save_dir, 'sweep_results.csv'), 'w', newline='') as csv_file:
+        table = csv.DictWriter(csv_file, fieldnames=list(rows[0]))
+        table.writeheader()
+        table.writerows(rows)
+#-------------------------------------------------------------------------------------------------------------------------------
 
-    print(log_string, flush=True)
 
-    if epoch % 50 == 0:
-        print(f'Time: {((time.time() - tic)/60):5.0f}')
+if checkpoint is not None:
+    epoch = load_checkpoint(checkpoint)
+    log(f'Resumed Training State of Epoch {epoch}')
 
+elif pretrained:
+    log(f'Start Epoch: {start_epoch}')
+    epoch = start_epoch
 
+else:
+    epoch = 0
 
-    early_stop = False
-    if early_stopping: early_stop = early_stopper.early_stop(val_r, train_r)
 
+log(f'Model Architecture {model_arch} - Folds {[fold_to_train] if sweep else folds} ({run_name})')
+if sweep: log(f'Sweep: {len(trials)} Trials ({args.sweep_workers} concurrently), the hyperparameters of the trials override the following')
+log(f'Number of Parameters: {parameters}')
+log(f'Learning Rate: {learning_rate}')
+log(f'Weight Decay: {weight_decay}')
+log(f'Batch Size: {batch_size}')
+log(f'Loss Function: {loss_function}')
+log(f'Number of Epochs: {num_epochs}')
+log(f'Mixed Precision: {amp if amp else "disabled (float32)"}')
+if train_metrics == 'eval': log(f'Training Metrics: Evaluation pass every {args.train_eval_every} epochs')
+else: log(f'Training Metrics: In-flight metrics of the training pass')
+log(f'{learning_rate_reduction_scheme}\n')
+
+log(f'Model Training Output ({run_name})')
+
+if checkpoint is None:
+    for run in runs: run.evaluate_before_training(epoch)
 
 
-    # After regular intervals, plot the predictions of the current and the best model
-    # -------------------------------------------------------------------------------------------------------------------------------
-    
-    if epoch % 100 == 0 or epoch == num_epochs or early_stop:
 
-        # Plot the predictions
-        # predictions = plot_predictions( train_y_true, train_y_pred,
-        #                                 val_y_true, val_y_pred,
-        #                                 f"{run_name}: Epoch {epoch}\nTrain R = {train_r:.3f}, Validation R = {val_r:.3f}\n Train RMSE = {train_rmse:.3f}, Validation RMSE = {val_rmse:.3f}")
+#===============================================================================================================================================
+# Training and Evaluation
+#===============================================================================================================================================
+# In a sweep, several trials can be trained concurrently in worker threads
+pool = ThreadPoolExecutor(max_workers=args.sweep_workers) if sweep and args.sweep_workers > 1 else None
 
+tic = time.time()
+for epoch in range(epoch+1, num_epochs+1):
 
-        # If there has been a new best epoch in the last interval of epochs, plot the predictions of this model      
-        if last_saved_epoch not in plotted:
-            
-            # Load the current best metrics from dict
-            val_loss, val_r, val_rmse, val_r2, val_y_true, val_y_pred = best_metrics['val']
-            train_loss, train_r, train_rmse, train_r2, train_y_true, train_y_pred = best_metrics['train']
+    # Train the runs (folds or trials) that have not been stopped early or pruned, one epoch each
+    active = [run for run in runs if not run.stopped]
+    if pool is not None: list(pool.map(lambda run: run.train_epoch(epoch), active))
+    else:
+        for run in active: run.train_epoch(epoch)
 
-            # Plot the predictions and the residuals plot
-            best_predictions = plot_predictions( train_y_true, train_y_pred,
-                                    val_y_true, val_y_pred,
-                                    f"{run_name}: Epoch {last_saved_epoch}\nTrain R = {train_r:.3f}, Validation R = {val_r:.3f}\nTrain RMSE = {train_rmse:.3f}, Validation RMSE = {val_rmse:.3f}")
-            best_predictions.savefig(f'{save_dir}/train_predictions.png')
+    # Successive halving of the trials of a sweep
+    if sweep and epoch in rungs:
+        prune_trials(epoch)
+        write_sweep_results()
 
-            residuals = residuals_plot(train_y_true, train_y_pred, val_y_true, val_y_pred, 
-                                    f"{run_name}: Epoch {last_saved_epoch}\nTrain R = {train_r:.3f}, Validation R = {val_r:.3f}\nTrain RMSE = {train_rmse:.3f}, Validation RMSE = {val_rmse:.3f}")     
-            residuals.savefig(f'{save_dir}/train_residuals.png')
+    if epoch % 50 == 0:
+        log(f'Time: {((time.time() - tic)/60):5.0f}')
 
-            plotted.append(last_saved_epoch)
+    # Save the full training state at regular intervals and at the end of the training
+    finished = all(run.stopped for run in runs) or epoch == num_epochs
+    if main_process and args.checkpoint_every > 0 and (epoch % args.checkpoint_every == 0 or finished):
+        save_checkpoint(epoch)
+
+    if finished: break
 
-        plt.close('all')
-        
-        if wandb_tracking: 
-            wandb.log({ #"Predictions Scatterplot": wandb.Image(predictions),
-                        "Best Predictions Scatterplot": wandb.Image(best_predictions),
-                        "Residuals Plot":wandb.Image(residuals)
-                        })
-            
-    
 
-    # Is it time for early stopping?
-    if early_stop: break
 
 
+# Wait for the checkpoints and plots that are still being written
+writer.close()
+if pool is not None: pool.shutdown()
 
+if sweep:
+    write_sweep_results()
+    best = max(runs, key=lambda run: run.best_epoch)
+    log(f'Sweep: Best Trial {best.trial} with Validation R {best.best_epoch:.3f} (Epoch {best.last_saved_epoch}): {best.hparams}')
+    log(f'Sweep Results saved to {os.path.join(save_dir, "sweep_results.csv")}')
 
 toc = time.time()
 training_time = (toc-tic)/60
-print(f"Time for Training: {training_time:5.1f} minutes - ({(training_time/num_epochs):5.2f} minutes/epoch)")
-if wandb_tracking: wandb.finish()
\ No newline at end of file
+log(f"Time for Training: {training_time:5.1f} minutes - ({(training_time/num_epochs):5.2f} minutes/epoch)")
+if device.type == 'cuda': log(f"Peak GPU Memory: {torch.cuda.max_memory_allocated(device) / 1024**3:.2f} GB")
+if distributed: dist.destroy_process_group()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+import argparse
+import torch
+from torch_geometric.loader import DataLoader
+from Dataset import *
+from model.GATE18 import *
+from model.ensemble import GATE18Ensemble
+
+
+'''
+Benchmark of the inference latency per batch of an ensemble of GATE18 models, comparing the eager models with the
+compiled deployment path (compile_model) and optionally the fused ensemble. Run from the repository root, e.g.:
+
+python -m utils.benchmark_inference --dataset_path <path/to/dataset> --stdicts <stdict1>,<stdict2> --threads 1
+'''
+
+
+def load_models(model_arch, stdicts, node_feat_dim, edge_feat_dim, device):
+    model_class = getattr(sys.modules[__name__], model_arch)
+    models = []
+    for path in stdicts:
+        model = model_class(dropout_prob=0, in_channels=node_feat_dim, edge_dim=edge_feat_dim, conv_dropout_prob=0).float().to(device)
+        model.load_state_dict(torch.load(path, map_location=device))
+        model.eval()
+        models.append(model)
+    return models
+
+
+def ensemble_predict(models, graphbatch):
+    prepared = PreparedBatch.from_batch(graphbatch)
+    if isinstance(models, GATE18Ensemble):
+        output, _ = models(graphbatch, prepared)
+        return output
+    return torch.mean(torch.stack([model(graphbatch, prepared).view(-1) for model in models]), dim=0)
+
+
+def benchmark(models, batches, device, repeats):
+    '''
+    Returns the predictions, the latency of the first pass (including compilation) and the median latency per batch
+    '''
+    with torch.no_grad():
+        start = time.perf_counter()
+        predictions = torch.cat([ensemble_predict(models, graphbatch) for graphbatch in batches])
+        if device.type == 'cuda': torch.cuda.synchronize()
+        first_pass = time.perf_counter() - start
+
+        latencies = []
+        for _ in range(repeats):
+            for graphbatch in batches:
+                start = time.perf_counter()
+                ensemble_predict(models, graphbatch)
+                if device.type == 'cuda': torch.cuda.synchronize()
+                latencies.append(time.perf_counter() - start)
+
+    return predictions, first_pass, sorted(latencies)[len(latencies) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the inference latency of eager and compiled GATE18 models")
+    parser.add_argument("--dataset_path", required=True, help="The path to the dataset pt file")
+    parser.add_argument("--stdicts", type=str, required=True, help="String of comma-separated paths to stdicts that should be evaluated as an ensemble")
+    parser.add_argument("--model_arch", default="GATE18d", help="The name of the model architecture")
+    parser.add_argument("--batch_size", default=128, type=int, help="The number of graphs per batch")
+    parser.add_argument("--num_batches", default=10, type=int, help="The number of batches that are timed")
+    parser.add_argument("--repeats", default=3, type=int, help="The number of timed passes over the batches")
+    parser.add_argument("--threads", default=None, type=int, help="The number of CPU threads used by torch (default: torch default)")
+    parser.add_argument("--device", default='cpu', help="The device the benchmark is run on")
+    parser.add_argument("--fused_ensemble", default=False, type=lambda x: x.lower() in ['true', '1', 'yes'], help="If the fused ensemble should be benchmarked as well")
+    args = parser.parse_args()
+
+    if args.threads is not None: torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+
+    dataset = torch.load(args.dataset_path)
+    loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False)
+    batches = [graphbatch.to(device) for graphbatch, _ in zip(loader, range(args.num_batches))]
+    node_feat_dim = dataset[0].x.shape[1]
+    edge_feat_dim = dataset[0].edge_attr.shape[1]
+    stdicts = args.stdicts.split(',')
+
+    print(f"{len(stdicts)} x {args.model_arch}, {len(batches)} batches of {args.batch_size} graphs, device {device}, {torch.get_num_threads()} threads")
+
+    variants = [('eager', False, False), ('compiled', False, True)]
+    if args.fused_ensemble: variants += [('fused eager', True, False), ('fused compiled', True, True)]
+
+    reference = None
+    for name, fused, compiled in variants:
+        models = load_models(args.model_arch, stdicts, node_feat_dim, edge_feat_dim, device)
+        if fused: models = GATE18Ensemble(models).to(device)
+        if compiled:
+            if fused: models = compile_model(models)
+            else: models = [compile_model(model) for model in models]
+
+        predictions, first_pass, latency = benchmark(models, batches, device, args.repeats)
+        if reference is None: reference = predictions
+        deviation = (predictions - reference).abs().max().item()
+        print(f"{name:<16} latency per batch: {latency*1000:8.1f} ms   first pass: {first_pass:6.1f} s   max deviation from eager: {deviation:.2e}")
+
+
+if __name__ == "__main__":
+    main()
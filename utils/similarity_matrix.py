@@ -0,0 +1,344 @@
+import os
+import json
+import argparse
+import h5py
+import numpy as np
+
+
+'''
+Storage of the pairwise similarity matrices of the complexes (Tanimoto, TM-score, ligand RMSD), as computed by the
+scripts in PDBbind_data/similarity/pairwise_similarity_matrix
+
+The matrices are computed into a dense dataset and can then be converted into a packed layout that stores only the
+upper triangle (including the diagonal) of the symmetric matrix, optionally in float16. Both layouts are read through
+SimilarityMatrix. Convert a computed matrix in place with:
+
+python -m utils.similarity_matrix --input <path/to/matrix.hdf5> [--dtype float16]
+'''
+
+
+def tile_ranges(size, tile_size):
+    # Start and end indices of the tiles along one dimension of a matrix
+    return [(start, min(start + tile_size, size)) for start in range(0, size, tile_size)]
+
+
+
+class TiledMatrixWriter:
+
+    """
+    Writes a symmetric square matrix into a dataset of a HDF5 file in square tiles of the upper triangle.
+
+    - The dataset is chunked with the tile size, so that each tile and its transpose are written in one chunk-aligned
+      operation each (every chunk is compressed once instead of once per element)
+    - For a tile on the diagonal, the upper triangle of the block is mirrored to the lower triangle
+    - Use as a context manager, the file is opened in append mode and an existing dataset is reused. An existing
+      dataset that is smaller than the matrix is grown to the new size (incremental updates), the new entries are 0.
+      The previous size is stored as attribute 'update_start' of the dataset, so that all runs of an update (e.g. in
+      several jobs) know the first new complex (update_start)
+    """
+
+    def __init__(self, path, size, tile_size, name='similarities', dtype='float32', compression='gzip'):
+        self.path = path
+        self.size = size
+        self.tile_size = tile_size
+        self.name = name
+        self.dtype = dtype
+        self.compression = compression
+        self.checked = False
+
+
+    def __enter__(self):
+        if not self.checked and os.path.exists(self.path): self.grow()
+
+        self.file = h5py.File(self.path, 'a')
+        chunks = (min(self.tile_size, self.size), min(self.tile_size, self.size))
+        if self.name not in self.file:
+            self.dset = self.file.create_dataset(self.name, (self.size, self.size), dtype=self.dtype,
+                                                 compression=self.compression, chunks=chunks, maxshape=(None, None))
+            self.dset.attrs['update_start'] = 0
+        else:
+            self.dset = self.file[self.name]
+            if not self.checked and self.dset.chunks != chunks:
+                print(f"Chunks {self.dset.chunks} of the existing dataset in {self.path} are not aligned to the tile size {self.tile_size}", flush=True)
+        self.update_start = int(self.dset.attrs.get('update_start', self.size))
+        self.checked = True
+        return self
+
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+
+    def grow(self):
+        """
+        Grows an existing dataset that is smaller than the matrix. Datasets that were created without a resizable
+        shape are copied into a new file in tile-sized row blocks, which then replaces the original file.
+        """
+        with h5py.File(self.path, 'r') as f:
+            if 'packed' in f and self.name not in f:
+                raise ValueError(f"{self.path} contains a packed matrix, matrices are computed in the dense layout and packed afterwards")
+            if self.name not in f: return
+            dset = f[self.name]
+            old_size = dset.shape[0]
+            if old_size > self.size:
+                raise ValueError(f"The matrix in {self.path} ({old_size}x{old_size}) is larger than the list of complexes ({self.size})")
+            if old_size == self.size: return
+            resizable = dset.maxshape[0] is None
+
+        print(f"Growing the matrix in {self.path} from {old_size} to {self.size} complexes", flush=True)
+        if resizable:
+            with h5py.File(self.path, 'a') as f:
+                f[self.name].resize((self.size, self.size))
+                f[self.name].attrs['update_start'] = old_size
+            return
+
+        tmp_path = f'{self.path}.tmp'
+        chunks = (min(self.tile_size, self.size), min(self.tile_size, self.size))
+        with h5py.File(self.path, 'r') as f_in, h5py.File(tmp_path, 'w') as f_out:
+            dset = f_out.create_dataset(self.name, (self.size, self.size), dtype=self.dtype,
+                                        compression=self.compression, chunks=chunks, maxshape=(None, None))
+            for r0, r1 in tile_ranges(old_size, self.tile_size):
+                dset[r0:r1, :old_size] = f_in[self.name][r0:r1, :]
+            dset.attrs['update_start'] = old_size
+        os.replace(tmp_path, self.path)
+
+
+    def tiles(self, row_start=0, row_end=None, col_start=0):
+        """
+        Returns the (row range, column range) of the tiles of the upper triangle, for the tile rows that start in
+        [row_start, row_end) and the tile columns that end after col_start
+        """
+        row_end = self.size if row_end is None else row_end
+        ranges = tile_ranges(self.size, self.tile_size)
+        return [(rows, cols) for r, rows in enumerate(ranges) if row_start <= rows[0] < row_end for cols in ranges[r:]
+                if cols[1] > col_start]
+
+
+    def write(self, rows, cols, block, mask=None):
+        """
+        Writes a tile and its transpose. With a boolean mask of the block, only the masked entries are written and
+        the others keep the values in the file.
+        """
+        (r0, r1), (c0, c1) = rows, cols
+        block = np.asarray(block, dtype=self.dtype)
+        if mask is not None: block = np.where(mask, block, self.dset[r0:r1, c0:c1])
+
+        if r0 == c0:
+            upper = np.triu(np.ones(block.shape, dtype=bool), k=1)
+            self.dset[r0:r1, c0:c1] = np.where(upper, block, block.T)
+        else:
+            self.dset[r0:r1, c0:c1] = block
+            self.dset[c0:c1, r0:r1] = block.T
+
+
+
+def stored_size(path, name='similarities'):
+    """
+    Returns the number of complexes of the matrix stored in an HDF5 file (dense or packed), None if there is none
+    """
+    if not os.path.exists(path): return None
+    with h5py.File(path, 'r') as f:
+        if name in f: return f[name].shape[0]
+        if 'packed' in f: return int(f['packed'].attrs['size'])
+    return None
+
+
+
+def update_complex_list(path, complexes, matrix_paths, name='similarities'):
+    """
+    Incremental updates of the matrices: Appends the complexes that are not yet in the list of the complexes of the
+    matrices (json file) to the end of the list, so that the existing complexes keep their indices. Returns the updated
+    list. The existing matrices have to cover the first complexes of the list, otherwise the new complexes would be
+    mixed up with the indices of the existing ones. A matrix can be smaller than the list if another matrix has already
+    been updated with the same list, it is then grown from its own size.
+    """
+    if not os.path.exists(path):
+        raise FileNotFoundError(f"{path} not found, the matrices can only be updated with the list of their complexes")
+    with open(path, 'r') as f:
+        existing = json.load(f)
+
+    for matrix_path in matrix_paths:
+        size = stored_size(matrix_path, name)
+        if size is None:
+            raise FileNotFoundError(f"No matrix found in {matrix_path}, there is nothing to update")
+        if size > len(existing):
+            raise ValueError(f"The matrix in {matrix_path} has {size} complexes, but {path} lists only {len(existing)} complexes")
+
+    missing = set(existing) - set(complexes)
+    if len(missing) > 0:
+        print(f"{len(missing)} complexes of {path} are not in the folder, their similarities to the new complexes cannot be computed", flush=True)
+
+    known = set(existing)
+    updated = existing + sorted(complex for complex in complexes if complex not in known)
+    print(f"Appended {len(updated) - len(existing)} new complexes to the {len(existing)} complexes of {path}", flush=True)
+
+    with open(path, 'w') as f:
+        json.dump(updated, f)
+    return updated
+
+
+
+def packed_offsets(rows, size):
+    # Position of the diagonal element (i, i) of the rows i in the packed upper triangle (row-major)
+    rows = np.asarray(rows, dtype=np.int64)
+    return rows * size - rows * (rows - 1) // 2
+
+
+
+class SimilarityMatrix:
+
+    """
+    Read access to a symmetric similarity matrix stored in a HDF5 file, either dense (dataset 'similarities') or packed
+    (dataset 'packed', the upper triangle of the matrix as a flat array)
+
+    - The packed dataset is stored contiguous and uncompressed, it is memory-mapped and the entries of the lower
+      triangle are gathered from their mirrored positions, so only the pages that are accessed are read from disk
+    - All accessors return float32 arrays
+    """
+
+    def __init__(self, path, name='similarities'):
+        self.path = path
+        self.file = h5py.File(path, 'r')
+        self.packed = 'packed' in self.file
+
+        if self.packed:
+            dset = self.file['packed']
+            self.size = int(dset.attrs['size'])
+            offset = dset.id.get_offset()
+            if offset is None or dset.chunks is not None: self.data = dset[:]
+            else: self.data = np.memmap(path, dtype=dset.dtype, mode='r', offset=offset, shape=dset.shape)
+        else:
+            self.data = self.file[name]
+            self.size = self.data.shape[0]
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def close(self):
+        self.data = None
+        self.file.close()
+
+
+    @property
+    def shape(self):
+        return (self.size, self.size)
+
+
+    def _gather(self, rows, cols):
+        # Entries (rows[k], cols[l]) of the packed matrix
+        rows, cols = np.asarray(rows, dtype=np.int64)[:, None], np.asarray(cols, dtype=np.int64)[None, :]
+        low, high = np.minimum(rows, cols), np.maximum(rows, cols)
+        return self.data[packed_offsets(low, self.size) + high - low].astype(np.float32)
+
+
+    def row(self, i):
+        if not self.packed: return self.data[i, :].astype(np.float32)
+        row = np.empty(self.size, dtype=np.float32)
+        start = packed_offsets(i, self.size)
+        row[i:] = self.data[start:start + self.size - i]
+        row[:i] = self._gather([i], np.arange(i))[0]
+        return row
+
+
+    def rows(self, indices, block_size=256):
+        """
+        Returns the rows with the given indices as a (len(indices), size) array
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        out = np.empty((len(indices), self.size), dtype=np.float32)
+        if not self.packed:
+            # h5py requires increasing indices for the selection
+            unique, inverse = np.unique(indices, return_inverse=True)
+            for start in range(0, len(unique), block_size):
+                block = self.data[unique[start:start + block_size], :]
+                selected = (inverse >= start) & (inverse < start + block_size)
+                out[selected] = block[inverse[selected] - start]
+            return out
+        for start in range(0, len(indices), block_size):
+            out[start:start + block_size] = self._gather(indices[start:start + block_size], np.arange(self.size))
+        return out
+
+
+    def block(self, rows, cols):
+        """
+        Returns the block of the matrix with the given (start, end) row and column ranges
+        """
+        (r0, r1), (c0, c1) = rows, cols
+        if not self.packed: return self.data[r0:r1, c0:c1].astype(np.float32)
+        return self._gather(np.arange(r0, r1), np.arange(c0, c1))
+
+
+    def submatrix(self, indices):
+        """
+        Returns the square submatrix of the complexes with the given indices
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if not self.packed: return self.rows(indices)[:, indices]
+        return self._gather(indices, indices)
+
+
+    def to_dense(self, block_size=1024):
+        dense = np.empty(self.shape, dtype=np.float32)
+        for r0, r1 in tile_ranges(self.size, block_size):
+            if not self.packed:
+                dense[r0:r1] = self.data[r0:r1, :]
+                continue
+            # Copy the packed rows into the upper triangle, then mirror the upper triangle of the row block
+            segment = self.data[packed_offsets(r0, self.size):packed_offsets(r1, self.size)]
+            for i in range(r0, r1):
+                start = packed_offsets(i, self.size) - packed_offsets(r0, self.size)
+                dense[i, i:] = segment[start:start + self.size - i]
+            dense[r1:, r0:r1] = dense[r0:r1, r1:].T
+            block = dense[r0:r1, r0:r1]
+            lower = np.tril(np.ones(block.shape, dtype=bool), k=-1)
+            block[lower] = block.T[lower]
+        return dense
+
+
+
+def pack_matrix(input_path, output_path=None, name='similarities', dtype='float32', block_size=512):
+    """
+    Converts the dense symmetric matrix in a HDF5 file into the packed layout read by SimilarityMatrix. The upper
+    triangle is read in row blocks and written as one contiguous segment per block. Without an output path, the input
+    file is replaced once the packed file is complete.
+    """
+    output_path = input_path if output_path is None else output_path
+    tmp_path = f'{output_path}.tmp'
+
+    with h5py.File(input_path, 'r') as f_in, h5py.File(tmp_path, 'w') as f_out:
+        dense = f_in[name]
+        size = dense.shape[0]
+        packed = f_out.create_dataset('packed', (size * (size + 1) // 2,), dtype=dtype)
+        packed.attrs['size'] = size
+
+        for r0, r1 in tile_ranges(size, block_size):
+            block = dense[r0:r1, r0:]
+            packed[packed_offsets(r0, size):packed_offsets(r1, size)] = np.concatenate(
+                [block[i - r0, i - r0:] for i in range(r0, r1)]).astype(dtype)
+
+    os.replace(tmp_path, output_path)
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a dense pairwise similarity matrix into the packed upper-triangular layout")
+    parser.add_argument("--input", required=True, help="The path to the HDF5 file with the dense matrix")
+    parser.add_argument("--output", default=None, help="The path to the packed HDF5 file (default: replace the input file)")
+    parser.add_argument("--dtype", default='float32', choices=['float32', 'float16'], help="The data type of the packed matrix")
+    parser.add_argument("--block_size", default=512, type=int, help="The number of rows that are converted at once")
+    args = parser.parse_args()
+
+    pack_matrix(args.input, args.output, dtype=args.dtype, block_size=args.block_size)
+
+    output_path = args.input if args.output is None else args.output
+    print(f"Packed matrix written to {output_path} ({os.path.getsize(output_path) / 1e6:.1f} MB)")
+
+
+if __name__ == "__main__":
+    main()